@@ -0,0 +1,87 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares `cp -al` with the native cloner.
+
+Run from the package root -
+  python3 -m benchmarks.clone_benchmark --files 200000
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from src.yaribak import cloner
+from src.yaribak import parallel_walk
+
+
+def _make_tree(root: str, num_files: int, files_per_dir: int) -> None:
+  for i in range(num_files):
+    if i % files_per_dir == 0:
+      directory = os.path.join(root, f'd{i // (files_per_dir * 32)}',
+                               f'd{i // files_per_dir}')
+      os.makedirs(directory)
+    with open(os.path.join(directory, f'f{i}'), 'w') as f:
+      f.write(str(i))
+
+
+def _drop_caches() -> None:
+  # Only possible as root; otherwise both runs see a warm cache.
+  try:
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+      f.write('3')
+  except OSError:
+    pass
+
+
+def main():
+  parser = argparse.ArgumentParser('clone_benchmark')
+  parser.add_argument('--files', type=int, default=100000)
+  parser.add_argument('--files-per-dir', type=int, default=100)
+  parser.add_argument('--workers',
+                      type=int,
+                      default=parallel_walk.DEFAULT_WORKERS)
+  parser.add_argument('--dir',
+                      type=str,
+                      default=None,
+                      help='Where to create the trees. Defaults to $TMPDIR.')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix='yaribak_bench_',
+                                   dir=args.dir) as tempdir:
+    source = os.path.join(tempdir, 'source')
+    _make_tree(source, args.files, args.files_per_dir)
+
+    _drop_caches()
+    start = time.monotonic()
+    subprocess.run(
+        ['cp', '-al', source, os.path.join(tempdir, 'cp')], check=True)
+    cp_secs = time.monotonic() - start
+    shutil.rmtree(os.path.join(tempdir, 'cp'))
+
+    _drop_caches()
+    stats = cloner.clone_tree(source,
+                              os.path.join(tempdir, 'native'),
+                              num_workers=args.workers)
+
+    print(f'cp -al: {cp_secs:0.2f}s '
+          f'({stats.entries / cp_secs:0.0f} entries/s)')
+    print(f'native ({args.workers} workers): {stats.seconds:0.2f}s '
+          f'({stats.entries_per_sec:0.0f} entries/s)')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,55 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures dedup of a renamed directory, with a cold and a warm hash cache.
+
+Run from the package root -
+  python3 -m benchmarks.dedup_benchmark --files 256 --file-mib 4
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from src.yaribak import dedup
+from src.yaribak import hash_cache
+
+
+def main():
+  parser = argparse.ArgumentParser('dedup_benchmark')
+  parser.add_argument('--files', type=int, default=256)
+  parser.add_argument('--file-mib', type=int, default=4)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix='yaribak_bench_') as tempdir:
+    old = os.path.join(tempdir, 'old', 'media')
+    os.makedirs(old)
+    for i in range(args.files):
+      with open(os.path.join(old, f'file{i:05d}'), 'wb') as f:
+        f.write(os.urandom(args.file_mib * 2**20))
+    cache_fname = os.path.join(tempdir, hash_cache.CACHE_FNAME)
+
+    for run in ['cold cache', 'warm cache']:
+      # The directory was renamed, so rsync copied all files afresh.
+      new = os.path.join(tempdir, 'new')
+      shutil.rmtree(new, ignore_errors=True)
+      shutil.copytree(os.path.dirname(old), new)
+      os.rename(os.path.join(new, 'media'), os.path.join(new, 'renamed'))
+      with hash_cache.HashCache(cache_fname) as cache:
+        stats = dedup.dedup(new, os.path.dirname(old), cache)
+      print(f'{run}: {stats}')
+
+
+if __name__ == '__main__':
+  main()
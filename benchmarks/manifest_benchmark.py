@@ -0,0 +1,95 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures manifest size, load time and memory per million entries.
+
+Run from the package root -
+  python3 -m benchmarks.manifest_benchmark --entries 1000000
+"""
+
+import argparse
+import os
+import random
+import resource
+import tempfile
+import time
+
+from src.yaribak import manifest
+
+
+def _rss_mib() -> float:
+  with open('/proc/self/statm') as f:
+    return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def main():
+  parser = argparse.ArgumentParser('manifest_benchmark')
+  parser.add_argument('--entries', type=int, default=1000000)
+  parser.add_argument('--lookups', type=int, default=100000)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix='yaribak_bench_') as tempdir:
+    fname = os.path.join(tempdir, manifest.MANIFEST_FNAME)
+    # The same stat is used for all entries; only the paths differ.
+    st = os.lstat(tempdir)
+    paths = [
+        f'dir{i // 1000:06d}/file{i % 1000:03d}' for i in range(args.entries)
+    ]
+
+    start = time.monotonic()
+    writer = manifest.ManifestWriter(fname, st)
+    for path in paths:
+      writer.add(manifest.path_key(path), st)
+    writer.close()
+    write_secs = time.monotonic() - start
+    size = os.path.getsize(fname)
+
+    rss_before = _rss_mib()
+    start = time.monotonic()
+    data = manifest.Manifest(fname)
+    open_secs = time.monotonic() - start
+
+    start = time.monotonic()
+    sample = random.Random(0).sample(paths, min(args.lookups, len(paths)))
+    for path in sample:
+      assert data.find(path) is not None
+    lookup_secs = time.monotonic() - start
+    rss_lookups = _rss_mib()
+
+    start = time.monotonic()
+    for _ in data:
+      pass
+    iterate_secs = time.monotonic() - start
+    rss_iterated = _rss_mib()
+    data.close()
+
+  per_million = 1e6 / args.entries
+  print(f'Entries: {args.entries}')
+  print(f'Write: {write_secs:0.2f}s')
+  print(f'File size: {size / 2**20:0.1f} MiB '
+        f'({size / 2**20 * per_million:0.1f} MiB per million entries)')
+  print(f'Open: {open_secs * 1e3:0.3f}ms')
+  print(f'Lookups: {len(sample)} in {lookup_secs:0.2f}s '
+        f'({lookup_secs / len(sample) * 1e6:0.1f}us each)')
+  print(f'Full iteration: {iterate_secs:0.2f}s '
+        f'({iterate_secs * per_million:0.2f}s per million entries)')
+  print(f'RSS growth after lookups: {rss_lookups - rss_before:0.1f} MiB, '
+        f'after full iteration: {rss_iterated - rss_before:0.1f} MiB '
+        '(mapped file pages, reclaimable)')
+  print(
+      f'Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:0.1f} MiB'
+  )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,103 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares utils.is_hardlinked_replica with the earlier os.walk version.
+
+Run from the package root -
+  python3 -m benchmarks.replica_benchmark --files 1000000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from src.yaribak import cloner
+from src.yaribak import parallel_walk
+from src.yaribak import utils
+
+from . import clone_benchmark
+
+
+def _walk_replica(dir1: str, dir2: str) -> bool:
+  """The earlier implementation, with os.walk and an lstat per file."""
+  for walk1, walk2 in zip(os.walk(dir1), os.walk(dir2)):
+    root1, dirs1, files1 = walk1
+    root2, dirs2, files2 = walk2
+    files1.sort()
+    files2.sort()
+    if files1 != files2:
+      return False
+    dirs1.sort()
+    dirs2.sort()
+    if dirs1 != dirs2:
+      return False
+    for file1, file2 in zip(files1, files2):
+      inode1 = os.lstat(os.path.join(root1, file1)).st_ino
+      inode2 = os.lstat(os.path.join(root2, file2)).st_ino
+      if inode1 != inode2:
+        return False
+  return True
+
+
+def main():
+  parser = argparse.ArgumentParser('replica_benchmark')
+  parser.add_argument('--files', type=int, default=100000)
+  parser.add_argument('--files-per-dir', type=int, default=100)
+  parser.add_argument('--workers',
+                      type=int,
+                      default=parallel_walk.DEFAULT_WORKERS)
+  parser.add_argument('--dir',
+                      type=str,
+                      default=None,
+                      help='Where to create the trees. Defaults to $TMPDIR.')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix='yaribak_bench_',
+                                   dir=args.dir) as tempdir:
+    source = os.path.join(tempdir, 'source')
+    replica = os.path.join(tempdir, 'replica')
+    clone_benchmark._make_tree(source, args.files, args.files_per_dir)
+    cloner.clone_tree(source, replica)
+
+    clone_benchmark._drop_caches()
+    start = time.monotonic()
+    assert _walk_replica(source, replica)
+    walk_secs = time.monotonic() - start
+
+    clone_benchmark._drop_caches()
+    start = time.monotonic()
+    assert utils.is_hardlinked_replica(source,
+                                       replica,
+                                       num_workers=args.workers)
+    new_secs = time.monotonic() - start
+
+    # Early exit: one difference in the last directory scanned by os.walk.
+    last_dir = max(
+        os.path.join(root, d)
+        for root, dirs, _ in os.walk(replica)
+        for d in dirs)
+    os.mkdir(os.path.join(last_dir, 'extra'))
+    start = time.monotonic()
+    assert not utils.is_hardlinked_replica(
+        source, replica, num_workers=args.workers)
+    differ_secs = time.monotonic() - start
+
+  print(f'os.walk version: {walk_secs:0.2f}s')
+  print(f'scandir version ({args.workers} workers): {new_secs:0.2f}s '
+        f'({walk_secs / new_secs:0.1f}x)')
+  print(f'scandir version, with a difference: {differ_secs:0.2f}s')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,98 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares the throughput of a first backup by rsync and by the seeder.
+
+The seeder is timed alone, and with the rsync pass that follows it in a
+backup with --seed. The rsync runs are skipped without rsync.
+
+Run from the package root -
+  python3 -m benchmarks.seed_benchmark --files 20000 --max-size 4194304
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from src.yaribak import parallel_walk
+from src.yaribak import seeder
+
+from . import clone_benchmark
+from . import tree_generator
+
+# As used by a backup, without the listing of changes.
+_RSYNC_FLAGS = ['-aAXHS', '--delete', '--delete-excluded']
+
+
+def _rsync(source: str, dest: str) -> float:
+  clone_benchmark._drop_caches()
+  start = time.monotonic()
+  subprocess.run(['rsync'] + _RSYNC_FLAGS + [f'{source}/', dest], check=True)
+  return time.monotonic() - start
+
+
+def _throughput(num_bytes: int, secs: float) -> str:
+  return f'{secs:0.2f}s ({num_bytes / 2**20 / secs:0.1f} MiB/s)'
+
+
+def main():
+  parser = argparse.ArgumentParser('seed_benchmark')
+  parser.add_argument('--files', type=int, default=20000)
+  parser.add_argument('--max-size', type=int, default=1 << 22)
+  parser.add_argument('--hardlink-ratio', type=float, default=0.05)
+  parser.add_argument('--workers',
+                      type=int,
+                      default=parallel_walk.DEFAULT_WORKERS)
+  parser.add_argument('--dir',
+                      type=str,
+                      default=None,
+                      help='Where to create the trees. Defaults to $TMPDIR.')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix='yaribak_bench_',
+                                   dir=args.dir) as tempdir:
+    source = os.path.join(tempdir, 'source')
+    spec = tree_generator.TreeSpec(files=args.files,
+                                   max_size=args.max_size,
+                                   hardlink_ratio=args.hardlink_ratio)
+    generated = tree_generator.generate(source, spec)
+    num_bytes = generated['bytes']
+    print(f'Source: {generated["files"]} files, {generated["hardlinks"]} '
+          f'hard links, {num_bytes / 2**20:0.1f} MiB')
+
+    has_rsync = shutil.which('rsync') is not None
+    if has_rsync:
+      rsync_dest = os.path.join(tempdir, 'rsync')
+      print(f'rsync: {_throughput(num_bytes, _rsync(source, rsync_dest))}')
+      shutil.rmtree(rsync_dest)
+    else:
+      print('rsync: skipped, not installed')
+
+    clone_benchmark._drop_caches()
+    seed_dest = os.path.join(tempdir, 'seed')
+    stats = seeder.seed_tree(source,
+                             seed_dest, [],
+                             num_workers=args.workers)
+    print(f'seed ({args.workers} workers): '
+          f'{_throughput(num_bytes, stats.seconds)}')
+    if has_rsync:
+      verify_secs = _rsync(source, seed_dest)
+      print(f'seed, then rsync: '
+            f'{_throughput(num_bytes, stats.seconds + verify_secs)}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,86 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Times an incremental backup with each snapshot strategy.
+
+Requires rsync. Run from the package root -
+  python3 -m benchmarks.snapshot_strategy_benchmark --files 200000
+"""
+
+import argparse
+import datetime
+import os
+import tempfile
+import time
+from unittest import mock
+
+from src.yaribak import backup_processor
+
+from . import clone_benchmark
+
+
+def _backup(strategy: str, source: str, target: str,
+            now: datetime.datetime) -> float:
+  processor = backup_processor.BackupProcessor(dryrun=False,
+                                               verbose=False,
+                                               only_if_changed=False,
+                                               low_ram=False,
+                                               snapshot_strategy=strategy)
+  start = time.monotonic()
+  with mock.patch.object(backup_processor, '_now', return_value=now):
+    processor.process(source, target, max_to_keep=-1, excludes=[], min_ttl=None)
+  return time.monotonic() - start
+
+
+def main():
+  parser = argparse.ArgumentParser('snapshot_strategy_benchmark')
+  parser.add_argument('--files', type=int, default=100000)
+  parser.add_argument('--files-per-dir', type=int, default=100)
+  parser.add_argument('--churn',
+                      type=float,
+                      default=0.01,
+                      help='Fraction of files to modify between backups.')
+  parser.add_argument('--dir',
+                      type=str,
+                      default=None,
+                      help='Where to create the trees. Defaults to $TMPDIR.')
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory(prefix='yaribak_bench_',
+                                   dir=args.dir) as tempdir:
+    source = os.path.join(tempdir, 'source')
+    clone_benchmark._make_tree(source, args.files, args.files_per_dir)
+    first = datetime.datetime(2022, 1, 1)
+    second = datetime.datetime(2022, 1, 2)
+    targets = {}
+    for strategy in backup_processor.SNAPSHOT_STRATEGIES:
+      targets[strategy] = os.path.join(tempdir, strategy)
+      os.mkdir(targets[strategy])
+      _backup(strategy, source, targets[strategy], first)
+
+    # Modify a spread of files.
+    step = max(1, int(1 / args.churn)) if args.churn > 0 else args.files + 1
+    for root, _, files in os.walk(source):
+      for i, fname in enumerate(sorted(files)):
+        if i % step == 0:
+          with open(os.path.join(root, fname), 'a') as f:
+            f.write('changed')
+
+    for strategy, target in targets.items():
+      clone_benchmark._drop_caches()
+      secs = _backup(strategy, source, target, second)
+      print(f'{strategy}: {secs:0.2f}s for an incremental backup')
+
+
+if __name__ == '__main__':
+  main()
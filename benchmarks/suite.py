@@ -0,0 +1,209 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs backups over several generations of a synthetic tree, as JSON results.
+
+Times the individual phases (clone with `cp -al` and natively, the replica
+check, and removal of a snapshot) on the generated tree, then runs full backup
+cycles with each snapshot strategy, changing the tree between backups. Phase
+timings of each backup come from the profiler. Backups need rsync, and are
+skipped without it.
+
+Run from the package root -
+  python3 -m benchmarks.suite --files 100000 --generations 5 --output a.json
+"""
+
+import argparse
+import dataclasses
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+from typing import Any, Callable, Dict, List, Optional
+
+from src.yaribak import backup_processor
+from src.yaribak import cloner
+from src.yaribak import reaper
+from src.yaribak import utils
+
+from . import clone_benchmark
+from . import tree_generator
+
+
+def _timed(fn: Callable[[], Any]) -> float:
+  clone_benchmark._drop_caches()
+  start = time.monotonic()
+  fn()
+  return round(time.monotonic() - start, 6)
+
+
+def _environment() -> Dict[str, Any]:
+  rsync: Optional[str] = None
+  if shutil.which('rsync'):
+    rsync = subprocess.run(['rsync', '--version'],
+                           check=True,
+                           capture_output=True,
+                           text=True).stdout.splitlines()[0]
+  return {
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpus': os.cpu_count(),
+      'rsync': rsync,
+  }
+
+
+def _phases(tempdir: str, spec: tree_generator.TreeSpec) -> Dict[str, float]:
+  """Times the phases that do not need rsync, on a fresh tree."""
+  source = os.path.join(tempdir, 'phases_source')
+  results = {}
+  results['generate'] = _timed(lambda: tree_generator.generate(source, spec))
+  cp_clone = os.path.join(tempdir, 'cp_clone')
+  results['clone_cp'] = _timed(
+      lambda: subprocess.run(['cp', '-al', source, cp_clone], check=True))
+  native_clone = os.path.join(tempdir, 'native_clone')
+  results['clone_native'] = _timed(
+      lambda: cloner.clone_tree(source, native_clone))
+  results['replica_check'] = _timed(
+      lambda: utils.is_hardlinked_replica(source, native_clone))
+
+  def delete() -> None:
+    reaper.move_to_trash(tempdir, cp_clone)
+    reaper.reap(tempdir)
+
+  results['delete'] = _timed(delete)
+  shutil.rmtree(native_clone)
+  shutil.rmtree(source)
+  return results
+
+
+def _cycles(tempdir: str, strategy: str, spec: tree_generator.TreeSpec,
+            generations: int, churn: float,
+            max_to_keep: int) -> List[Dict[str, Any]]:
+  """Backs up a fresh tree once per generation, changing it in between."""
+  source = os.path.join(tempdir, f'{strategy}_source')
+  target = os.path.join(tempdir, f'{strategy}_backups')
+  os.mkdir(target)
+  tree_generator.generate(source, spec)
+  profile_fname = os.path.join(tempdir, 'profile.json')
+  results = []
+  for generation in range(generations):
+    changes: Dict[str, int] = {}
+    if generation > 0:
+      changes = tree_generator.churn(source, spec, churn, generation)
+    processor = backup_processor.BackupProcessor(
+        dryrun=False,
+        verbose=False,
+        only_if_changed=False,
+        low_ram=False,
+        snapshot_strategy=strategy,
+        reap_mode=backup_processor.REAP_INLINE,
+        profile_fname=profile_fname)
+    now = datetime.datetime(2022, 1, 1) + datetime.timedelta(days=generation)
+    clone_benchmark._drop_caches()
+    start = time.monotonic()
+    with mock.patch.object(backup_processor, '_now', return_value=now):
+      processor.process(source,
+                        target,
+                        max_to_keep=max_to_keep,
+                        excludes=[],
+                        min_ttl=None)
+    seconds = time.monotonic() - start
+    with open(profile_fname) as f:
+      profile = json.load(f)
+    results.append({
+        'generation': generation,
+        'changes': changes,
+        'seconds': round(seconds, 6),
+        'phases': profile['totals'],
+    })
+  shutil.rmtree(source)
+  shutil.rmtree(target)
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser('suite')
+  parser.add_argument('--files', type=int, default=10000)
+  parser.add_argument('--depth', type=int, default=2)
+  parser.add_argument('--fanout', type=int, default=10)
+  parser.add_argument('--min-size', type=int, default=0)
+  parser.add_argument('--max-size', type=int, default=64 * 1024)
+  parser.add_argument('--hardlink-ratio', type=float, default=0.0)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--generations', type=int, default=4)
+  parser.add_argument('--churn',
+                      type=float,
+                      default=0.01,
+                      help='Fraction of files to change between backups.')
+  parser.add_argument('--max-to-keep',
+                      type=int,
+                      default=3,
+                      help='Older snapshots are deleted during the cycles.')
+  parser.add_argument('--strategies',
+                      nargs='+',
+                      choices=backup_processor.SNAPSHOT_STRATEGIES,
+                      default=list(backup_processor.SNAPSHOT_STRATEGIES))
+  parser.add_argument('--dir',
+                      type=str,
+                      default=None,
+                      help='Where to create the trees. Defaults to $TMPDIR.')
+  parser.add_argument('--output',
+                      type=str,
+                      default=None,
+                      help='Write the results here instead of stdout.')
+  args = parser.parse_args()
+
+  spec = tree_generator.TreeSpec(files=args.files,
+                                 depth=args.depth,
+                                 fanout=args.fanout,
+                                 min_size=args.min_size,
+                                 max_size=args.max_size,
+                                 hardlink_ratio=args.hardlink_ratio,
+                                 seed=args.seed)
+  environment = _environment()
+  results: Dict[str, Any] = {
+      'spec': dataclasses.asdict(spec),
+      'generations': args.generations,
+      'churn': args.churn,
+      'max_to_keep': args.max_to_keep,
+      'environment': environment,
+  }
+  with tempfile.TemporaryDirectory(prefix='yaribak_bench_',
+                                   dir=args.dir) as tempdir:
+    results['phases'] = _phases(tempdir, spec)
+    cycles: Dict[str, Any] = {}
+    for strategy in args.strategies:
+      if environment['rsync'] is None:
+        cycles[strategy] = 'skipped, no rsync'
+        continue
+      cycles[strategy] = _cycles(tempdir, strategy, spec, args.generations,
+                                 args.churn, args.max_to_keep)
+    results['cycles'] = cycles
+
+  if args.output is None:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+  else:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,136 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Generates synthetic source trees, and changes them between backups.
+
+The same spec and seed always give the same tree and the same changes, so
+results can be compared across runs and machines.
+"""
+
+import dataclasses
+import math
+import os
+import random
+
+from typing import Dict, List
+
+# Content of files is this block, repeated after a unique header.
+_BLOCK_SIZE = 1 << 16
+
+
+@dataclasses.dataclass
+class TreeSpec:
+  files: int = 10000
+  # Files are spread over directories this deep, with this many
+  # subdirectories in each.
+  depth: int = 2
+  fanout: int = 10
+  # Sizes are log-uniform between these, in bytes.
+  min_size: int = 0
+  max_size: int = 64 * 1024
+  # Fraction of files that are hard links to another file in the tree.
+  hardlink_ratio: float = 0.0
+  seed: int = 0
+
+
+def _directory(spec: TreeSpec, i: int) -> str:
+  """Leaf directory of the i-th file, so that leaves fill up evenly."""
+  parts = []
+  for _ in range(spec.depth):
+    parts.append(f'd{i % spec.fanout}')
+    i //= spec.fanout
+  return os.path.join(*parts) if parts else ''
+
+
+def _size(spec: TreeSpec, rng: random.Random) -> int:
+  low = math.log(spec.min_size + 1)
+  high = math.log(spec.max_size + 1)
+  return int(math.exp(rng.uniform(low, high))) - 1
+
+
+def _write(path: str, size: int, block: bytes, header: str) -> None:
+  content = header.encode()[:size]
+  with open(path, 'wb') as f:
+    f.write(content)
+    remaining = size - len(content)
+    while remaining > 0:
+      f.write(block[:remaining])
+      remaining -= len(block)
+
+
+def _block(seed: int) -> bytes:
+  rng = random.Random(seed)
+  return rng.getrandbits(8 * _BLOCK_SIZE).to_bytes(_BLOCK_SIZE, 'little')
+
+
+def generate(root: str, spec: TreeSpec) -> Dict[str, int]:
+  """Creates the tree at root. Returns counts of what was created."""
+  rng = random.Random(spec.seed)
+  block = _block(spec.seed)
+  paths: List[str] = []
+  stats = {'files': 0, 'hardlinks': 0, 'bytes': 0}
+  for i in range(spec.files):
+    relpath = os.path.join(_directory(spec, i), f'f{i}')
+    path = os.path.join(root, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if paths and rng.random() < spec.hardlink_ratio:
+      os.link(rng.choice(paths), path)
+      stats['hardlinks'] += 1
+      continue
+    size = _size(spec, rng)
+    _write(path, size, block, f'{relpath}\n')
+    paths.append(path)
+    stats['files'] += 1
+    stats['bytes'] += size
+  return stats
+
+
+def churn(root: str, spec: TreeSpec, ratio: float,
+          generation: int) -> Dict[str, int]:
+  """Changes about ratio of the files in the tree at root.
+
+  The changes are split evenly among modifying, adding, deleting and moving
+  files to another directory. The generation, e.g. a count of backups, makes
+  each call change different files.
+  """
+  rng = random.Random(f'{spec.seed}:{generation}')
+  block = _block(spec.seed)
+  # Sorted, so that the same files are chosen wherever root is.
+  files = sorted(
+      os.path.join(dirpath, name)
+      for dirpath, _, names in os.walk(root)
+      for name in names)
+  directories = sorted({os.path.dirname(path) for path in files} or {root})
+  num_changes = int(len(files) * ratio)
+  changed = rng.sample(files, min(num_changes, len(files)))
+  stats = {'modified': 0, 'added': 0, 'deleted': 0, 'moved': 0}
+  for i, path in enumerate(changed):
+    kind = i % 4
+    if kind == 0:
+      with open(path, 'ab') as f:
+        f.write(f'generation {generation}\n'.encode())
+      stats['modified'] += 1
+    elif kind == 1:
+      new_path = os.path.join(rng.choice(directories), f'g{generation}_{i}')
+      _write(new_path, _size(spec, rng), block,
+             f'{os.path.relpath(new_path, root)}\n')
+      stats['added'] += 1
+    elif kind == 2:
+      os.remove(path)
+      stats['deleted'] += 1
+    else:
+      new_path = os.path.join(rng.choice(directories),
+                              f'm{generation}_{os.path.basename(path)}')
+      os.rename(path, new_path)
+      stats['moved'] += 1
+  return stats
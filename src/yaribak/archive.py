@@ -0,0 +1,408 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compressed, seekable archive of a snapshot's payload.
+
+Layout of the file -
+  magic
+  compressed frames
+  record for each entry, sorted by path as in a manifest
+  index of u64 offsets to each record
+  u64 offsets of each frame, and of the end of the last frame
+  footer
+
+Contents of all regular files stored in the archive, in the order of the
+records, form one stream. The stream is cut into frames of FRAME_SIZE bytes,
+each compressed on its own, so reading a file only needs the frames it spans.
+
+Files hard linked from elsewhere, e.g. unchanged in newer snapshots, are not
+stored again. Instead, each such inode keeps one hard link in a directory of
+references next to the archive, and its records refer to it by number.
+
+Records are written to a temporary file while the frames are written, and
+appended after, so memory does not grow with the number of entries beyond
+their offsets.
+
+Frames are compressed with zstd if the zstandard module is installed (the
+"zstd" extra), and with zlib otherwise.
+"""
+
+import array
+import mmap
+import os
+import shutil
+import stat
+import struct
+import threading
+import zlib
+
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+try:
+  import zstandard  # type: ignore
+except ImportError:
+  zstandard = None
+
+from . import manifest
+from . import utils
+
+# Names in the snapshot directory.
+ARCHIVE_FNAME = 'archive.yar'
+REFS_DIR = 'refs'
+
+# Size of uncompressed frames.
+FRAME_SIZE = 4 << 20
+
+# Kinds of entries.
+DIRECTORY = 0
+# Regular file, stored in the archive.
+FILE = 1
+# Regular file, stored as a reference.
+REFERENCE = 2
+SYMLINK = 3
+# Other special files, e.g. devices or pipes.
+SPECIAL = 4
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+_MAGIC = b'YARCHV01'
+# kind, mode, uid, gid, mtime_ns, size, data, path length, symlink target
+# length, xattrs length. For files, data is the offset in the stream; for
+# references the reference number; and for special files the device number.
+_RECORD = struct.Struct('<BIIIqQQHHI')
+# magic, codec, frame size, number of entries, offset of index, number of
+# frames, offset of frame offsets.
+_FOOTER = struct.Struct('<8sBIQQQQ')
+# Length of an xattr name or value.
+_XATTR_LEN = struct.Struct('<I')
+
+_COPY_BUFFER_SIZE = 1 << 20
+
+
+class Entry(NamedTuple):
+  path: str
+  kind: int
+  mode: int
+  uid: int
+  gid: int
+  mtime_ns: int
+  size: int
+  data: int
+  target: str
+  xattrs: Dict[str, bytes]
+
+
+def _from_key(key: bytes) -> str:
+  return os.fsdecode(key.replace(b'\0', b'/'))
+
+
+def ref_path(refs_dir: str, number: int) -> str:
+  """Path of a reference, in subdirectories of up to 4096 entries."""
+  return os.path.join(refs_dir, f'{number >> 12:x}', f'{number:x}')
+
+
+def records_fname(fname: str) -> str:
+  """Temporary file for the records, while the archive is written."""
+  return fname + '.records.tmp'
+
+
+def default_codec() -> int:
+  return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+
+def _compressor(codec: int):
+  if codec == CODEC_ZSTD:
+    return zstandard.ZstdCompressor(level=3).compress
+  return lambda data: zlib.compress(data, 6)
+
+
+def _decompressor(codec: int):
+  if codec == CODEC_ZSTD:
+    if zstandard is None:
+      raise ValueError('Archive uses zstd; install the zstandard module')
+    return zstandard.ZstdDecompressor().decompress
+  if codec == CODEC_ZLIB:
+    return zlib.decompress
+  raise ValueError(f'Unknown codec {codec}')
+
+
+def _encode_xattrs(xattrs: Dict[str, bytes]) -> bytes:
+  parts = []
+  for name, value in sorted(xattrs.items()):
+    encoded = os.fsencode(name)
+    parts += [_XATTR_LEN.pack(len(encoded)), encoded]
+    parts += [_XATTR_LEN.pack(len(value)), value]
+  return b''.join(parts)
+
+
+def _decode_xattrs(data: bytes) -> Dict[str, bytes]:
+  xattrs = {}
+  offset = 0
+  while offset < len(data):
+    fields = []
+    for _ in range(2):
+      length = _XATTR_LEN.unpack_from(data, offset)[0]
+      offset += _XATTR_LEN.size
+      fields.append(data[offset:offset + length])
+      offset += length
+    xattrs[os.fsdecode(fields[0])] = fields[1]
+  return xattrs
+
+
+class _FrameWriter:
+  """Compresses a stream into frames of FRAME_SIZE."""
+
+  def __init__(self, f: BinaryIO, codec: int):
+    self._file = f
+    self._compress = _compressor(codec)
+    self._pending = bytearray()
+    self.offsets: List[int] = [f.tell()]
+    # Uncompressed bytes so far.
+    self.size = 0
+
+  def _flush(self, size: int) -> None:
+    self._file.write(self._compress(bytes(self._pending[:size])))
+    del self._pending[:size]
+    self.offsets.append(self._file.tell())
+
+  def write(self, data: bytes) -> None:
+    self._pending += data
+    self.size += len(data)
+    while len(self._pending) >= FRAME_SIZE:
+      self._flush(FRAME_SIZE)
+
+  def close(self) -> None:
+    if self._pending:
+      self._flush(len(self._pending))
+
+
+class ArchiveStats(NamedTuple):
+  entries: int
+  # Uncompressed bytes of files stored in the archive.
+  stored_bytes: int
+  # Bytes of files stored as references.
+  referenced_bytes: int
+  archive_bytes: int
+
+
+def write(payload: str,
+          fname: str,
+          refs_dir: str,
+          codec: Optional[int] = None) -> ArchiveStats:
+  """Archives payload into fname, with references in refs_dir.
+
+  Both are written under temporary names first, and renamed when complete.
+  """
+  if codec is None:
+    codec = default_codec()
+  tmp_fname = fname + '.tmp'
+  tmp_refs_dir = refs_dir + '.tmp'
+  os.makedirs(tmp_refs_dir)
+  # Inode to its reference number.
+  refs: Dict[int, int] = {}
+  # Offset of each record, relative to the first.
+  offsets = array.array('Q')
+  referenced_bytes = 0
+  with open(tmp_fname, 'wb') as f, open(records_fname(fname), 'w+b') as records:
+    f.write(_MAGIC)
+    frames = _FrameWriter(f, codec)
+    for key, entry in manifest.walk_sorted(payload):
+      st = entry.stat(follow_symlinks=False)
+      target = b''
+      data = 0
+      size = 0
+      if stat.S_ISDIR(st.st_mode):
+        kind = DIRECTORY
+      elif stat.S_ISLNK(st.st_mode):
+        kind = SYMLINK
+        target = os.fsencode(os.readlink(entry.path))
+      elif not stat.S_ISREG(st.st_mode):
+        kind = SPECIAL
+        data = st.st_rdev
+      elif st.st_nlink > 1:
+        kind = REFERENCE
+        size = st.st_size
+        if st.st_ino not in refs:
+          refs[st.st_ino] = len(refs)
+          link = ref_path(tmp_refs_dir, refs[st.st_ino])
+          os.makedirs(os.path.dirname(link), exist_ok=True)
+          os.link(entry.path, link)
+          referenced_bytes += size
+        data = refs[st.st_ino]
+      else:
+        kind = FILE
+        data = frames.size
+        with open(entry.path, 'rb') as src:
+          while True:
+            chunk = src.read(_COPY_BUFFER_SIZE)
+            if not chunk:
+              break
+            frames.write(chunk)
+        size = frames.size - data
+      xattrs = _encode_xattrs(utils.get_xattrs(entry.path))
+      offsets.append(records.tell())
+      records.write(
+          _RECORD.pack(kind, st.st_mode, st.st_uid, st.st_gid,
+                       st.st_mtime_ns, size, data, len(key), len(target),
+                       len(xattrs)) + key + target + xattrs)
+    frames.close()
+    stored_bytes = frames.size
+
+    records_offset = f.tell()
+    records.seek(0)
+    shutil.copyfileobj(records, f)
+    index_offset = f.tell()
+    for offset in offsets:
+      f.write(struct.pack('<Q', records_offset + offset))
+    frames_offset = f.tell()
+    f.write(struct.pack(f'<{len(frames.offsets)}Q', *frames.offsets))
+    f.write(
+        _FOOTER.pack(_MAGIC, codec, FRAME_SIZE, len(offsets), index_offset,
+                     len(frames.offsets) - 1, frames_offset))
+    f.flush()
+    os.fsync(f.fileno())
+    archive_bytes = f.tell()
+  os.remove(records_fname(fname))
+  os.replace(tmp_fname, fname)
+  os.rename(tmp_refs_dir, refs_dir)
+  return ArchiveStats(len(offsets), stored_bytes, referenced_bytes,
+                      archive_bytes)
+
+
+class Archive:
+  """Read-only, memory mapped view of an archive."""
+
+  def __init__(self, fname: str, refs_dir: str):
+    self._refs_dir = refs_dir
+    with open(fname, 'rb') as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = self._mmap[:len(_MAGIC)]
+    if len(self._mmap) < len(_MAGIC) + _FOOTER.size or header != _MAGIC:
+      self._mmap.close()
+      raise ValueError(f'{fname} is not an archive')
+    (magic, codec, self._frame_size, self._count, index_offset, num_frames,
+     frames_offset) = _FOOTER.unpack_from(self._mmap,
+                                          len(self._mmap) - _FOOTER.size)
+    if magic != _MAGIC:
+      self._mmap.close()
+      raise ValueError(f'{fname} is truncated')
+    self._decompress = _decompressor(codec)
+    view = memoryview(self._mmap)
+    self._index = view[index_offset:index_offset + 8 * self._count].cast('Q')
+    frames_end = frames_offset + 8 * (num_frames + 1)
+    self._frames = view[frames_offset:frames_end].cast('Q')
+    # The last frame read in each thread, since consecutive small files share
+    # frames.
+    self._frame_cache = threading.local()
+
+  def __len__(self) -> int:
+    return self._count
+
+  def _key(self, i: int) -> bytes:
+    offset = self._index[i]
+    key_len = _RECORD.unpack_from(self._mmap, offset)[7]
+    start = offset + _RECORD.size
+    return self._mmap[start:start + key_len]
+
+  def __getitem__(self, i: int) -> Entry:
+    if not 0 <= i < self._count:
+      raise IndexError(i)
+    offset = self._index[i]
+    (kind, mode, uid, gid, mtime_ns, size, data, key_len, target_len,
+     xattrs_len) = _RECORD.unpack_from(self._mmap, offset)
+    start = offset + _RECORD.size
+    key = self._mmap[start:start + key_len]
+    start += key_len
+    target = os.fsdecode(self._mmap[start:start + target_len])
+    start += target_len
+    xattrs = _decode_xattrs(self._mmap[start:start + xattrs_len])
+    return Entry(_from_key(key), kind, mode, uid, gid, mtime_ns, size, data,
+                 target, xattrs)
+
+  def __iter__(self) -> Iterator[Entry]:
+    for i in range(self._count):
+      yield self[i]
+
+  def _lower_bound(self, key: bytes) -> int:
+    lo, hi = 0, self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._key(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def find(self, path: str) -> Optional[Entry]:
+    key = manifest.path_key(path)
+    i = self._lower_bound(key)
+    if i < self._count and self._key(i) == key:
+      return self[i]
+    return None
+
+  def subtree(self, path: str) -> Iterator[Entry]:
+    """The entry at path and all entries under it, or all if path is empty.
+
+    Entries under a directory are contiguous in the sort order, so only they
+    are read.
+    """
+    if not path:
+      yield from self
+      return
+    key = manifest.path_key(path)
+    i = self._lower_bound(key)
+    if i < self._count and self._key(i) == key:
+      yield self[i]
+      i += 1
+    prefix = key + b'\0'
+    while i < self._count and self._key(i).startswith(prefix):
+      yield self[i]
+      i += 1
+
+  def ref_path(self, entry: Entry) -> str:
+    """Path of the hard link holding the content of a reference."""
+    if entry.kind != REFERENCE:
+      raise ValueError(f'{entry.path} is not a reference')
+    return ref_path(self._refs_dir, entry.data)
+
+  def _frame(self, number: int) -> bytes:
+    cached: Tuple[int, bytes] = getattr(self._frame_cache, 'frame', (-1, b''))
+    if cached[0] != number:
+      compressed = self._mmap[self._frames[number]:self._frames[number + 1]]
+      cached = (number, self._decompress(compressed))
+      self._frame_cache.frame = cached
+    return cached[1]
+
+  def read(self, entry: Entry) -> Iterator[bytes]:
+    """Content of a file stored in the archive, in chunks."""
+    if entry.kind != FILE:
+      raise ValueError(f'{entry.path} is not stored in the archive')
+    position = entry.data
+    end = entry.data + entry.size
+    while position < end:
+      number, start = divmod(position, self._frame_size)
+      chunk = self._frame(number)[start:start + end - position]
+      yield chunk
+      position += len(chunk)
+
+  def close(self) -> None:
+    self._index.release()
+    self._frames.release()
+    self._mmap.close()
+
+  def __enter__(self) -> 'Archive':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
@@ -0,0 +1,176 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs backups in an asyncio event loop, streaming events as they progress.
+
+Many backups can run at once in one event loop, e.g. -
+
+  async for event in async_backup.backup(processor, source, target, ...):
+    print(event)
+
+The steps of a backup come from BackupProcessor.steps(). Commands, e.g. rsync,
+run as asyncio subprocesses, and their output is parsed in the event loop.
+In-process work that may take long, e.g. the native clone, runs in the loop's
+default executor so that the loop is not blocked.
+
+Cancelling the task that iterates over the events stops the backup. Running
+commands are terminated and waited for, as is in-process work, so that nothing
+writes to the backup after. What was done so far is left in the "_incomplete"
+snapshot, to be handled by the next backup as after any interruption.
+"""
+
+import asyncio
+import logging
+import os
+
+from typing import Any, AsyncIterator, List, Optional
+
+from . import backup_processor
+from . import events
+
+
+async def _read_lines(stream: asyncio.StreamReader,
+                      lines: 'asyncio.Queue[Optional[str]]') -> None:
+  pending = b''
+  while True:
+    chunk = await stream.read(backup_processor.READ_SIZE)
+    if not chunk:
+      break
+    *complete, pending = backup_processor.LINE_END_RE.split(pending + chunk)
+    for line in complete:
+      lines.put_nowait(os.fsdecode(line))
+  if pending:
+    lines.put_nowait(os.fsdecode(pending))
+
+
+async def _run_command(args: List[str], lines: 'asyncio.Queue[Optional[str]]',
+                       read_output: bool) -> int:
+  """Runs a command, and returns its exit status.
+
+  Lines of its stdout are put in the queue if read_output, followed by None
+  when the command is done. If cancelled, the command is terminated.
+  """
+  try:
+    stdout = asyncio.subprocess.PIPE if read_output else None
+    proc = await asyncio.create_subprocess_exec(*args, stdout=stdout)
+    try:
+      if proc.stdout is not None:
+        await _read_lines(proc.stdout, lines)
+      return await proc.wait()
+    except BaseException:
+      if proc.returncode is None:
+        logging.info(f'Terminating {args[0]} ({proc.pid}).')
+        proc.terminate()
+        await proc.wait()
+      raise
+  finally:
+    lines.put_nowait(None)
+
+
+async def _call_blocking(request: backup_processor.CallBlocking) -> Any:
+  future = asyncio.get_running_loop().run_in_executor(None, request.fn)
+  try:
+    return await asyncio.shield(future)
+  except asyncio.CancelledError:
+    # The thread cannot be stopped, and may still write to the backup.
+    await asyncio.wait([future])
+    raise
+
+
+async def backup(processor: backup_processor.BackupProcessor,
+                 source: str,
+                 target: str,
+                 max_to_keep: int,
+                 excludes: List[str],
+                 min_ttl: Optional[float],
+                 dirty_dirs: Optional[List[str]] = None
+                 ) -> AsyncIterator[events.Event]:
+  """Runs a backup, and yields events as it progresses.
+
+  Arguments are as for BackupProcessor.process(). Backups that run at once
+  each need their own processor.
+  """
+  pending: List[events.Event] = []
+  steps = processor.steps(source,
+                          target,
+                          max_to_keep=max_to_keep,
+                          excludes=excludes,
+                          min_ttl=min_ttl,
+                          dirty_dirs=dirty_dirs,
+                          event_handler=pending.append)
+  result: Any = None
+  error: Optional[Exception] = None
+  num_done = 0
+  try:
+    while True:
+      step: Optional[backup_processor.Step] = None
+      try:
+        if error is None:
+          step = steps.send(result)
+        else:
+          step = steps.throw(error)
+      except StopIteration:
+        pass
+      # Events from the steps that just ran.
+      done, pending[:] = list(pending), []
+      for event in done:
+        yield event
+      if step is None:
+        break
+      result, error = None, None
+
+      if isinstance(step, str):
+        num_done += 1
+        logging.info(f'End of step #{num_done}. {step}')
+        yield events.StepDone(step)
+        continue
+      if isinstance(step, backup_processor.CallBlocking):
+        try:
+          result = await _call_blocking(step)
+        except asyncio.CancelledError:
+          raise
+        except Exception as e:  # Raised in the steps.
+          error = e
+        continue
+
+      lines: 'asyncio.Queue[Optional[str]]' = asyncio.Queue()
+      handler = step.output_handler
+      tasks = [
+          asyncio.ensure_future(_run_command(args, lines, handler is not None))
+          for args in step.commands
+      ]
+      try:
+        running = len(tasks)
+        while running:
+          line = await lines.get()
+          if line is None:
+            running -= 1
+            continue
+          assert handler is not None
+          handler(line)
+          done, pending[:] = list(pending), []
+          for event in done:
+            yield event
+        result = await asyncio.gather(*tasks)
+      except asyncio.CancelledError:
+        raise
+      except Exception as e:  # Raised in the steps.
+        error = e
+      finally:
+        for task in tasks:
+          task.cancel()
+        await asyncio.wait(tasks)
+  finally:
+    # If stopped early, e.g. cancelled, the steps may block to clean up, e.g.
+    # to wait for the background reaper.
+    await _call_blocking(backup_processor.CallBlocking(steps.close))
@@ -12,40 +12,205 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import contextlib
+import dataclasses
 import datetime
 import functools
 import logging
 import os
 import pathlib
+import re
 import shutil
 import subprocess
+import threading
+import time
 
-from typing import Iterator, List, Optional
+from typing import (Any, Callable, Generator, Iterator, List, Optional, TypeVar,
+                    Union)
 
+from . import catalog
+from . import changelog
+from . import chunks
+from . import cloner
+from . import dedup
+from . import events
+from . import governor
+from . import hash_cache
+from . import manifest
 from . import metadata
+from . import profiler
+from . import progress
+from . import reaper
+from . import resume
+from . import seeder
+from . import sharding
 from . import utils
 
 # TODO: Include option to omit backup if run within some period of last backup.
 
-_SNAPSHOT_DIR_PREFIX = 'ysnap_'
+_SNAPSHOT_DIR_PREFIX = catalog.SNAPSHOT_DIR_PREFIX
 
 # Time in seconds to buffer for elapsed time computation.
 # A backup will trigger even if elapsed time is short by this much.
 _ELAPSED_TIME_BUFFER = 30.0
 
+# Ways to create a new snapshot from the latest one.
+# Clones with hard links in-process, using a pool of threads.
+SNAPSHOT_NATIVE = 'native'
+# Clones with `cp -al`.
+SNAPSHOT_CP = 'cp'
+# Skips cloning. A single rsync pass creates the new snapshot, hard linking
+# unchanged files against the latest payload with --link-dest.
+SNAPSHOT_LINK_DEST = 'link-dest'
+SNAPSHOT_STRATEGIES = (SNAPSHOT_NATIVE, SNAPSHOT_CP, SNAPSHOT_LINK_DEST)
+
+# Lists the directories to update, when only some are, e.g. by `yaribak watch`.
+_FILES_FROM_FNAME = 'files_from.txt'
+
+# When to remove expired snapshots, after they are moved to the trash.
+# Reap the trash in the background during the next backup.
+REAP_BACKGROUND = 'background'
+# Reap right after moving to trash, before the backup finishes.
+REAP_INLINE = 'inline'
+# Only reap with `yaribak reap`.
+REAP_MANUAL = 'manual'
+REAP_MODES = (REAP_BACKGROUND, REAP_INLINE, REAP_MANUAL)
+
+# Splits output of subprocesses into lines, for any driver of the steps.
+LINE_END_RE = re.compile(rb'\r\n|\r|\n')
+READ_SIZE = 1 << 16
+
+_T = TypeVar('_T')
+
+
+@dataclasses.dataclass
+class RunCommands:
+  """Asks the driver of the steps to run commands at once.
+
+  Lines of their stdout are passed to output_handler one at a time, if given.
+  The exit statuses are sent back, in order.
+  """
+  commands: List[List[str]]
+  output_handler: Optional[Callable[[str], None]] = None
+
+
+@dataclasses.dataclass
+class CallBlocking:
+  """Asks the driver of the steps to call fn, and send back its result.
+
+  For in-process work that may take long, e.g. cloning, so that an asynchronous
+  driver can run it without blocking its event loop.
+  """
+  fn: Callable[[], Any]
+
+
+# Yielded by the steps of a backup. A string describes a step that is done,
+# for logging. Requests are run by the driver, e.g. run_sync().
+Step = Union[str, RunCommands, CallBlocking]
+
 
 # Useful for injection and testing.
-@functools.lru_cache(maxsize=None)
 def _now() -> datetime.datetime:
   return datetime.datetime.now()
 
 
-def _now_epoch() -> float:
-  return _now().timestamp()
+def elapsed_since_backup(target: str) -> Optional[float]:
+  """Seconds since the latest backup in target, as compared to minimum delay.
+
+  Returns None if there is no backup.
+  """
+  names = catalog.snapshot_names(target)
+  if not names:
+    return None
+  old_metadata = metadata.Metadata.load_from(
+      os.path.join(target, names[-1], 'backup_context.json'))
+  elapsed = _now().timestamp() - old_metadata.last_updated()
+  return elapsed + _ELAPSED_TIME_BUFFER
 
 
-def _now_str() -> str:
-  return _now().strftime('%Y%m%d_%H%M%S')
+def _run_with_output_handler(args: List[str],
+                             output_handler: Callable[[str], None]) -> None:
+  """Like subprocess.run(check=True), but streams stdout to a handler.
+
+  Lines may end with "\\r", as progress lines from rsync do.
+  """
+  with subprocess.Popen(args, stdout=subprocess.PIPE) as proc:
+    assert proc.stdout is not None
+    pending = b''
+    while True:
+      chunk = proc.stdout.read1(READ_SIZE)  # type: ignore
+      if not chunk:
+        break
+      *lines, pending = LINE_END_RE.split(pending + chunk)
+      for line in lines:
+        output_handler(os.fsdecode(line))
+    if pending:
+      output_handler(os.fsdecode(pending))
+  if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, args)
+
+
+def _run_commands(request: RunCommands) -> List[int]:
+  """Runs the commands of a request, each in its own thread if several."""
+  commands = request.commands
+  returncodes = [0] * len(commands)
+  lock = threading.Lock()
+
+  def locked_handler(line: str) -> None:
+    assert request.output_handler is not None
+    with lock:
+      request.output_handler(line)
+
+  def run(i: int) -> None:
+    try:
+      if request.output_handler is None:
+        subprocess.run(commands[i], check=True)
+      else:
+        _run_with_output_handler(commands[i], locked_handler)
+    except subprocess.CalledProcessError as e:
+      returncodes[i] = e.returncode
+
+  if len(commands) == 1:
+    run(0)
+  else:
+    with concurrent.futures.ThreadPoolExecutor(len(commands)) as executor:
+      # Consume the results to surface any exception.
+      for _ in executor.map(run, range(len(commands))):
+        pass
+  return returncodes
+
+
+def run_sync(steps: Generator[Step, Any, _T]) -> Generator[str, None, _T]:
+  """Runs the requests of steps in this thread, and yields the steps done.
+
+  Errors of a request are raised in the steps. The return value (of
+  `yield from`) is that of the steps.
+  """
+  result: Any = None
+  error: Optional[Exception] = None
+  try:
+    while True:
+      try:
+        if error is None:
+          step = steps.send(result)
+        else:
+          step = steps.throw(error)
+      except StopIteration as e:
+        return e.value
+      result, error = None, None
+      if isinstance(step, str):
+        yield step
+        continue
+      try:
+        if isinstance(step, RunCommands):
+          result = _run_commands(step)
+        else:
+          result = step.fn()
+      except Exception as e:  # Raised in the steps.
+        error = e
+  finally:
+    steps.close()
 
 
 class BackupProcessor:
@@ -55,82 +220,619 @@ class BackupProcessor:
                verbose: bool,
                only_if_changed: bool,
                low_ram: bool,
-               minimum_delay_secs: float = 0):
+               minimum_delay_secs: float = 0,
+               snapshot_strategy: str = SNAPSHOT_NATIVE,
+               reap_mode: str = REAP_BACKGROUND,
+               write_manifest: bool = False,
+               shards: int = 1,
+               dedup_files: bool = False,
+               seed: bool = False,
+               chunk_threshold: Optional[int] = None,
+               metrics_textfile: Optional[str] = None,
+               metrics_jsonl: Optional[str] = None,
+               profile_fname: Optional[str] = None,
+               resource_governor: Optional[governor.Governor] = None):
+    if snapshot_strategy not in SNAPSHOT_STRATEGIES:
+      raise ValueError(f'Unknown snapshot strategy {snapshot_strategy!r}; '
+                       f'expected one of {SNAPSHOT_STRATEGIES}')
+    if shards < 1:
+      raise ValueError(f'shards must be positive, got {shards}')
+    if reap_mode not in REAP_MODES:
+      raise ValueError(f'Unknown reap mode {reap_mode!r}; '
+                       f'expected one of {REAP_MODES}')
+    if chunk_threshold is not None and chunk_threshold < 1:
+      raise ValueError(
+          f'chunk_threshold must be positive, got {chunk_threshold}')
     self._dryrun = dryrun
-    self._rsync_flags = '-aAXHSv' if verbose else '-aAXHS'
+    self._verbose = verbose
+    self._low_ram = low_ram
+    self._governor = resource_governor or governor.Governor()
+    # Files of at least this size are stored in the chunk store, not copied by
+    # rsync.
+    self._chunk_threshold = chunk_threshold
+    self._rsync_flags = self._make_rsync_flags(low_ram)
+    self._only_if_changed = only_if_changed
+    self._minimum_delay_secs = minimum_delay_secs
+    self._snapshot_strategy = snapshot_strategy
+    self._reap_mode = reap_mode
+    self._write_manifest = write_manifest
+    self._shards = shards
+    self._dedup_files = dedup_files
+    # Copies the first backup with seeder before rsync.
+    self._seed = seed
+    self._metrics_textfile = metrics_textfile
+    self._metrics_jsonl = metrics_jsonl
+    self._profile_fname = profile_fname
+    # Replaced for each backup, if it is to be profiled.
+    self._profiler = profiler.Profiler(enabled=False)
+    # Open during a backup, except in dry runs.
+    self._catalog: Optional[catalog.Catalog] = None
+    # Open while rsync and others list changes, except in dry runs.
+    self._changelog_writer: Optional[changelog.ChangelogWriter] = None
+    # Set during a backup, to report its progress.
+    self._event_handler: Optional[Callable[[events.Event], None]] = None
+    # Set when a backup starts, for its name, metadata and expiry.
+    self._start_time: Optional[datetime.datetime] = None
+
+  def _now_epoch(self) -> float:
+    """Time of the backup being run, the same throughout it."""
+    assert self._start_time is not None
+    return self._start_time.timestamp()
+
+  def _make_rsync_flags(self, low_ram: bool) -> List[str]:
+    flags = ['-aAXHSv' if self._verbose else '-aAXHS']
     if not low_ram:
       # Forces collecting all hard links before running the backup.
       # See https://lincolnloop.com/blog/detecting-file-moves-renames-rsync/
-      self._rsync_flags += ' --no-inc-recursive --delete-after'
+      flags += ['--no-inc-recursive', '--delete-after']
     else:
-      self._rsync_flags += ' --delete'
-    self._rsync_flags += ' --delete-excluded'
-    self._only_if_changed = only_if_changed
-    self._minimum_delay_secs = minimum_delay_secs
+      flags.append('--delete')
+    flags.append('--delete-excluded')
+    # Lists each change, to detect changes and keep a changelog.
+    flags.append(f'--out-format={changelog.RSYNC_OUT_FORMAT}')
+    # Shows the overall progress and totals, to export as metrics.
+    flags.append(progress.RSYNC_FLAGS)
+    flags += self._governor.rsync_flags()
+    if self._chunk_threshold is not None:
+      flags.append(f'--max-size={self._chunk_threshold - 1}')
+    return flags
+
+  def _emit(self, event: events.Event) -> None:
+    if self._event_handler is not None:
+      self._event_handler(event)
+
+  @contextlib.contextmanager
+  def _phase(self, name: str, detail: str = '') -> Iterator[None]:
+    """Profiles a phase of the backup, and reports its start and end."""
+    self._emit(events.PhaseStarted(name, detail))
+    start = time.monotonic()
+    with self._profiler.span(name, detail):
+      yield
+    self._emit(events.PhaseFinished(name, detail, time.monotonic() - start))
+
+  def _execute_sh(
+      self,
+      args: List[str],
+      error_ok=False,
+      output_handler: Optional[Callable[[str], None]] = None
+  ) -> Generator[Step, Any, int]:
+    """Optionally executes, and returns the command back for logging.
 
-  def _execute_sh(self, command: str, error_ok=False) -> Iterator[str]:
-    """Optionally executes, and returns the command back for logging."""
+    If output_handler is given, it is called with each line of stdout.
+    The return value (of `yield from`) is the exit status of the command.
+    """
+    args = self._governor.command_prefix() + args
+    # Only for logging. Arguments are passed as they are, even with spaces.
+    command = ' '.join(args)
+    returncode = 0
     if not self._dryrun:
       logging.info(f'Running {command}')
-      try:
-        subprocess.run(command.split(' '), check=True)
-      except subprocess.CalledProcessError as e:
+      returncode, = yield RunCommands([args], output_handler)
+      if returncode:
+        error = subprocess.CalledProcessError(returncode, args)
         if not error_ok:
-          raise e
-        logging.warn(f'Process had error {e}')
+          raise error
+        logging.warn(f'Process had error {error}')
     yield command
+    return returncode
+
+  def _execute_parallel(
+      self,
+      commands: List[List[str]],
+      output_handler: Optional[Callable[[str], None]] = None
+  ) -> Generator[Step, Any, int]:
+    """Like _execute_sh() with error_ok, but runs all commands at once.
+
+    The output_handler is called with lines from all commands, one at a time.
+    The return value is the first non-zero exit status, if any.
+    """
+    prefix = self._governor.command_prefix()
+    commands = [prefix + args for args in commands]
+    returncodes = [0] * len(commands)
+    if not self._dryrun and commands:
+      for args in commands:
+        logging.info(f'Running {" ".join(args)}')
+      returncodes = yield RunCommands(commands, output_handler)
+      for args, returncode in zip(commands, returncodes):
+        if returncode:
+          error = subprocess.CalledProcessError(returncode, args)
+          logging.warn(f'Process had error {error}')
+    for args in commands:
+      yield ' '.join(args)
+    return next((code for code in returncodes if code), 0)
+
+  def _clone(self, latest: str, new_backup: str) -> Generator[Step, Any, None]:
+    """Creates new_backup as a hard-linked copy of latest."""
+    if self._snapshot_strategy == SNAPSHOT_CP:
+      yield from self._execute_sh(['cp', '-al', latest, new_backup])
+      return
+    if not self._dryrun:
+      stats = yield CallBlocking(
+          functools.partial(cloner.clone_tree,
+                            latest,
+                            new_backup,
+                            initializer=self._governor.apply_to_thread))
+      logging.info(f'Cloned {stats.entries} entries in {stats.seconds:0.2f}s '
+                   f'({stats.entries_per_sec:0.0f} entries/s).')
+    yield f'[Clone {latest} to {new_backup}]'
+
+  def _create_new_backup(self, source: str, latest: Optional[str],
+                         new_backup: str) -> Generator[Step, Any, None]:
+    if latest is not None and self._snapshot_strategy != SNAPSHOT_LINK_DEST:
+      yield from self._clone(latest, new_backup)
+      return
+    yield from self._execute_sh(['mkdir', new_backup])
+    # While creating the first backup, ensure that owner is maintained.
+    # This is useful as backups may be often run as root.
+    source_path = pathlib.Path(source)
+    owner, group = source_path.owner(), source_path.group()
+    yield from self._execute_sh(['chown', f'{owner}:{group}', new_backup])
+
+  def _resumable(self, new_backup: str,
+                 state: resume.ResumeState) -> Optional[resume.ResumeState]:
+    """The state saved in new_backup, if the backup can continue from it."""
+    saved = resume.ResumeState.load_from(
+        os.path.join(new_backup, resume.STATE_FNAME))
+    if saved is None:
+      logging.info(f'Cannot resume {new_backup}, which has no saved state.')
+      return None
+    if not saved.same_backup(state):
+      logging.info(f'Cannot resume {new_backup}, since the source, base or '
+                   f'strategy changed: {saved}')
+      return None
+    if resume.CLONE not in saved.phases:
+      logging.info(f'Cannot resume {new_backup}, which was not cloned.')
+      return None
+    return saved
+
+  def _save_state(self, state: resume.ResumeState, phase: str,
+                  new_backup: str) -> None:
+    """Records that a phase is done."""
+    state.phases.append(phase)
+    if not self._dryrun:
+      state.save_to(os.path.join(new_backup, resume.STATE_FNAME))
+
+  def _load_metadata(self, folder: str) -> metadata.Metadata:
+    if self._catalog is not None:
+      snapshot = self._catalog.get(os.path.basename(folder))
+      if snapshot is not None:
+        return snapshot.metadata
+    return metadata.Metadata.load_from(
+        os.path.join(folder, 'backup_context.json'))
 
   def _create_metadata(self, directory: str, source: str,
-                       min_ttl: Optional[float]) -> Iterator[str]:
+                       min_ttl: Optional[float]
+                       ) -> Generator[Step, Any, metadata.Metadata]:
     data = metadata.Metadata(source=source,
-                             epoch=int(_now_epoch()),
-                             updated_epoch=int(_now_epoch()),
+                             epoch=int(self._now_epoch()),
+                             updated_epoch=int(self._now_epoch()),
                              min_ttl=min_ttl)
+    yield from self._store_metadata(data, directory)
+    return data
+
+  def _store_metadata(self, data: metadata.Metadata,
+                      directory: str) -> Iterator[Step]:
     fname = os.path.join(directory, 'backup_context.json')
     if not self._dryrun:
-      data.save_to(fname)
+      with self._phase('metadata'):
+        data.save_to(fname)
     yield f'[Store metadata at {fname}]'
 
-  def _delete_older_backups(self, folders: List[str],
-                            max_to_keep: int) -> Iterator[str]:
-    """Deletes older backups, after reading and honoring min_ttl."""
+  def _update_metadata(self, old_metadata: metadata.Metadata,
+                       fname: str) -> Iterator[Step]:
+    """Marks an existing backup as up to date."""
+    old_metadata.updated_epoch = int(self._now_epoch())
+    name = os.path.basename(os.path.dirname(fname))
+    with self._phase('metadata'):
+      if not self._dryrun:
+        old_metadata.save_to(fname)
+      if self._catalog is not None:
+        self._catalog.update_metadata(name, old_metadata)
+    self._emit(events.SnapshotUpdated(name))
+    yield f'[Update metadata at {fname}]'
+
+  def _rsync_command(self,
+                     source: str,
+                     dest: str,
+                     excludes: List[str],
+                     extra_flags: Optional[List[str]] = None,
+                     shard: Optional[List[str]] = None) -> List[str]:
+    """Command to copy source to dest, or only the directories in shard."""
+    sources = [f'{source}/']
+    if shard is not None:
+      # With -R, the part of each path after "./" is recreated in dest.
+      sources = ['-R'] + [f'{source}/./{name}' for name in shard]
+    args = ['rsync'] + self._rsync_flags + sources + [dest]
+    args += extra_flags or []
+    for exclude in excludes:
+      args.append(f'--exclude={exclude}')
+    return args
+
+  def _rsync(
+      self,
+      source: str,
+      dest: str,
+      excludes: List[str],
+      extra_flags: List[str],
+      shards: Optional[List[List[str]]],
+      output_handler: Optional[Callable[[str], None]] = None
+  ) -> Generator[Step, Any, int]:
+    """Runs rsync, as one process or one per shard. Returns exit status.
+
+    Errors are ignored (e.g. if some files moved before copied), and only
+    reflected in the status.
+    """
+    if shards is None:
+      command = self._rsync_command(source, dest, excludes, extra_flags)
+      return (yield from self._execute_sh(command,
+                                          error_ok=True,
+                                          output_handler=output_handler))
+    # Top-level entries first. This also creates the directories for the
+    # shards, and removes deleted ones.
+    command = self._rsync_command(source, dest, excludes,
+                                  ['--no-recursive', '--dirs'] + extra_flags)
+    status = yield from self._execute_sh(command,
+                                         error_ok=True,
+                                         output_handler=output_handler)
+    commands = [
+        self._rsync_command(source, dest, excludes, extra_flags, shard)
+        for shard in shards
+    ]
+    shards_status = yield from self._execute_parallel(commands, output_handler)
+    return status or shards_status
+
+  def _metrics_writer(self,
+                      target: str) -> Optional[progress.MetricsWriter]:
+    if self._metrics_textfile is None and self._metrics_jsonl is None:
+      return None
+    return progress.MetricsWriter(self._metrics_textfile,
+                                  self._metrics_jsonl,
+                                  labels={'backup_path': target})
+
+  def _plan_shards(
+      self,
+      source: str,
+      latest: Optional[str],
+      excludes: List[str],
+  ) -> Generator[Step, Any, Optional[List[List[str]]]]:
+    if self._shards == 1:
+      return None
+
+    def plan() -> List[List[str]]:
+      manifest_fname: Optional[str] = None
+      if latest is not None:
+        manifest_fname = manifest.usable_manifest(latest)
+      return sharding.plan(source, excludes, self._shards, manifest_fname)
+
+    # Scans the top level of source, and reads the latest manifest.
+    shards = yield CallBlocking(plan)
+    logging.info(f'Copying top-level directories in {len(shards)} shards.')
+    return shards
+
+  def _probe(self, source: str, latest: str, excludes: List[str],
+             shards: Optional[List[List[str]]]) -> Generator[Step, Any, bool]:
+    """Checks if source differs from the latest backup, without any writes.
+
+    This runs before the clone, so that an unchanged source costs a single
+    scan. Attribute-only changes count here, since updating them in the clone
+    also updates the latest backup. Returns True if there are changes, or if
+    that could not be determined.
+    """
+    changes = changelog.RsyncOutputParser(count_attributes=True)
+    status = yield from self._rsync(source,
+                                    os.path.join(latest, 'payload'),
+                                    excludes, ['--dry-run'],
+                                    shards,
+                                    output_handler=changes)
+    if self._dryrun or status != 0 or changes.has_changes():
+      return True
+    if self._chunk_threshold is None:
+      return False
+    with self._phase('probe_chunks'):
+      return (yield CallBlocking(
+          functools.partial(chunks.has_changes,
+                            source,
+                            os.path.join(latest, chunks.MAPS_DIR),
+                            self._chunk_threshold,
+                            excludes,
+                            initializer=self._governor.apply_to_thread)))
+
+  def _write_files_from(self, fname: str,
+                        dirty_dirs: List[str]) -> Iterator[Step]:
+    """Lists dirty_dirs for rsync --files-from, along with --dirs.
+
+    Each directory ends with a slash, so that rsync updates its immediate
+    contents, and removes deleted ones with --delete.
+    """
+    if not self._dryrun:
+      with open(fname, 'w') as f:
+        for directory in dirty_dirs:
+          f.write((os.path.join(directory, '') or './') + '\n')
+    yield f'[List {len(dirty_dirs)} directories to update at {fname}]'
+
+  def _seed_payload(self, source: str, payload: str, excludes: List[str],
+                    changes: Optional[changelog.RsyncOutputParser]
+                    ) -> Generator[Step, Any, None]:
+    """Copies source to payload in-process, for rsync to complete after."""
+    if not self._dryrun:
+      assert changes is not None
+      lock = threading.Lock()
+
+      def on_change(change: changelog.Change) -> None:
+        with lock:
+          changes.add(change)
+
+      max_size: Optional[int] = None
+      if self._chunk_threshold is not None:
+        max_size = self._chunk_threshold - 1
+      stats = yield CallBlocking(
+          functools.partial(seeder.seed_tree,
+                            source,
+                            payload,
+                            excludes,
+                            max_size=max_size,
+                            initializer=self._governor.apply_to_thread,
+                            on_change=on_change))
+      logging.info(f'Seed {stats}.')
+    yield f'[Seed {payload} from {source}]'
+
+  def _chunk_files(self, source: str, target: str, latest: Optional[str],
+                   new_backup: str, excludes: List[str],
+                   dirty_dirs: Optional[List[str]],
+                   changes: Optional[changelog.RsyncOutputParser]
+                   ) -> Generator[Step, Any, bool]:
+    """Stores the large files that rsync skipped. Returns True if changed."""
+    assert self._chunk_threshold is not None
+    store = chunks.store_dir(target)
+    changed = False
+    if not self._dryrun:
+      assert changes is not None
+      lock = threading.Lock()
+
+      def on_change(change: changelog.Change) -> None:
+        with lock:
+          changes.add(change)
+
+      base_maps: Optional[str] = None
+      if latest is not None:
+        base_maps = os.path.join(latest, chunks.MAPS_DIR)
+      stats = yield CallBlocking(
+          functools.partial(chunks.chunk_tree,
+                            source,
+                            os.path.join(new_backup, 'payload'),
+                            os.path.join(new_backup, chunks.MAPS_DIR),
+                            base_maps,
+                            store,
+                            self._chunk_threshold,
+                            excludes,
+                            dirty_dirs=dirty_dirs,
+                            initializer=self._governor.apply_to_thread,
+                            on_change=on_change))
+      logging.info(f'Chunks {stats}.')
+      changed = stats.changed
+    yield f'[Store large files of {source} in {store}]'
+    return changed
+
+  def _collect_garbage(self, target: str) -> Generator[Step, Any, None]:
+    """Removes blocks of the chunk store that no snapshot uses."""
+    if not self._dryrun:
+      with self._phase('chunk_gc'):
+        stats = yield CallBlocking(
+            functools.partial(chunks.collect_garbage, target))
+      logging.info(f'Chunk store {stats}.')
+    yield f'[Collect garbage in {chunks.store_dir(target)}]'
+
+  def _dedup(self, target: str, latest: str,
+             new_backup: str) -> Generator[Step, Any, None]:
+    """Hard links files that were moved or renamed since latest."""
+
+    def run() -> dedup.DedupStats:
+      with hash_cache.HashCache(os.path.join(target,
+                                             hash_cache.CACHE_FNAME)) as cache:
+        return dedup.dedup(
+            os.path.join(new_backup, 'payload'),
+            os.path.join(latest, 'payload'),
+            cache,
+            changelog_fname=os.path.join(new_backup,
+                                         changelog.CHANGELOG_FNAME),
+            manifest_fname=manifest.usable_manifest(latest),
+            initializer=self._governor.apply_to_thread)
+
+    if not self._dryrun:
+      stats = yield CallBlocking(run)
+      logging.info(f'Dedup {stats}.')
+    yield f'[Dedup {new_backup} against {latest}]'
+
+  def _create_manifest(self,
+                       directory: str) -> Generator[Step, Any, Optional[int]]:
+    """Returns the number of entries, except in dry runs."""
+    fname = os.path.join(directory, manifest.MANIFEST_FNAME)
+    count: Optional[int] = None
+    if not self._dryrun:
+      start = time.monotonic()
+      count = yield CallBlocking(
+          functools.partial(manifest.write_tree,
+                            os.path.join(directory, 'payload'),
+                            fname,
+                            initializer=self._governor.apply_to_thread))
+      logging.info(f'Wrote {count} entries to manifest in '
+                   f'{time.monotonic() - start:0.2f}s.')
+    yield f'[Write manifest at {fname}]'
+    return count
+
+  def _delete_older_backups(self, target: str, folders: List[str],
+                            max_to_keep: int) -> Generator[Step, Any, int]:
+    """Moves older backups to trash, after reading and honoring min_ttl.
+
+    Returns the number moved.
+    """
     if not folders or max_to_keep < 1:
-      return
+      return 0
     num_deleted = 0
     for folder in sorted(folders):
       if len(folders) - num_deleted + 1 <= max_to_keep:
         logging.info(f'Deleted old dirs {num_deleted} out of {len(folders)}.')
         break
-      meta_fname = os.path.join(folder, 'backup_context.json')
-      old_metadata = metadata.Metadata.load_from(meta_fname)
+      old_metadata = self._load_metadata(folder)
       if old_metadata.min_ttl is not None:
-        elapsed = _now_epoch() - old_metadata.last_updated()
+        elapsed = self._now_epoch() - old_metadata.last_updated()
         logging.info(f'{folder} has ttl {old_metadata.min_ttl:0.1f}; '
                      f'elapsed {elapsed:0.1f}')
         if old_metadata.min_ttl > elapsed:
           logging.info('Skipping deletion.')
           continue
-      yield from self._execute_sh(f'rm -r {folder}')
+      yield from self._move_to_trash(target, folder)
+      if self._reap_mode == REAP_INLINE:
+        yield from self._reap(target)
       num_deleted += 1
+    return num_deleted
+
+  def _move_to_trash(self, target: str, folder: str) -> Iterator[Step]:
+    name = os.path.basename(folder)
+    with self._phase('delete', name):
+      if self._dryrun:
+        trashed = os.path.join(reaper.trash_dir(target), name)
+      else:
+        trashed = reaper.move_to_trash(target, folder)
+      if self._catalog is not None:
+        self._catalog.remove(name)
+    self._emit(events.SnapshotDeleted(name))
+    yield f'[Move {folder} to {trashed}]'
 
-  def _process_iterator(self, source: str, target: str, max_to_keep: int,
-                        excludes: List[str],
-                        min_ttl: Optional[float]) -> Iterator[str]:
-    """Creates an iterator of processes that need to be run for the backup."""
+  def _reap(self, target: str) -> Generator[Step, Any, None]:
+    if not self._dryrun:
+      with self._phase('reap'):
+        stats = yield CallBlocking(functools.partial(reaper.reap, target))
+      logging.info(f'Reaper {stats}.')
+    yield f'[Reap {reaper.trash_dir(target)}]'
+
+  def _start_reaper(self, target: str) -> Optional[reaper.BackgroundReaper]:
+    """Starts reaping snapshots trashed by earlier runs, if any."""
+    if self._dryrun or self._reap_mode == REAP_MANUAL:
+      return None
+    trash = reaper.trash_dir(target)
+    if not os.path.isdir(trash) or not os.listdir(trash):
+      return None
+    background_reaper = reaper.BackgroundReaper(target)
+    background_reaper.start()
+    return background_reaper
+
+  def steps(
+      self,
+      source: str,
+      target: str,
+      max_to_keep: int,
+      excludes: List[str],
+      min_ttl: Optional[float],
+      dirty_dirs: Optional[List[str]] = None,
+      event_handler: Optional[Callable[[events.Event], None]] = None
+  ) -> Generator[Step, Any, None]:
+    """The steps of a backup, to be run by a driver, e.g. run_sync().
+
+    If dirty_dirs is given, only those directories (relative to source) are
+    updated in the clone of the latest backup. They must include every
+    directory with a change since then.
+
+    If event_handler is given, it is called with events as the backup
+    progresses, from whichever thread runs the steps.
+    """
     if not os.path.isdir(target):
       raise ValueError(f'{target!r} is not a valid directory')
+    if dirty_dirs is not None and self._snapshot_strategy == SNAPSHOT_LINK_DEST:
+      raise ValueError('Updating only some directories needs a clone of the '
+                       f'latest backup, not {SNAPSHOT_LINK_DEST!r}')
+    self._event_handler = event_handler
+    self._start_time = _now()
+    if self._profile_fname is not None:
+      self._profiler = profiler.Profiler()
+    if not self._dryrun:
+      self._catalog = catalog.Catalog(target)
+    background_reaper = self._start_reaper(target)
+    error: Optional[Exception] = None
+    try:
+      try:
+        yield from self._backup_iterator(source=source,
+                                         target=target,
+                                         max_to_keep=max_to_keep,
+                                         excludes=excludes,
+                                         min_ttl=min_ttl,
+                                         dirty_dirs=dirty_dirs)
+      except Exception as e:
+        # Raised once the reaper is done, which is also a blocking call for
+        # the driver to run.
+        error = e
+      if background_reaper is not None:
+        reap_stats = yield CallBlocking(background_reaper.join)
+        background_reaper = None
+        logging.info(f'Reaper {reap_stats}.')
+      if error is not None:
+        raise error
+    finally:
+      # Only if the steps were closed, or the reaper failed.
+      if background_reaper is not None:
+        logging.info(f'Reaper {background_reaper.join()}.')
+      if self._changelog_writer is not None:
+        # Stopped. Kept for the backup that resumes this one.
+        self._changelog_writer.suspend()
+        self._changelog_writer = None
+      if self._catalog is not None:
+        self._catalog.close()
+        self._catalog = None
+      self._event_handler = None
+      self._start_time = None
+      if self._profile_fname is not None:
+        self._profiler.write(self._profile_fname)
+        logging.info(f'Wrote profile to {self._profile_fname}.')
+        self._profiler = profiler.Profiler(enabled=False)
+
+  def _process_iterator(self, *args, **kwargs) -> Iterator[str]:
+    """Runs the steps of a backup in this thread, and yields each step."""
+    return run_sync(self.steps(*args, **kwargs))
+
+  def _backup_iterator(self, source: str, target: str, max_to_keep: int,
+                       excludes: List[str], min_ttl: Optional[float],
+                       dirty_dirs: Optional[List[str]] = None
+                       ) -> Generator[Step, Any, None]:
+    start_time = time.monotonic()
     prefix = os.path.join(target, _SNAPSHOT_DIR_PREFIX)
     # This is a temporary directory, to use in case backup is stopped in the middle.
     new_backup = os.path.join(target, prefix + '_incomplete')
-    if not self._dryrun and os.path.exists(new_backup):
-      yield f'[Remove lingering {new_backup}]'
-      shutil.rmtree(new_backup)
-
-    folders = [
-        os.path.join(it.path)
-        for it in os.scandir(target)
-        if it.is_dir() and it.path.startswith(prefix)
-    ]
+
+    with self._phase('scan'):
+      if self._catalog is not None:
+        folders = [
+            os.path.join(target, snapshot.name)
+            for snapshot in self._catalog.snapshots()
+        ]
+      else:
+        folders = [
+            os.path.join(it.path)
+            for it in os.scandir(target)
+            if it.is_dir() and it.path.startswith(prefix)
+        ]
+        # Not a snapshot yet.
+        if new_backup in folders:
+          folders.remove(new_backup)
 
     # The directory with latest backup.
     latest: Optional[str] = None
@@ -139,64 +841,225 @@ class BackupProcessor:
       latest = max(folders)
       # Load and store old metadata.
       meta_fname = os.path.join(latest, 'backup_context.json')
-      old_metadata = metadata.Metadata.load_from(meta_fname)
+      old_metadata = self._load_metadata(latest)
 
-      delay_since = _now_epoch() - old_metadata.last_updated(
+      delay_since = self._now_epoch() - old_metadata.last_updated(
       ) + _ELAPSED_TIME_BUFFER
       if delay_since < self._minimum_delay_secs:
         logging.info(f'Nothing to do since elapsed time {delay_since:0.2f} '
                      f'is less than {self._minimum_delay_secs}.')
         return
 
-      yield from self._execute_sh(f'cp -al {latest} {new_backup}')
-      # Rsync version, echoes the directories being copied.
-      # yield from self._execute(
-      #     f'rsync -aAXHSv {latest}/ {new_backup}/ --link-dest={latest}'))
-    else:
-      yield from self._execute_sh(f'mkdir {new_backup}')
-      # While creating the first backup, ensure that owner is maintained.
-      # This is useful as backups may be often run as root.
-      source_path = pathlib.Path(source)
-      owner, group = source_path.owner(), source_path.group()
-      yield from self._execute_sh(f'chown {owner}:{group} {new_backup}')
-
-    yield from self._create_metadata(directory=new_backup,
-                                     source=source,
-                                     min_ttl=min_ttl)
-
-    # List that will be joined to get the final command.
+    state = resume.ResumeState(
+        source=source,
+        base=None if latest is None else os.path.basename(latest),
+        snapshot_strategy=self._snapshot_strategy)
+    # Left by a backup that was stopped.
+    resumed: Optional[resume.ResumeState] = None
+    if os.path.exists(new_backup):
+      resumed = self._resumable(new_backup, state)
+      if resumed is not None:
+        state = resumed
+        if not self._dryrun:
+          # In case it was stopped while deduplicating.
+          yield CallBlocking(
+              functools.partial(dedup.remove_leftovers,
+                                os.path.join(new_backup, 'payload')))
+        yield f'[Resume {new_backup} after {", ".join(state.phases)}]'
+      elif not self._dryrun:
+        yield f'[Remove lingering {new_backup}]'
+        with self._phase('remove_lingering'):
+          yield CallBlocking(functools.partial(shutil.rmtree, new_backup))
+
+    if latest is None or resumed is not None:
+      # Nothing to update, so the whole source is copied. When resuming, the
+      # directories that were dirty before the stop are not known.
+      dirty_dirs = None
+    elif self._governor.ram_budget is not None:
+      assert old_metadata is not None
+      latest_entries: Optional[int] = None
+      if self._catalog is not None:
+        snapshot = self._catalog.get(os.path.basename(latest))
+        if snapshot is not None:
+          latest_entries = snapshot.entries
+      files = governor.predicted_files(old_metadata, latest_entries)
+      self._rsync_flags = self._make_rsync_flags(
+          self._governor.low_ram(files, default=self._low_ram))
+
+    # Only some directories are updated, so there is nothing to shard.
+    shards: Optional[List[List[str]]] = None
+    if dirty_dirs is None:
+      shards = yield from self._plan_shards(source, latest, excludes)
+
+    # Dirty directories are known to have changes, so skip the probe. A
+    # resumed backup has had changes copied already.
+    probe = self._only_if_changed and dirty_dirs is None and resumed is None
+    if latest is not None and probe:
+      with self._phase('probe'):
+        changed = yield from self._probe(source, latest, excludes, shards)
+      if not changed:
+        logging.info(f'There was no change since {latest}.')
+        assert old_metadata is not None
+        yield from self._update_metadata(old_metadata, meta_fname)
+        return
+
+    if resumed is None:
+      with self._phase('clone'):
+        yield from self._create_new_backup(source, latest, new_backup)
+      self._save_state(state, resume.CLONE, new_backup)
+
+    new_metadata = yield from self._create_metadata(directory=new_backup,
+                                                    source=source,
+                                                    min_ttl=min_ttl)
+
     new_backup_payload = os.path.join(new_backup, 'payload')
-    command_build = [
-        f'rsync {self._rsync_flags} {source}/ {new_backup_payload}'
-    ]
-    for exclude in excludes:
-      command_build.append(f'--exclude={exclude}')
-    # Ignore rsync errors (e.g. if some files moved before copied).
-    yield from self._execute_sh(' '.join(command_build), error_ok=True)
+    extra_flags = []
+    if latest is not None and self._snapshot_strategy == SNAPSHOT_LINK_DEST:
+      # Unchanged files become hard links to the latest payload. Unlike
+      # updating a clone, this never changes attributes in place on inodes
+      # shared with older snapshots.
+      extra_flags.append(f'--link-dest={os.path.join(latest, "payload")}')
+    files_from: Optional[str] = None
+    if dirty_dirs is not None:
+      files_from = os.path.join(new_backup, _FILES_FROM_FNAME)
+      yield from self._write_files_from(files_from, dirty_dirs)
+      extra_flags += [f'--files-from={files_from}', '--dirs']
+    changes: Optional[changelog.RsyncOutputParser] = None
+    writer: Optional[changelog.ChangelogWriter] = None
+    tracker: Optional[progress.ProgressTracker] = None
+    if not self._dryrun:
+      changelog_fname = os.path.join(new_backup, changelog.CHANGELOG_FNAME)
+      earlier_changes: Optional[str] = None
+      if resumed is not None:
+        earlier_changes = changelog.set_aside_partial(changelog_fname)
+      writer = changelog.ChangelogWriter(changelog_fname)
+      self._changelog_writer = writer
+      changes = changelog.RsyncOutputParser(
+          writer,
+          echo=self._verbose,
+          ignore_new_dirs=self._snapshot_strategy == SNAPSHOT_LINK_DEST)
+      tracker = progress.ProgressTracker(
+          changes,
+          self._metrics_writer(target),
+          on_progress=lambda metrics: self._emit(
+              events.RsyncProgress.from_metrics(metrics)))
+      if earlier_changes is not None:
+        # Rsync does not list again what was copied before the stop.
+        read_all = yield CallBlocking(
+            functools.partial(changelog.read_partial, earlier_changes,
+                              changes.add))
+        if not read_all and not state.changelog_lost:
+          logging.warning('Changes listed before the stop were lost. The '
+                          'backup will have no changelog.')
+          state.changelog_lost = True
+          state.save_to(os.path.join(new_backup, resume.STATE_FNAME))
+        os.remove(earlier_changes)
+    # Seeding needs an empty destination. If one was stopped, rsync completes
+    # it.
+    if latest is None and self._seed and resumed is None:
+      with self._phase('seed'):
+        yield from self._seed_payload(source, new_backup_payload, excludes,
+                                      changes)
+      self._save_state(state, resume.SEED, new_backup)
+    with self._phase('rsync'):
+      rsync_status = yield from self._rsync(source,
+                                            new_backup_payload,
+                                            excludes,
+                                            extra_flags,
+                                            shards,
+                                            output_handler=tracker)
+    self._save_state(state, resume.RSYNC, new_backup)
+    if files_from is not None and not self._dryrun:
+      os.remove(files_from)
+    chunks_changed = False
+    if self._chunk_threshold is not None:
+      with self._phase('chunks'):
+        chunks_changed = yield from self._chunk_files(source, target, latest,
+                                                      new_backup, excludes,
+                                                      dirty_dirs, changes)
+    if writer is not None and changes is not None:
+      if state.changelog_lost:
+        writer.discard()
+      else:
+        writer.close()
+      self._changelog_writer = None
+      logging.info(f'Changes: {changes.summary()}.')
+    if tracker is not None and changes is not None:
+      new_metadata.rsync_stats = tracker.finish()
+      self._emit(
+          events.RsyncFinished(status=rsync_status,
+                               counts=dict(changes.counts),
+                               bytes=dict(changes.bytes),
+                               stats=new_metadata.rsync_stats))
 
     # Backup is done. Remaining steps are for cleaning up.
 
     # Check if there was no change.
     if not self._dryrun and self._only_if_changed and latest is not None:
-      no_change = utils.is_hardlinked_replica(os.path.join(latest, 'payload'),
-                                              new_backup_payload)
+      assert changes is not None
+      with self._phase('detect_changes'):
+        listed_all = rsync_status == 0 and resumed is None
+        if listed_all and self._snapshot_strategy != SNAPSHOT_LINK_DEST:
+          # No extra walk needed, rsync listed all changes.
+          no_change = not changes.has_changes()
+        else:
+          # With --link-dest, rsync also lists symlinks and special files it
+          # recreates, which may not be changes. After an error, the list may
+          # be incomplete, as it may be when resuming, e.g. if rsync listed
+          # changes that were not read before the stop.
+          same_payload = yield CallBlocking(
+              functools.partial(utils.is_hardlinked_replica,
+                                os.path.join(latest, 'payload'),
+                                new_backup_payload))
+          no_change = same_payload and not chunks_changed
       # If no_change, remove new backup and update old metadata.
       if no_change:
         logging.info('There was no change. Removing the new backup.')
-        yield from self._execute_sh(f'rm -r {new_backup}')
-        # Update the $metadata.
+        yield from self._execute_sh(['rm', '-r', new_backup])
         assert old_metadata is not None
-        old_metadata.updated_epoch = int(_now_epoch())
-        old_metadata.save_to(meta_fname)
+        yield from self._update_metadata(old_metadata, meta_fname)
         # Return early and do not remove older directories.
         return
 
-    final_directory = os.path.join(target, prefix + _now_str())
+    if new_metadata.rsync_stats is not None:
+      yield from self._store_metadata(new_metadata, new_backup)
+
+    if self._dedup_files and latest is not None:
+      with self._phase('dedup'):
+        yield from self._dedup(target, latest, new_backup)
+
+    entries: Optional[int] = None
+    if self._write_manifest:
+      with self._phase('manifest'):
+        entries = yield from self._create_manifest(new_backup)
+
+    if not self._dryrun:
+      os.remove(os.path.join(new_backup, resume.STATE_FNAME))
+    assert self._start_time is not None
+    final_directory = os.path.join(
+        target, prefix + self._start_time.strftime('%Y%m%d_%H%M%S'))
     yield f'[Rename {new_backup} to {final_directory}]'
     if not self._dryrun:
-      shutil.move(new_backup, final_directory)
+      with self._phase('rename'):
+        shutil.move(new_backup, final_directory)
+    if self._catalog is not None:
+      changed_bytes: Optional[int] = None
+      if changes is not None and not state.changelog_lost:
+        changed_bytes = changes.bytes[changelog.ADDED]
+        changed_bytes += changes.bytes[changelog.MODIFIED]
+      self._catalog.add(
+          catalog.Snapshot(name=os.path.basename(final_directory),
+                           metadata=new_metadata,
+                           entries=entries,
+                           changed_bytes=changed_bytes,
+                           seconds=time.monotonic() - start_time))
+    self._emit(events.SnapshotCreated(os.path.basename(final_directory)))
 
-    yield from self._delete_older_backups(folders, max_to_keep)
+    num_deleted = yield from self._delete_older_backups(target, folders,
+                                                        max_to_keep)
+    # Blocks only used by the deleted snapshots.
+    if num_deleted and self._chunk_threshold is not None:
+      yield from self._collect_garbage(target)
 
   def process(self, *args, **kwargs) -> None:
     # Just runs through the iterator.
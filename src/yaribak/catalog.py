@@ -0,0 +1,222 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Index of all snapshots in a backup path, with their metadata and stats.
+
+The catalog is a SQLite database in the backup path, updated in a transaction
+with every change. It is rebuilt from the snapshot directories if the names of
+those differ from the snapshots it lists when opened, i.e. if something else
+added or removed a snapshot. It is also rebuilt if it is missing or corrupt.
+
+Snapshots that could not be read when rebuilding are recorded as skipped, so
+that they do not cause a rebuild every time.
+"""
+
+import dataclasses
+import datetime
+import logging
+import os
+import sqlite3
+
+from typing import Iterator, List, Optional, Set
+
+from . import changelog
+from . import manifest
+from . import metadata
+
+# File name of the catalog, in the backup path.
+CATALOG_FNAME = '.catalog.sqlite3'
+
+SNAPSHOT_DIR_PREFIX = 'ysnap_'
+# Snapshot being created, which is not yet in the catalog.
+INCOMPLETE_DIR = SNAPSHOT_DIR_PREFIX + '_incomplete'
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS snapshots ('
+    'name TEXT PRIMARY KEY, metadata TEXT, entries INTEGER, '
+    'changed_bytes INTEGER, seconds REAL)',
+    'CREATE TABLE IF NOT EXISTS skipped (name TEXT PRIMARY KEY)',
+    # Used by older versions.
+    'DROP TABLE IF EXISTS state',
+]
+
+
+@dataclasses.dataclass
+class Snapshot:
+  # Directory name in the backup path.
+  name: str
+  metadata: metadata.Metadata
+  # Number of entries in the payload. None if not known.
+  entries: Optional[int] = None
+  # Size of files added or modified since the previous snapshot.
+  changed_bytes: Optional[int] = None
+  # Time taken to create the snapshot.
+  seconds: Optional[float] = None
+
+
+def snapshot_names(target: str) -> List[str]:
+  """Scans the backup path for complete snapshots."""
+  names = []
+  with os.scandir(target) as it:
+    for entry in it:
+      if not entry.name.startswith(SNAPSHOT_DIR_PREFIX):
+        continue
+      if entry.name != INCOMPLETE_DIR and entry.is_dir():
+        names.append(entry.name)
+  return sorted(names)
+
+
+def _changed_bytes(fname: str) -> Optional[int]:
+  if not os.path.exists(fname):
+    return None
+  return sum(change.size
+             for change in changelog.read(fname)
+             if change.kind in (changelog.ADDED, changelog.MODIFIED))
+
+
+def _entries(directory: str) -> Optional[int]:
+  fname = manifest.usable_manifest(directory)
+  if fname is None:
+    return None
+  with manifest.Manifest(fname) as listing:
+    return len(listing)
+
+
+def scan_snapshot(target: str, name: str) -> Snapshot:
+  """Reads a snapshot's metadata and stats from its directory."""
+  directory = os.path.join(target, name)
+  return Snapshot(
+      name=name,
+      metadata=metadata.Metadata.load_from(
+          os.path.join(directory, 'backup_context.json')),
+      entries=_entries(directory),
+      changed_bytes=_changed_bytes(
+          os.path.join(directory, changelog.CHANGELOG_FNAME)))
+
+
+class Catalog:
+
+  def __init__(self, target: str):
+    self._target = target
+    fname = os.path.join(target, CATALOG_FNAME)
+    try:
+      self._db = self._connect(fname)
+      stale = self._known_names() != set(snapshot_names(target))
+    except sqlite3.DatabaseError as e:
+      logging.warning(f'Recreating {fname}: {e}')
+      os.remove(fname)
+      self._db = self._connect(fname)
+      stale = True
+    if stale:
+      self.rebuild()
+
+  @staticmethod
+  def _connect(fname: str) -> sqlite3.Connection:
+    # Used by one thread at a time, though not always the same one, e.g. the
+    # steps of a backup may be closed off the driver's event loop.
+    db = sqlite3.connect(fname, check_same_thread=False)
+    # Keeps the journal file instead of creating and deleting it each time.
+    db.execute('PRAGMA journal_mode=TRUNCATE')
+    for statement in _SCHEMA:
+      db.execute(statement)
+    return db
+
+  def _known_names(self) -> Set[str]:
+    """Names of snapshots listed or skipped."""
+    rows = self._db.execute(
+        'SELECT name FROM snapshots UNION SELECT name FROM skipped')
+    return {name for name, in rows}
+
+  def _insert(self, snapshot: Snapshot) -> None:
+    self._db.execute(
+        'INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)',
+        (snapshot.name, snapshot.metadata.asjson(), snapshot.entries,
+         snapshot.changed_bytes, snapshot.seconds))
+
+  def rebuild(self) -> None:
+    logging.info(f'Rebuilding catalog of {self._target}.')
+    # Seconds taken are only known from the catalog.
+    seconds = dict(
+        self._db.execute('SELECT name, seconds FROM snapshots').fetchall())
+    self._db.execute('DELETE FROM snapshots')
+    self._db.execute('DELETE FROM skipped')
+    for name in snapshot_names(self._target):
+      try:
+        snapshot = scan_snapshot(self._target, name)
+      except (OSError, ValueError, TypeError) as e:
+        logging.warning(f'Skipping {name} in catalog: {e}')
+        self._db.execute('INSERT INTO skipped VALUES (?)', (name,))
+        continue
+      snapshot.seconds = seconds.get(name)
+      self._insert(snapshot)
+    self._db.commit()
+
+  def _rows(self, where: str = '', *args) -> Iterator[Snapshot]:
+    rows = self._db.execute(f'SELECT * FROM snapshots {where} ORDER BY name',
+                            args)
+    for name, metadata_json, entries, changed_bytes, seconds in rows:
+      yield Snapshot(name, metadata.Metadata.fromjson(metadata_json), entries,
+                     changed_bytes, seconds)
+
+  def snapshots(self) -> List[Snapshot]:
+    """All snapshots, oldest first."""
+    return list(self._rows())
+
+  def get(self, name: str) -> Optional[Snapshot]:
+    return next(self._rows('WHERE name=?', name), None)
+
+  def add(self, snapshot: Snapshot) -> None:
+    """Call after the snapshot directory is in place."""
+    self._insert(snapshot)
+    self._db.commit()
+
+  def update_metadata(self, name: str, data: metadata.Metadata) -> None:
+    self._db.execute('UPDATE snapshots SET metadata=? WHERE name=?',
+                     (data.asjson(), name))
+    self._db.commit()
+
+  def remove(self, name: str) -> None:
+    """Call after the snapshot directory is removed."""
+    self._db.execute('DELETE FROM snapshots WHERE name=?', (name,))
+    self._db.execute('DELETE FROM skipped WHERE name=?', (name,))
+    self._db.commit()
+
+  def close(self) -> None:
+    self._db.close()
+
+
+def _format_epoch(epoch: Optional[int]) -> str:
+  if epoch is None:
+    return '-'
+  return datetime.datetime.fromtimestamp(epoch).strftime('%Y-%m-%d %H:%M')
+
+
+def format_snapshots(snapshots: List[Snapshot]) -> str:
+  """Table of snapshots, one per line."""
+  lines = [
+      f'{"Snapshot":<22} {"Created":<16} {"Updated":<16} {"Entries":>10} '
+      f'{"Changed":>12} {"Time":>9}'
+  ]
+  for snapshot in snapshots:
+    entries = '-' if snapshot.entries is None else str(snapshot.entries)
+    changed = '-'
+    if snapshot.changed_bytes is not None:
+      changed = f'{snapshot.changed_bytes / 2**20:0.1f} MiB'
+    seconds = '-'
+    if snapshot.seconds is not None:
+      seconds = f'{snapshot.seconds:0.1f}s'
+    lines.append(f'{snapshot.name:<22} '
+                 f'{_format_epoch(snapshot.metadata.epoch):<16} '
+                 f'{_format_epoch(snapshot.metadata.updated_epoch):<16} '
+                 f'{entries:>10} {changed:>12} {seconds:>9}')
+  return '\n'.join(lines)
@@ -0,0 +1,201 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Parses rsync's itemized output into a changelog.
+
+With --out-format=RSYNC_OUT_FORMAT, rsync prints one line per changed item, as
+"<itemized flags>:<size>:<path>". See --itemize-changes in `man rsync` for the
+flags. By default, items whose content did not change (only attributes, or
+nothing) are not counted as changes, same as comparing the inodes of the
+snapshots.
+"""
+
+import collections
+import dataclasses
+import gzip
+import json
+import os
+import re
+import sys
+import zlib
+
+from typing import Callable, Dict, Iterator, Optional
+
+# File name of the changelog, in the snapshot directory.
+CHANGELOG_FNAME = 'changelog.jsonl.gz'
+
+# Pass as --out-format to rsync. Must not have spaces.
+RSYNC_OUT_FORMAT = '%i:%l:%n'
+
+ADDED = 'added'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+# Only attributes, e.g. permissions or times, changed.
+ATTRIBUTES = 'attributes'
+
+# E.g. ">f.st......:1234:dir/file" or "*deleting  :0:dir/file".
+_LINE_RE = re.compile(r'^(?P<item>[<>ch.*][^\s:]*)\s*:(?P<size>\d*):(?P<path>.+)$')
+
+
+@dataclasses.dataclass
+class Change:
+  kind: str
+  path: str
+  size: int
+
+
+def parse_line(line: str) -> Optional[Change]:
+  """Returns the change in one line of rsync output, if any."""
+  m = _LINE_RE.match(line)
+  if not m:
+    return None
+  item = m.group('item')
+  size = int(m.group('size') or 0)
+  path = m.group('path')
+  if item.startswith('*'):
+    # Currently the only message is "*deleting".
+    return Change(DELETED, path, size) if item == '*deleting' else None
+  if item[0] == '.':
+    if item[2:].strip('.') == '':
+      return None
+    return Change(ATTRIBUTES, path, size)
+  if item[0] == 'h' or item[2:].strip('+') == '':
+    # Hard link to another item, or all "+" for a new item.
+    return Change(ADDED, path, size)
+  return Change(MODIFIED, path, size)
+
+
+def _partial_fname(fname: str) -> str:
+  return fname + '.tmp'
+
+
+class ChangelogWriter:
+  """Streams changes to a gzipped JSON-lines file."""
+
+  def __init__(self, fname: str):
+    self._fname = fname
+    self._tmp_fname = _partial_fname(fname)
+    self._file = gzip.open(self._tmp_fname, 'wt')
+
+  def add(self, change: Change) -> None:
+    self._file.write(json.dumps(dataclasses.asdict(change)) + '\n')
+
+  def close(self) -> None:
+    self._file.close()
+    # Replacing also ensures this is not a hard link to an older changelog.
+    os.replace(self._tmp_fname, self._fname)
+
+  def suspend(self) -> None:
+    """Closes the partial changelog, e.g. if stopped, for a resumed backup."""
+    self._file.close()
+
+  def discard(self) -> None:
+    self._file.close()
+    os.remove(self._tmp_fname)
+
+
+def read(fname: str) -> Iterator[Change]:
+  with gzip.open(fname, 'rt') as f:
+    for line in f:
+      yield Change(**json.loads(line))
+
+
+def set_aside_partial(fname: str) -> Optional[str]:
+  """Moves aside the partial changelog of a stopped backup, if any.
+
+  Call before a ChangelogWriter for fname replaces it, and pass the path
+  returned to read_partial(). Remove it when done; until then, it is used again
+  if the backup is stopped again.
+  """
+  stopped_fname = fname + '.stopped'
+  if os.path.exists(stopped_fname):
+    # Stopped before it was read. The partial changelog has no more.
+    return stopped_fname
+  partial_fname = _partial_fname(fname)
+  if not os.path.exists(partial_fname):
+    return None
+  os.replace(partial_fname, stopped_fname)
+  return stopped_fname
+
+
+def read_partial(fname: str, on_change: Callable[[Change], None]) -> bool:
+  """Passes on the changes in a partial changelog.
+
+  Returns whether it was read to the end. It is cut short if the backup was
+  killed, with the changes buffered then lost.
+  """
+  if os.path.getsize(fname) == 0:
+    # Not even the header was written.
+    return False
+  changes = read(fname)
+  while True:
+    try:
+      change = next(changes)
+    except StopIteration:
+      return True
+    except (EOFError, OSError, ValueError, zlib.error):
+      return False
+    on_change(change)
+
+
+class RsyncOutputParser:
+  """Consumes lines of rsync output, and counts and logs the changes."""
+
+  def __init__(self,
+               writer: Optional[ChangelogWriter] = None,
+               echo: bool = False,
+               ignore_new_dirs: bool = False,
+               count_attributes: bool = False):
+    """Initializes the parser.
+
+    Args:
+      writer: If given, all changes are written to it.
+      echo: Print each line, e.g. if rsync was asked to be verbose.
+      ignore_new_dirs: Do not count created directories. Useful with
+        --link-dest, where all directories are created afresh.
+      count_attributes: Count attribute-only changes too.
+    """
+    self._writer = writer
+    self._echo = echo
+    self._ignore_new_dirs = ignore_new_dirs
+    self._count_attributes = count_attributes
+    self.counts: Dict[str, int] = collections.Counter()
+    self.bytes: Dict[str, int] = collections.Counter()
+
+  def __call__(self, line: str) -> None:
+    if self._echo:
+      print(line, file=sys.stdout)
+    change = parse_line(line)
+    if change is None:
+      return
+    if change.kind == ATTRIBUTES and not self._count_attributes:
+      return
+    is_new_dir = change.kind == ADDED and change.path.endswith('/')
+    if self._ignore_new_dirs and is_new_dir:
+      return
+    self.add(change)
+
+  def add(self, change: Change) -> None:
+    """Counts and writes a change, e.g. one not listed by rsync."""
+    self.counts[change.kind] += 1
+    self.bytes[change.kind] += change.size
+    if self._writer is not None:
+      self._writer.add(change)
+
+  def has_changes(self) -> bool:
+    return sum(self.counts.values()) > 0
+
+  def summary(self) -> str:
+    return ', '.join(f'{self.counts[kind]} {kind} '
+                     f'({self.bytes[kind] / 2**20:0.1f} MiB)'
+                     for kind in (ADDED, MODIFIED, DELETED))
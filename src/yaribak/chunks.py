@@ -0,0 +1,588 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stores large files as blocks shared by all snapshots.
+
+Hard links share a file across snapshots only while it is unchanged, so a
+large file that changes a little, e.g. a disk image or a database, would be
+copied in full into each snapshot. Instead, files over a size threshold are
+left out of the payload (rsync skips them with --max-size), and split into
+fixed size blocks. Blocks are kept once in a store under the backup path,
+named by their SHA-256, and only blocks not already there are written.
+
+Each snapshot has a map for each such file, under MAPS_DIR at the same path
+as in the payload, listing its blocks in order. A map has the owner, mode,
+xattrs and times of the file it stands for, so that files are quick checked
+and restored as in the payload. Maps of unchanged files are hard links to the
+previous snapshot's, like the payload's files.
+
+Blocks are at fixed offsets, which suits files that change in place. Blocks
+of zeros are not stored, and are restored as holes.
+
+Blocks no longer in any map are removed by collect_garbage(). Blocks written
+or reused recently are kept, since a running backup may not have written the
+map that lists them yet.
+"""
+
+import dataclasses
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import threading
+import time
+
+from typing import (Callable, Dict, Iterator, List, NamedTuple, Optional, Set,
+                    Tuple)
+
+from . import catalog
+from . import changelog
+from . import copier
+from . import exclusion
+from . import parallel_walk
+
+# The store of blocks, under the backup path.
+STORE_DIR = '.chunks'
+# Maps of the large files, in each snapshot directory next to the payload.
+MAPS_DIR = 'chunkmaps'
+
+CHUNK_SIZE = 1 << 20
+
+# Blocks modified more recently than this are not collected.
+GC_GRACE_SECS = 24 * 60 * 60
+
+# First line of a map is "<magic> <version> <file size> <chunk size>". Each
+# following line is the hex SHA-256 of a block, or _HOLE for zeros.
+_MAGIC = 'yaribak-chunkmap'
+_VERSION = '1'
+_HOLE = '-'
+
+# How a map compares with the file it is for.
+_SAME = 'same'
+_ATTRIBUTES = 'attributes'
+_DIFFERENT = 'different'
+
+
+class ChunkMap(NamedTuple):
+  size: int
+  chunk_size: int
+  # Hex digest of each block in order, or None for a block of zeros.
+  digests: List[Optional[str]]
+
+  def blocks(self) -> Iterator[Tuple[Optional[str], int]]:
+    """Pairs of (digest, length) of the blocks."""
+    for i, digest in enumerate(self.digests):
+      yield digest, min(self.chunk_size, self.size - i * self.chunk_size)
+
+
+@dataclasses.dataclass
+class ChunkStats:
+  # Large files whose blocks were stored, those with only new attributes, and
+  # those unchanged since the latest snapshot.
+  files: int = 0
+  attributes: int = 0
+  unchanged: int = 0
+  # Maps removed, since their file is gone, excluded or no longer large.
+  removed: int = 0
+  blocks_written: int = 0
+  blocks_reused: int = 0
+  bytes_read: int = 0
+  bytes_written: int = 0
+  seconds: float = 0.0
+
+  @property
+  def changed(self) -> bool:
+    return bool(self.files or self.attributes or self.removed)
+
+  def __str__(self) -> str:
+    return (f'stored {self.files} large files ({self.unchanged} unchanged, '
+            f'{self.removed} removed), read {self.bytes_read / 2**20:0.1f} '
+            f'MiB and wrote {self.blocks_written} new blocks '
+            f'({self.bytes_written / 2**20:0.1f} MiB), reused '
+            f'{self.blocks_reused}, in {self.seconds:0.2f}s')
+
+
+@dataclasses.dataclass
+class GcStats:
+  blocks: int = 0
+  bytes: int = 0
+  seconds: float = 0.0
+
+  def __str__(self) -> str:
+    return (f'removed {self.blocks} unused blocks '
+            f'({self.bytes / 2**20:0.1f} MiB) in {self.seconds:0.2f}s')
+
+
+def store_dir(target: str) -> str:
+  return os.path.join(target, STORE_DIR)
+
+
+def chunk_path(store: str, digest: str) -> str:
+  return os.path.join(store, digest[:2], digest)
+
+
+def _read_header(f) -> Tuple[int, int]:
+  fields = f.readline().split()
+  if len(fields) != 4 or fields[:2] != [_MAGIC, _VERSION]:
+    raise ValueError(f'{f.name} is not a chunk map')
+  return int(fields[2]), int(fields[3])
+
+
+def read_size(path: str) -> int:
+  """Size of the file that a map is for."""
+  with open(path) as f:
+    return _read_header(f)[0]
+
+
+def read_map(path: str) -> ChunkMap:
+  with open(path) as f:
+    size, chunk_size = _read_header(f)
+    digests: List[Optional[str]] = [
+        None if line == _HOLE else line for line in f.read().split()
+    ]
+  if len(digests) != -(-size // chunk_size):
+    raise ValueError(f'Chunk map {path} has {len(digests)} blocks for '
+                     f'{size} bytes')
+  return ChunkMap(size, chunk_size, digests)
+
+
+def _write_map(path: str, chunk_map: ChunkMap) -> None:
+  with open(path, 'x') as f:
+    f.write(f'{_MAGIC} {_VERSION} {chunk_map.size} {chunk_map.chunk_size}\n')
+    for digest in chunk_map.digests:
+      f.write(f'{digest or _HOLE}\n')
+
+
+def _read_block(f, size: int) -> bytes:
+  parts = []
+  while size:
+    data = f.read(size)
+    if not data:
+      break
+    parts.append(data)
+    size -= len(data)
+  return b''.join(parts)
+
+
+def _compare(map_path: str, st: os.stat_result) -> str:
+  """Quick check of a map against the lstat of its file, as rsync does."""
+  try:
+    map_st = os.lstat(map_path)
+    if not stat.S_ISREG(map_st.st_mode):
+      return _DIFFERENT
+    if map_st.st_mtime_ns != st.st_mtime_ns:
+      return _DIFFERENT
+    if read_size(map_path) != st.st_size:
+      return _DIFFERENT
+  except (FileNotFoundError, ValueError):
+    return _DIFFERENT
+  same_mode = map_st.st_mode == st.st_mode
+  # Owners can only be set as root.
+  same_owner = os.geteuid() != 0 or (map_st.st_uid, map_st.st_gid) == (
+      st.st_uid, st.st_gid)
+  return _SAME if same_mode and same_owner else _ATTRIBUTES
+
+
+def _tmp_path(path: str) -> str:
+  return f'{path}.{threading.get_ident()}.tmp'
+
+
+def _remove_copy(path: str) -> None:
+  """Removes what the payload has at the path of a large file, if anything."""
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path)
+  elif os.path.lexists(path):
+    os.remove(path)
+
+
+class _Store:
+  """Writes blocks to the store. Methods may be called from threads."""
+
+  def __init__(self, store: str, stats: ChunkStats, lock: threading.Lock):
+    self._store = store
+    self._stats = stats
+    self._lock = lock
+    # Blocks known to be in the store, and in use by a live snapshot.
+    self._known: Set[str] = set()
+
+  def know(self, digests: List[Optional[str]]) -> None:
+    with self._lock:
+      self._known.update(digest for digest in digests if digest is not None)
+
+  def _put(self, digest: str, block: bytes) -> None:
+    with self._lock:
+      known = digest in self._known
+    if not known:
+      path = chunk_path(self._store, digest)
+      try:
+        # Marks it as recently used, so that it is not collected meanwhile.
+        os.utime(path)
+      except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = _tmp_path(path)
+        with open(tmp_path, 'wb') as f:
+          f.write(block)
+        os.replace(tmp_path, path)
+        with self._lock:
+          self._stats.blocks_written += 1
+          self._stats.bytes_written += len(block)
+          self._known.add(digest)
+        return
+    with self._lock:
+      self._stats.blocks_reused += 1
+      self._known.add(digest)
+
+  def store_file(self, path: str, chunk_size: int) -> ChunkMap:
+    """Stores the blocks of a file, and returns its map."""
+    zeros = bytes(chunk_size)
+    digests: List[Optional[str]] = []
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
+      os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+      while True:
+        block = _read_block(f, chunk_size)
+        if not block:
+          break
+        size += len(block)
+        if block == zeros[:len(block)]:
+          digests.append(None)
+          continue
+        digest = hashlib.sha256(block).hexdigest()
+        self._put(digest, block)
+        digests.append(digest)
+    with self._lock:
+      self._stats.bytes_read += size
+    return ChunkMap(size, chunk_size, digests)
+
+
+_Item = Tuple[str, os.stat_result]
+
+
+def _large_files(source: str, threshold: int, excluder: exclusion.Excluder,
+                 dirty_dirs: Optional[List[str]], num_workers: int,
+                 initializer: Optional[Callable[[], None]]
+                 ) -> Dict[str, os.stat_result]:
+  """Regular files of at least threshold bytes, by path relative to source.
+
+  If dirty_dirs is given, only files directly in those are listed.
+  """
+  files: Dict[str, os.stat_result] = {}
+  lock = threading.Lock()
+
+  def scan(relpath: str, recursive: bool) -> List[str]:
+    subdirs = []
+    found = []
+    try:
+      with os.scandir(os.path.join(source, relpath)) as it:
+        for entry in it:
+          child = os.path.join(relpath, entry.name)
+          st = entry.stat(follow_symlinks=False)
+          is_dir = stat.S_ISDIR(st.st_mode)
+          if excluder.excludes(child, is_dir):
+            continue
+          if is_dir:
+            subdirs.append(child)
+          elif stat.S_ISREG(st.st_mode) and st.st_size >= threshold:
+            found.append((child, st))
+    except (FileNotFoundError, NotADirectoryError):
+      # Removed meanwhile. Rsync, which ran before, has removed it too.
+      return []
+    except PermissionError as e:
+      logging.warning(f'Not chunking files in {relpath or source}: {e}')
+      return []
+    with lock:
+      files.update(found)
+    return subdirs if recursive else []
+
+  if dirty_dirs is None:
+    parallel_walk.run([''],
+                      lambda relpath: scan(relpath, True),
+                      num_workers=num_workers,
+                      initializer=initializer)
+  else:
+    for directory in dirty_dirs:
+      scan(directory.strip('/'), False)
+  return files
+
+
+def _list_maps(maps: str, relpath: str = '') -> List[str]:
+  """Paths of all maps under maps/relpath, relative to maps."""
+  found = []
+  for dirpath, _, filenames in os.walk(os.path.join(maps, relpath)):
+    for name in filenames:
+      found.append(os.path.relpath(os.path.join(dirpath, name), maps))
+  return found
+
+
+def _stale_maps(source: str, maps: str, files: Dict[str, os.stat_result],
+                excluder: exclusion.Excluder,
+                dirty_dirs: Optional[List[str]]) -> List[str]:
+  """Maps that are not of a file in files, among those that were checked."""
+  if dirty_dirs is None:
+    return [relpath for relpath in _list_maps(maps) if relpath not in files]
+  stale = []
+  for directory in dirty_dirs:
+    directory = directory.strip('/')
+    try:
+      with os.scandir(os.path.join(maps, directory)) as it:
+        entries = list(it)
+    except (FileNotFoundError, NotADirectoryError):
+      continue
+    for entry in entries:
+      relpath = os.path.join(directory, entry.name)
+      if not entry.is_dir(follow_symlinks=False):
+        if relpath not in files:
+          stale.append(relpath)
+        continue
+      # Maps within a directory that is gone. Those within one that is still
+      # there are checked if it is dirty.
+      src = os.path.join(source, relpath)
+      is_dir = os.path.isdir(src) and not os.path.islink(src)
+      if not is_dir or excluder.excludes(relpath, True):
+        stale.extend(_list_maps(maps, relpath))
+  return stale
+
+
+def _remove_maps(maps: str, relpaths: List[str]) -> None:
+  """Removes maps, and the directories they leave empty."""
+  for relpath in relpaths:
+    os.remove(os.path.join(maps, relpath))
+    parent = os.path.dirname(relpath)
+    while parent:
+      try:
+        os.rmdir(os.path.join(maps, parent))
+      except OSError:
+        break
+      parent = os.path.dirname(parent)
+
+
+def has_changes(source: str,
+                maps: str,
+                threshold: int,
+                excludes: List[str],
+                num_workers: int = parallel_walk.DEFAULT_WORKERS,
+                initializer: Optional[Callable[[], None]] = None) -> bool:
+  """Whether chunk_tree() would change maps, without writing anything."""
+  excluder = exclusion.Excluder(excludes)
+  files = _large_files(source, threshold, excluder, None, num_workers,
+                       initializer)
+  for relpath, st in files.items():
+    if _compare(os.path.join(maps, relpath), st) != _SAME:
+      return True
+  return bool(_stale_maps(source, maps, files, excluder, None))
+
+
+def chunk_tree(
+    source: str,
+    payload: str,
+    maps: str,
+    base_maps: Optional[str],
+    store: str,
+    threshold: int,
+    excludes: List[str],
+    dirty_dirs: Optional[List[str]] = None,
+    num_workers: int = parallel_walk.DEFAULT_WORKERS,
+    initializer: Optional[Callable[[], None]] = None,
+    on_change: Optional[Callable[[changelog.Change], None]] = None,
+    chunk_size: int = CHUNK_SIZE
+) -> ChunkStats:
+  """Stores the files in source of at least threshold bytes, and maps them.
+
+  Maps are written in maps, and any copy of these files in payload is removed.
+  Maps of other files are removed. base_maps are those of the latest snapshot,
+  if any, which files unchanged since are hard linked to. If dirty_dirs is
+  given, only the files directly in those directories are checked, as rsync
+  does with them.
+
+  If given, initializer() is called at the start of each worker thread, and
+  on_change() with each change. Both may be called from several threads at
+  once.
+  """
+  start = time.monotonic()
+  stats = ChunkStats()
+  lock = threading.Lock()
+  excluder = exclusion.Excluder(excludes)
+  files = _large_files(source, threshold, excluder, dirty_dirs, num_workers,
+                       initializer)
+
+  stale = _stale_maps(source, maps, files, excluder, dirty_dirs)
+  _remove_maps(maps, stale)
+  stats.removed = len(stale)
+  if on_change is not None:
+    for relpath in stale:
+      on_change(changelog.Change(changelog.DELETED, relpath, 0))
+
+  blocks = _Store(store, stats, lock)
+  os.makedirs(store, mode=0o700, exist_ok=True)
+
+  def replace_map(map_path: str, write: Callable[[str], None]) -> None:
+    tmp_path = _tmp_path(map_path)
+    write(tmp_path)
+    os.replace(tmp_path, map_path)
+
+  def changed(kind: str, relpath: str, size: int) -> None:
+    if on_change is not None:
+      on_change(changelog.Change(kind, relpath, size))
+
+  def process(relpath: str, st: os.stat_result) -> None:
+    src = os.path.join(source, relpath)
+    map_path = os.path.join(maps, relpath)
+    base_map = None if base_maps is None else os.path.join(base_maps, relpath)
+    _remove_copy(os.path.join(payload, relpath))
+    os.makedirs(os.path.dirname(map_path), exist_ok=True)
+
+    if _compare(map_path, st) == _SAME:
+      with lock:
+        stats.unchanged += 1
+      return
+    base_comparison = _DIFFERENT
+    if base_map is not None:
+      base_comparison = _compare(base_map, st)
+    if base_comparison == _SAME:
+      assert base_map is not None
+      replace_map(map_path, lambda tmp_path: os.link(base_map, tmp_path))
+      with lock:
+        stats.unchanged += 1
+      return
+    if base_comparison == _ATTRIBUTES:
+      assert base_map is not None
+
+      def copy_map(tmp_path: str) -> None:
+        shutil.copyfile(base_map, tmp_path)
+        copier.set_metadata(tmp_path, copier.Attrs.of(src, st))
+
+      replace_map(map_path, copy_map)
+      with lock:
+        stats.attributes += 1
+      changed(changelog.ATTRIBUTES, relpath, st.st_size)
+      return
+
+    in_base = base_map is not None and os.path.exists(base_map)
+    existed = in_base or os.path.exists(map_path)
+    if in_base:
+      assert base_map is not None
+      try:
+        blocks.know(read_map(base_map).digests)
+      except ValueError as e:
+        logging.warning(f'Ignoring {e}')
+    chunk_map = blocks.store_file(src, chunk_size)
+
+    def write_map(tmp_path: str) -> None:
+      _write_map(tmp_path, chunk_map)
+      copier.set_metadata(tmp_path, copier.Attrs.of(src, st))
+
+    replace_map(map_path, write_map)
+    with lock:
+      stats.files += 1
+    changed(changelog.MODIFIED if existed else changelog.ADDED, relpath,
+            chunk_map.size)
+
+  def visit(item: _Item) -> List[_Item]:
+    relpath, st = item
+    try:
+      process(relpath, st)
+    except (FileNotFoundError, PermissionError) as e:
+      # Removed while chunking, or unreadable. Like rsync, the rest of the
+      # backup goes on.
+      logging.warning(f'Not chunking {relpath}: {e}')
+    return []
+
+  # Largest first, so that the workers are not left waiting on one file.
+  items = sorted(files.items(), key=lambda item: item[1].st_size, reverse=True)
+  parallel_walk.run(items,
+                    visit,
+                    num_workers=num_workers,
+                    initializer=initializer)
+  stats.seconds = time.monotonic() - start
+  return stats
+
+
+def restore_file(map_path: str, store: str, dst: str) -> int:
+  """Writes the file of a map to dst, which must not exist.
+
+  Returns the bytes written, which excludes holes.
+  """
+  chunk_map = read_map(map_path)
+  written = 0
+  fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+  try:
+    for digest, length in chunk_map.blocks():
+      if digest is None:
+        os.lseek(fd_out, length, os.SEEK_CUR)
+        continue
+      fd_in = os.open(chunk_path(store, digest), os.O_RDONLY)
+      try:
+        copied = copier.copy_contents(fd_in, fd_out, length)
+      finally:
+        os.close(fd_in)
+      if copied != length:
+        raise ValueError(f'Block {digest} of {map_path} is truncated')
+      written += length
+    # Extends the file over a trailing hole.
+    os.ftruncate(fd_out, chunk_map.size)
+  finally:
+    os.close(fd_out)
+  return written
+
+
+def map_inodes(directories: List[str]) -> Dict[Tuple[int, int], str]:
+  """All maps in the given snapshot directories, one path per inode."""
+  found: Dict[Tuple[int, int], str] = {}
+  for directory in directories:
+    maps = os.path.join(directory, MAPS_DIR)
+    for relpath in _list_maps(maps):
+      path = os.path.join(maps, relpath)
+      st = os.lstat(path)
+      found.setdefault((st.st_dev, st.st_ino), path)
+  return found
+
+
+def collect_garbage(target: str,
+                    grace_secs: float = GC_GRACE_SECS) -> GcStats:
+  """Removes blocks that no snapshot in target uses."""
+  start = time.monotonic()
+  stats = GcStats()
+  store = store_dir(target)
+  if not os.path.isdir(store):
+    return stats
+  # Including the snapshot being created, if any.
+  names = catalog.snapshot_names(target) + [catalog.INCOMPLETE_DIR]
+  used: Set[str] = set()
+  directories = [os.path.join(target, name) for name in names]
+  for path in map_inodes(directories).values():
+    try:
+      used.update(digest for digest in read_map(path).digests
+                  if digest is not None)
+    except ValueError as e:
+      # Unsafe to remove anything it may list.
+      raise ValueError(f'Not collecting garbage: {e}') from e
+  cutoff_ns = int((time.time() - grace_secs) * 1e9)
+  with os.scandir(store) as fanout:
+    subdirs = [entry.path for entry in fanout if entry.is_dir()]
+  for subdir in subdirs:
+    with os.scandir(subdir) as it:
+      for entry in it:
+        if entry.name in used:
+          continue
+        try:
+          st = entry.stat(follow_symlinks=False)
+          if st.st_mtime_ns >= cutoff_ns:
+            continue
+          os.remove(entry.path)
+        except FileNotFoundError:
+          continue
+        stats.blocks += 1
+        stats.bytes += st.st_blocks * 512
+  stats.seconds = time.monotonic() - start
+  return stats
@@ -0,0 +1,104 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""In-process equivalent of `cp -al`.
+
+Directories are recreated, and everything else (regular files, symlinks,
+fifos, sockets and devices) is hard linked. Hard links share the inode, so
+their owner, mode, xattrs and ACLs come along for free. Directories get their
+owner, mode, xattrs (which hold ACLs) and times copied after all entries are
+created, since creating entries updates the directory's mtime.
+"""
+
+import concurrent.futures
+import dataclasses
+import os
+import threading
+import time
+
+from typing import Callable, List, Optional
+
+from . import copier
+from . import parallel_walk
+
+
+@dataclasses.dataclass
+class CloneStats:
+  directories: int = 0
+  links: int = 0
+  seconds: float = 0.0
+
+  @property
+  def entries(self) -> int:
+    return self.directories + self.links
+
+  @property
+  def entries_per_sec(self) -> float:
+    if self.seconds <= 0:
+      return 0.0
+    return self.entries / self.seconds
+
+
+def clone_tree(source: str,
+               dest: str,
+               num_workers: int = parallel_walk.DEFAULT_WORKERS,
+               initializer: Optional[Callable[[], None]] = None) -> CloneStats:
+  """Recreates source at dest, hard linking all non-directories.
+
+  The dest must not exist. If given, initializer() is called at the start of
+  each worker thread.
+  """
+  start = time.monotonic()
+  stats = CloneStats()
+  stats_lock = threading.Lock()
+  # Relative paths of all directories created, for the metadata pass.
+  directories: List[str] = ['']
+  os.mkdir(dest)
+
+  def visit(relpath: str) -> List[str]:
+    subdirs: List[str] = []
+    links = 0
+    with os.scandir(os.path.join(source, relpath)) as it:
+      for entry in it:
+        child = os.path.join(relpath, entry.name)
+        target = os.path.join(dest, child)
+        if entry.is_dir(follow_symlinks=False):
+          os.mkdir(target)
+          subdirs.append(child)
+        else:
+          os.link(entry.path, target, follow_symlinks=False)
+          links += 1
+    with stats_lock:
+      stats.directories += len(subdirs)
+      stats.links += links
+      directories.extend(subdirs)
+    return subdirs
+
+  parallel_walk.run([''],
+                    visit,
+                    num_workers=num_workers,
+                    initializer=initializer)
+
+  def fix_metadata(relpath: str) -> None:
+    copier.copy_metadata(os.path.join(source, relpath),
+                         os.path.join(dest, relpath))
+
+  executor = concurrent.futures.ThreadPoolExecutor(num_workers,
+                                                   initializer=initializer)
+  with executor:
+    # Consume the results to surface any exception.
+    for _ in executor.map(fix_metadata, directories):
+      pass
+
+  stats.seconds = time.monotonic() - start
+  return stats
@@ -0,0 +1,159 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Copies files and their metadata, with the data staying in the kernel.
+
+Contents are copied with copy_file_range(), which on some filesystems (e.g.
+btrfs, xfs, NFS) shares or copies extents without reading them. Where it is
+not supported, e.g. across filesystems on older kernels, sendfile() is used,
+and then plain reads and writes. Only the data of files is copied, as found
+with SEEK_DATA and SEEK_HOLE, so holes of sparse files stay holes.
+"""
+
+import errno
+import os
+import stat
+
+from typing import Dict, NamedTuple, Optional
+
+from . import utils
+
+# Bytes requested per call.
+_CHUNK_SIZE = 1 << 30
+_BUFFER_SIZE = 1 << 20
+
+# Errors meaning the call is not supported for these files.
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF
+}
+
+
+def _copy_with(copy_fn, fd_in: int, fd_out: int,
+               count: Optional[int]) -> Optional[int]:
+  """Copies count bytes, or until end of file if None.
+
+  Returns None if unsupported before copying anything.
+  """
+  copied = 0
+  while count is None or copied < count:
+    size = _CHUNK_SIZE if count is None else min(_CHUNK_SIZE, count - copied)
+    try:
+      num_bytes = copy_fn(fd_in, fd_out, size)
+    except OSError as e:
+      if copied == 0 and e.errno in _UNSUPPORTED_ERRNOS:
+        return None
+      raise
+    if num_bytes == 0:
+      break
+    copied += num_bytes
+  return copied
+
+
+def copy_contents(fd_in: int, fd_out: int, count: Optional[int] = None) -> int:
+  """Copies from the current offsets, count bytes or to end of file.
+
+  Returns the bytes copied.
+  """
+  if hasattr(os, 'copy_file_range'):
+    copied = _copy_with(os.copy_file_range, fd_in, fd_out, count)
+    if copied is not None:
+      return copied
+  copied = _copy_with(
+      lambda fd_in, fd_out, size: os.sendfile(fd_out, fd_in, None, size),
+      fd_in, fd_out, count)
+  if copied is not None:
+    return copied
+  copied = 0
+  while count is None or copied < count:
+    size = _BUFFER_SIZE if count is None else min(_BUFFER_SIZE, count - copied)
+    data = os.read(fd_in, size)
+    if not data:
+      break
+    os.write(fd_out, data)
+    copied += len(data)
+  return copied
+
+
+def copy_sparse(fd_in: int, fd_out: int) -> int:
+  """Copies all data of fd_in to the empty fd_out, leaving holes as holes.
+
+  Returns the bytes of data copied, which excludes the holes.
+  """
+  size = os.fstat(fd_in).st_size
+  if not hasattr(os, 'SEEK_DATA'):
+    return copy_contents(fd_in, fd_out)
+  copied = 0
+  offset = 0
+  while offset < size:
+    try:
+      start = os.lseek(fd_in, offset, os.SEEK_DATA)
+    except OSError as e:
+      if e.errno != errno.ENXIO:
+        raise
+      # Only a hole is left.
+      break
+    end = os.lseek(fd_in, start, os.SEEK_HOLE)
+    os.lseek(fd_in, start, os.SEEK_SET)
+    os.lseek(fd_out, start, os.SEEK_SET)
+    copied += copy_contents(fd_in, fd_out, end - start)
+    offset = end
+  # Extends fd_out over a trailing hole.
+  os.ftruncate(fd_out, size)
+  return copied
+
+
+def copy_file(src: str, dst: str) -> int:
+  """Copies contents of src into a new file dst. Returns bytes copied."""
+  with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+    return copy_sparse(fsrc.fileno(), fdst.fileno())
+
+
+class Attrs(NamedTuple):
+  """Metadata of a file, other than its contents."""
+  mode: int
+  uid: int
+  gid: int
+  atime_ns: int
+  mtime_ns: int
+  # Includes POSIX ACLs, in `system.posix_acl_*`.
+  xattrs: Dict[str, bytes]
+
+  @staticmethod
+  def of(path: str, st: Optional[os.stat_result] = None) -> 'Attrs':
+    """Attributes of path, with st from lstat() if already known."""
+    if st is None:
+      st = os.lstat(path)
+    return Attrs(st.st_mode, st.st_uid, st.st_gid, st.st_atime_ns,
+                 st.st_mtime_ns, utils.get_xattrs(path))
+
+
+def set_metadata(dst: str, attrs: Attrs) -> None:
+  """Sets owner, mode, xattrs and times of dst, without following links.
+
+  This is the order `cp -a` uses. Changing the owner may clear setuid bits,
+  and ACLs in the xattrs refine the mode.
+  """
+  try:
+    os.chown(dst, attrs.uid, attrs.gid, follow_symlinks=False)
+  except PermissionError:
+    # Same as `cp -a` when not running as root.
+    pass
+  if not stat.S_ISLNK(attrs.mode):
+    os.chmod(dst, stat.S_IMODE(attrs.mode))
+  utils.set_xattrs(dst, attrs.xattrs)
+  os.utime(dst, ns=(attrs.atime_ns, attrs.mtime_ns), follow_symlinks=False)
+
+
+def copy_metadata(src: str, dst: str) -> None:
+  """Copies owner, mode, xattrs and times of src to dst."""
+  set_metadata(dst, Attrs.of(src))
@@ -0,0 +1,239 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Replaces new files in a snapshot with hard links to identical older files.
+
+Unchanged files are already hard links to the previous snapshot, but a file
+that was renamed or moved is copied afresh. This finds such copies -
+1. New files are those rsync added or modified, as listed in the changelog,
+   that are not yet hard linked to anything.
+2. Only files in the previous snapshot of the same size as a new file can be
+   identical, so only those are hashed. Hashes are cached by inode.
+3. A new file is replaced with a hard link to a file with the same hash, if
+   the two also have the same owner, mode, mtime and xattrs (which would
+   otherwise change when linked), and the same bytes.
+
+Each link is made in a directory next to the payload, and renamed over the
+file it replaces. A backup that is stopped meanwhile may leave that directory,
+which is removed when dedup runs again.
+"""
+
+import concurrent.futures
+import dataclasses
+import itertools
+import os
+import shutil
+import stat
+import threading
+import time
+
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from . import changelog
+from . import hash_cache
+from . import manifest
+from . import parallel_walk
+from . import utils
+
+# Smaller files are not worth the overhead.
+DEFAULT_MIN_SIZE = 64 * 1024
+
+_COMPARE_BUFFER_SIZE = 1 << 20
+
+# Next to the payload, for links that replace files in it.
+_TMP_DIRNAME = 'dedup_tmp'
+
+
+@dataclasses.dataclass
+class DedupStats:
+  candidates: int = 0
+  linked: int = 0
+  bytes_reclaimed: int = 0
+  bytes_hashed: int = 0
+  seconds_hashing: float = 0.0
+  seconds: float = 0.0
+
+  def __str__(self) -> str:
+    hash_rate = 0.0
+    if self.seconds_hashing > 0:
+      hash_rate = self.bytes_hashed / 2**20 / self.seconds_hashing
+    return (f'linked {self.linked} of {self.candidates} new files, '
+            f'reclaiming {self.bytes_reclaimed / 2**20:0.1f} MiB; hashed '
+            f'{self.bytes_hashed / 2**20:0.1f} MiB at {hash_rate:0.0f} MiB/s '
+            f'per thread; took {self.seconds:0.2f}s')
+
+
+def _walk_files(payload: str) -> Iterator[Tuple[str, os.stat_result]]:
+  for dirpath, _, filenames in os.walk(payload):
+    for name in filenames:
+      path = os.path.join(dirpath, name)
+      yield os.path.relpath(path, payload), os.lstat(path)
+
+
+def _new_files(payload: str,
+               changelog_fname: Optional[str]) -> Iterator[Tuple[str, int]]:
+  """Relative paths and sizes of files which are not hard linked."""
+  if changelog_fname is not None and os.path.exists(changelog_fname):
+    for change in changelog.read(changelog_fname):
+      if change.kind not in (changelog.ADDED, changelog.MODIFIED):
+        continue
+      relpath = change.path
+      if relpath.endswith('/'):
+        continue
+      try:
+        st = os.lstat(os.path.join(payload, relpath))
+      except FileNotFoundError:
+        continue
+      if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+        yield relpath, st.st_size
+  else:
+    for relpath, st in _walk_files(payload):
+      if stat.S_ISREG(st.st_mode) and st.st_nlink == 1:
+        yield relpath, st.st_size
+
+
+def _files_with_sizes(payload: str, sizes: Set[int],
+                      manifest_fname: Optional[str]) -> Dict[int, List[str]]:
+  """Relative paths of regular files in payload with one of the sizes."""
+  by_size: Dict[int, List[str]] = {}
+  if manifest_fname is not None and os.path.exists(manifest_fname):
+    with manifest.Manifest(manifest_fname) as listing:
+      for entry in listing:
+        if stat.S_ISREG(entry.mode) and entry.size in sizes:
+          by_size.setdefault(entry.size, []).append(entry.path)
+  else:
+    for relpath, st in _walk_files(payload):
+      if stat.S_ISREG(st.st_mode) and st.st_size in sizes:
+        by_size.setdefault(st.st_size, []).append(relpath)
+  return by_size
+
+
+def _same_attributes(path1: str, st1: os.stat_result, path2: str,
+                     st2: os.stat_result) -> bool:
+  if st1.st_mode != st2.st_mode or st1.st_mtime_ns != st2.st_mtime_ns:
+    return False
+  if st1.st_uid != st2.st_uid or st1.st_gid != st2.st_gid:
+    return False
+  return utils.get_xattrs(path1) == utils.get_xattrs(path2)
+
+
+def _same_content(path1: str, path2: str) -> bool:
+  """Compares bytes, in case a cached hash is stale (e.g. reused inode)."""
+  with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+    while True:
+      b1 = f1.read(_COMPARE_BUFFER_SIZE)
+      b2 = f2.read(_COMPARE_BUFFER_SIZE)
+      if b1 != b2:
+        return False
+      if not b1:
+        return True
+
+
+def _link(existing: str, path: str, tmp: str) -> None:
+  """Atomically replaces path with a hard link to existing, made at tmp."""
+  os.link(existing, tmp)
+  os.replace(tmp, path)
+
+
+def remove_leftovers(payload: str) -> None:
+  """Removes links left by a dedup of payload that was stopped."""
+  tmp_dir = os.path.join(os.path.dirname(payload), _TMP_DIRNAME)
+  if os.path.isdir(tmp_dir):
+    shutil.rmtree(tmp_dir)
+
+
+def dedup(payload: str,
+          previous_payload: str,
+          cache: hash_cache.HashCache,
+          changelog_fname: Optional[str] = None,
+          manifest_fname: Optional[str] = None,
+          min_size: int = DEFAULT_MIN_SIZE,
+          num_workers: int = parallel_walk.DEFAULT_WORKERS,
+          initializer: Optional[Callable[[], None]] = None) -> DedupStats:
+  """Links new files in payload to identical files in either payload.
+
+  If given, changelog_fname lists changes in payload, and manifest_fname lists
+  previous_payload, to avoid walking them. If given, initializer() is called at
+  the start of each worker thread, e.g. to lower its priority.
+  """
+  start = time.monotonic()
+  hashed_before = cache.bytes_hashed
+  seconds_hashing_before = cache.seconds_hashing
+  stats = DedupStats()
+  stats_lock = threading.Lock()
+  remove_leftovers(payload)
+  tmp_dir = os.path.join(os.path.dirname(payload), _TMP_DIRNAME)
+  # Short names, since those in the payload may be near the limit.
+  tmp_names = itertools.count()
+
+  new_by_size: Dict[int, List[str]] = {}
+  for relpath, size in _new_files(payload, changelog_fname):
+    if size >= min_size:
+      new_by_size.setdefault(size, []).append(relpath)
+      stats.candidates += 1
+  old_by_size = _files_with_sizes(previous_payload, set(new_by_size),
+                                  manifest_fname)
+
+  def process_size(size: int) -> None:
+    if len(new_by_size[size]) + len(old_by_size.get(size, [])) < 2:
+      # Nothing to compare with, so no need to hash.
+      return
+    # Digest to existing files with that content.
+    by_digest: Dict[bytes, List[Tuple[str, os.stat_result]]] = {}
+    for relpath in old_by_size.get(size, []):
+      path = os.path.join(previous_payload, relpath)
+      try:
+        st = os.lstat(path)
+      except FileNotFoundError:
+        continue
+      by_digest.setdefault(cache.digest(path, st), []).append((path, st))
+    linked = 0
+    for relpath in new_by_size[size]:
+      path = os.path.join(payload, relpath)
+      st = os.lstat(path)
+      digest = cache.digest(path, st)
+      existing = by_digest.setdefault(digest, [])
+      match: Optional[str] = None
+      for other, other_st in existing:
+        if not _same_attributes(path, st, other, other_st):
+          continue
+        if _same_content(path, other):
+          match = other
+          break
+      if match is None:
+        # Later new files may be identical to this.
+        existing.append((path, st))
+        continue
+      with stats_lock:
+        tmp = os.path.join(tmp_dir, str(next(tmp_names)))
+      _link(match, path, tmp)
+      linked += 1
+    with stats_lock:
+      stats.linked += linked
+      stats.bytes_reclaimed += linked * size
+
+  os.mkdir(tmp_dir)
+  try:
+    with concurrent.futures.ThreadPoolExecutor(num_workers,
+                                               initializer=initializer) as ex:
+      # Consume the results to surface any exception.
+      for _ in ex.map(process_size, sorted(new_by_size)):
+        pass
+  finally:
+    remove_leftovers(payload)
+  cache.commit()
+
+  stats.bytes_hashed = cache.bytes_hashed - hashed_before
+  stats.seconds_hashing = cache.seconds_hashing - seconds_hashing_before
+  stats.seconds = time.monotonic() - start
+  return stats
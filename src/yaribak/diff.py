@@ -0,0 +1,181 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Lists differences between two snapshots, without reading file contents.
+
+Both snapshots are listed in the same sorted order (see manifest.path_key()),
+and merged in a single pass. Each snapshot is listed from its manifest if it
+has one, from its archive if archived, or else walked. Entries that are the
+same inode are identical, and others are compared by type, size and mtime as
+in rsync's quick check. Directories are only reported when added or removed,
+since their mtime changes whenever their contents do.
+"""
+
+import collections
+import dataclasses
+import os
+import stat
+
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple
+
+from . import archive
+from . import catalog
+from . import changelog
+from . import manifest
+from . import usage
+
+
+class Record(NamedTuple):
+  key: bytes
+  # None if not known, e.g. for files stored in an archive.
+  inode: Optional[int]
+  size: int
+  mtime_ns: int
+  mode: int
+
+
+@dataclasses.dataclass
+class Difference:
+  # One of changelog.ADDED, MODIFIED or DELETED.
+  kind: str
+  # Directories end with '/', as in the changelog.
+  path: str
+  old_size: int
+  new_size: int
+
+  @property
+  def delta(self) -> int:
+    return self.new_size - self.old_size
+
+
+def _walk(payload: str) -> Iterator[Record]:
+  for key, entry in manifest.walk_sorted(payload):
+    st = entry.stat(follow_symlinks=False)
+    yield Record(key, st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+
+
+def _from_manifest(fname: str) -> Iterator[Record]:
+  with manifest.Manifest(fname) as listing:
+    for entry in listing:
+      yield Record(manifest.path_key(entry.path), entry.inode, entry.size,
+                   entry.mtime_ns, entry.mode)
+
+
+def _from_archive(fname: str, refs_dir: str) -> Iterator[Record]:
+  with archive.Archive(fname, refs_dir) as reader:
+    for entry in reader:
+      inode: Optional[int] = None
+      if entry.kind == archive.REFERENCE:
+        inode = os.lstat(reader.ref_path(entry)).st_ino
+      yield Record(manifest.path_key(entry.path), inode, entry.size,
+                   entry.mtime_ns, entry.mode)
+
+
+def records(target: str, snapshot: catalog.Snapshot) -> Iterator[Record]:
+  """Entries of the snapshot's payload, sorted by key."""
+  directory = os.path.join(target, snapshot.name)
+  if snapshot.metadata.archive is not None:
+    return _from_archive(os.path.join(directory, snapshot.metadata.archive),
+                         os.path.join(directory, archive.REFS_DIR))
+  fname = manifest.usable_manifest(directory)
+  if fname is not None:
+    return _from_manifest(fname)
+  return _walk(os.path.join(directory, 'payload'))
+
+
+def _path(record: Record) -> str:
+  path = os.fsdecode(record.key.replace(b'\0', b'/'))
+  if stat.S_ISDIR(record.mode):
+    path += '/'
+  return path
+
+
+def _same(old: Record, new: Record) -> bool:
+  if old.inode is not None and old.inode == new.inode:
+    return True
+  if stat.S_IFMT(old.mode) != stat.S_IFMT(new.mode):
+    return False
+  if stat.S_ISDIR(old.mode):
+    return True
+  return old.size == new.size and old.mtime_ns == new.mtime_ns
+
+
+def _aligned(old: Iterator[Record], new: Iterator[Record]
+             ) -> Iterator[Tuple[Optional[Record], Optional[Record]]]:
+  """Merges two sorted listings into pairs of entries with the same key.
+
+  One of each pair is None if the key is only in the other listing.
+  """
+  old_record = next(old, None)
+  new_record = next(new, None)
+  while old_record is not None and new_record is not None:
+    if old_record.key < new_record.key:
+      yield old_record, None
+      old_record = next(old, None)
+    elif new_record.key < old_record.key:
+      yield None, new_record
+      new_record = next(new, None)
+    else:
+      yield old_record, new_record
+      old_record = next(old, None)
+      new_record = next(new, None)
+  while old_record is not None:
+    yield old_record, None
+    old_record = next(old, None)
+  while new_record is not None:
+    yield None, new_record
+    new_record = next(new, None)
+
+
+def diff(old: Iterator[Record],
+         new: Iterator[Record]) -> Iterator[Difference]:
+  """Yields the differences between two sorted listings, in order."""
+  for old_record, new_record in _aligned(old, new):
+    if new_record is None:
+      assert old_record is not None
+      yield Difference(changelog.DELETED, _path(old_record), old_record.size, 0)
+    elif old_record is None:
+      yield Difference(changelog.ADDED, _path(new_record), 0, new_record.size)
+    elif not _same(old_record, new_record):
+      yield Difference(changelog.MODIFIED, _path(new_record), old_record.size,
+                       new_record.size)
+
+
+class DiffSummary:
+  """Counts differences as they stream by."""
+
+  def __init__(self):
+    self.counts: Dict[str, int] = collections.Counter()
+    self.deltas: Dict[str, int] = collections.Counter()
+
+  def add(self, difference: Difference) -> None:
+    self.counts[difference.kind] += 1
+    self.deltas[difference.kind] += difference.delta
+
+  def __str__(self) -> str:
+    parts = [
+        f'{self.counts[kind]} {kind} ({format_delta(self.deltas[kind])})'
+        for kind in (changelog.ADDED, changelog.MODIFIED, changelog.DELETED)
+    ]
+    net = sum(self.deltas.values())
+    return ', '.join(parts) + f'; net {format_delta(net)}'
+
+
+def format_delta(num_bytes: int) -> str:
+  sign = '-' if num_bytes < 0 else '+'
+  return sign + usage.format_bytes(abs(num_bytes))
+
+
+def format_difference(difference: Difference) -> str:
+  return (f'{difference.kind:<8} {format_delta(difference.delta):>12}  '
+          f'{difference.path}')
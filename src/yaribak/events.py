@@ -0,0 +1,103 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Events reported as a backup progresses, e.g. by async_backup.backup()."""
+
+import dataclasses
+
+from typing import Dict, Optional, Union
+
+
+@dataclasses.dataclass
+class PhaseStarted:
+  # As named in profiles, e.g. "clone", "rsync" or "delete".
+  phase: str
+  # E.g. the snapshot being deleted.
+  detail: str = ''
+
+
+@dataclasses.dataclass
+class PhaseFinished:
+  phase: str
+  detail: str
+  seconds: float
+
+
+@dataclasses.dataclass
+class StepDone:
+  # As logged, e.g. the command that was run.
+  description: str
+
+
+@dataclasses.dataclass
+class RsyncProgress:
+  """The overall progress of rsync, as of its latest progress line.
+
+  With several shards, this is the progress of whichever printed last.
+  """
+  bytes_transferred: int
+  percent: float
+  bytes_per_sec: float
+  elapsed_secs: float
+  eta_secs: Optional[float] = None
+  files_transferred: Optional[int] = None
+  files_checked: Optional[int] = None
+  files_total: Optional[int] = None
+
+  @classmethod
+  def from_metrics(cls, metrics: Dict[str, float]) -> 'RsyncProgress':
+    """From metrics of progress.ProgressTracker."""
+
+    def count(key: str) -> Optional[int]:
+      return int(metrics[key]) if key in metrics else None
+
+    return cls(bytes_transferred=int(metrics['bytes_transferred']),
+               percent=metrics['percent'],
+               bytes_per_sec=metrics['bytes_per_sec'],
+               elapsed_secs=metrics.get('elapsed_secs', 0.0),
+               eta_secs=metrics.get('eta_secs'),
+               files_transferred=count('files_transferred'),
+               files_checked=count('files_checked'),
+               files_total=count('files_total'))
+
+
+@dataclasses.dataclass
+class RsyncFinished:
+  # Non-zero if any rsync process had an error.
+  status: int
+  # Changes and their bytes, by kind, e.g. changelog.DELETED.
+  counts: Dict[str, int]
+  bytes: Dict[str, int]
+  # Totals from rsync, as saved in the metadata.
+  stats: Dict[str, float]
+
+
+@dataclasses.dataclass
+class SnapshotCreated:
+  name: str
+
+
+@dataclasses.dataclass
+class SnapshotUpdated:
+  """The latest snapshot was marked up to date, as nothing had changed."""
+  name: str
+
+
+@dataclasses.dataclass
+class SnapshotDeleted:
+  """A snapshot was moved to the trash, e.g. past max_to_keep."""
+  name: str
+
+
+Event = Union[PhaseStarted, PhaseFinished, StepDone, RsyncProgress,
+              RsyncFinished, SnapshotCreated, SnapshotUpdated, SnapshotDeleted]
@@ -0,0 +1,77 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Matches paths against excludes, as rsync's --exclude does.
+
+For in-process walks of the source that must leave out what rsync does. As in
+rsync, a pattern ending with "/" only matches directories, and one starting
+with "/" is anchored at the source. Others match the end of the path, at a
+component boundary; so "*.tmp" matches any name, and "cache/*.tmp" any such
+file in a directory named cache. "*" and "?" do not match "/", and "**" does.
+"""
+
+import re
+
+from typing import List, Pattern, Tuple
+
+
+def _translate(pattern: str) -> str:
+  """Regular expression for a glob, without anchors."""
+  parts = []
+  i = 0
+  while i < len(pattern):
+    if pattern.startswith('**', i):
+      parts.append('.*')
+      i += 2
+      continue
+    char = pattern[i]
+    i += 1
+    if char == '*':
+      parts.append('[^/]*')
+    elif char == '?':
+      parts.append('[^/]')
+    elif char == '[':
+      end = pattern.find(']', i + 1 if pattern[i:i + 1] in ('!', ']') else i)
+      if end < 0:
+        parts.append(re.escape(char))
+        continue
+      body = pattern[i:end].replace('\\', '\\\\')
+      if body.startswith('!'):
+        body = '^' + body[1:]
+      parts.append(f'[{body}]')
+      i = end + 1
+    else:
+      parts.append(re.escape(char))
+  return ''.join(parts)
+
+
+class Excluder:
+  """Decides whether paths relative to the source are excluded."""
+
+  def __init__(self, excludes: List[str]):
+    # Pairs of (compiled pattern, whether it only matches directories).
+    self._patterns: List[Tuple[Pattern[str], bool]] = []
+    for exclude in excludes:
+      dir_only = exclude.endswith('/')
+      pattern = exclude.rstrip('/')
+      if pattern.startswith('/'):
+        regex = '^' + _translate(pattern.lstrip('/')) + '$'
+      else:
+        regex = '(?:^|/)' + _translate(pattern) + '$'
+      if pattern.strip('/'):
+        self._patterns.append((re.compile(regex, re.DOTALL), dir_only))
+
+  def excludes(self, relpath: str, is_dir: bool) -> bool:
+    return any(
+        pattern.search(relpath) is not None and (is_dir or not dir_only)
+        for pattern, dir_only in self._patterns)
@@ -0,0 +1,137 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Limits the CPU, I/O, bandwidth and memory a backup takes from its host.
+
+Child processes (rsync, cp, rm and others) are run under `nice` and `ionice`.
+Worker threads within yaribak get the same priorities, which on Linux are per
+thread. Rsync is also given a bandwidth limit.
+
+Rsync keeps its whole file list in memory, unless it recurses incrementally,
+which uses less memory but cannot detect all hard links. With a RAM budget,
+the mode is chosen for each backup from the number of files in the previous
+one, instead of with --low-ram.
+"""
+
+import dataclasses
+import logging
+import os
+import re
+import subprocess
+import threading
+
+from typing import List, Optional
+
+from . import metadata
+
+# Rsync's file list takes about 100 bytes per file (see its FAQ). Without
+# incremental recursion, each of its three processes holds the whole list.
+BYTES_PER_FILE = 300
+
+# Arguments to `ionice -c`.
+IONICE_CLASSES = {'best-effort': 2, 'idle': 3}
+
+_SIZE_RE = re.compile(r'^(?P<number>\d+(\.\d*)?)\s*(?P<unit>[kmgt]?)(i?b)?$',
+                      re.IGNORECASE)
+_UNITS = {'': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+
+
+def parse_size(size: str) -> int:
+  """Bytes in a size like '512M' or '2GiB'. Units are powers of 1024."""
+  m = _SIZE_RE.match(size.strip())
+  if not m:
+    raise ValueError(f'Cannot parse size {size!r}')
+  return int(float(m.group('number')) * _UNITS[m.group('unit').lower()])
+
+
+def predicted_files(data: metadata.Metadata,
+                    entries: Optional[int]) -> Optional[int]:
+  """Files expected in the next backup, from the previous one, if known.
+
+  Args:
+    data: Metadata of the previous backup, with totals from rsync.
+    entries: Entries in the previous backup, e.g. from its manifest.
+  """
+  if data.rsync_stats is not None and 'files' in data.rsync_stats:
+    return int(data.rsync_stats['files'])
+  return entries
+
+
+@dataclasses.dataclass
+class Governor:
+  # Memory rsync may use, in bytes.
+  ram_budget: Optional[int] = None
+  # Niceness, from 0 to 19, of children and worker threads. Absolute, not
+  # relative to that of yaribak.
+  nice: Optional[int] = None
+  # One of IONICE_CLASSES.
+  ionice_class: Optional[str] = None
+  # Passed to rsync's --bwlimit, e.g. "20m" for 20 MiB/s.
+  bwlimit: Optional[str] = None
+
+  def __post_init__(self):
+    if self.nice is not None and not 0 <= self.nice <= 19:
+      raise ValueError(f'nice must be between 0 and 19, got {self.nice}')
+    known_class = self.ionice_class in IONICE_CLASSES
+    if self.ionice_class is not None and not known_class:
+      raise ValueError(f'Unknown ionice class {self.ionice_class!r}; '
+                       f'expected one of {sorted(IONICE_CLASSES)}')
+
+  def command_prefix(self) -> List[str]:
+    """Prepended to the arguments of every command run."""
+    prefix: List[str] = []
+    if self.nice is not None:
+      # The niceness is absolute, as for apply_to_thread(), while `nice -n`
+      # adds to that of the calling thread, which starts the command.
+      increment = self.nice - os.getpriority(os.PRIO_PROCESS, 0)
+      prefix += ['nice', '-n', str(increment)]
+    if self.ionice_class is not None:
+      prefix += ['ionice', '-c', str(IONICE_CLASSES[self.ionice_class])]
+    return prefix
+
+  def rsync_flags(self) -> List[str]:
+    if self.bwlimit is None:
+      return []
+    return [f'--bwlimit={self.bwlimit}']
+
+  def low_ram(self, files: Optional[int], default: bool) -> bool:
+    """Whether rsync should recurse incrementally, to fit in the budget."""
+    if self.ram_budget is None or files is None:
+      return default
+    needed = files * BYTES_PER_FILE
+    low_ram = needed > self.ram_budget
+    logging.info(f'Rsync needs about {needed / 2**20:0.0f} MiB for {files} '
+                 f'files, with a budget of {self.ram_budget / 2**20:0.0f} '
+                 f'MiB; {"" if low_ram else "not "}using low RAM mode.')
+    return low_ram
+
+  def apply_to_thread(self) -> None:
+    """Lowers priorities of the calling thread, e.g. a worker thread.
+
+    Failures are logged and ignored, as in utils.lower_thread_priority().
+    """
+    tid = threading.get_native_id()
+    if self.nice is not None:
+      try:
+        os.setpriority(os.PRIO_PROCESS, tid, self.nice)
+      except OSError as e:
+        logging.debug(f'Could not set CPU priority: {e}')
+    if self.ionice_class is not None:
+      io_class = IONICE_CLASSES[self.ionice_class]
+      try:
+        subprocess.run(['ionice', '-c', str(io_class), '-p', str(tid)],
+                       check=True,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+      except (OSError, subprocess.CalledProcessError) as e:
+        logging.debug(f'Could not set I/O priority: {e}')
@@ -0,0 +1,123 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Persistent cache of file content hashes, keyed by inode.
+
+Files in snapshots are hard links to the same inode across many snapshots, so
+each inode needs to be hashed only once. An entry is used only if the size and
+mtime still match.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from typing import Optional, Set, Tuple
+
+# File name of the cache, in the backup path.
+CACHE_FNAME = '.hash_cache.sqlite3'
+
+# With SHA-NI, this is faster than blake2b and others in hashlib.
+_ALGORITHM = 'sha256'
+_BUFFER_SIZE = 1 << 20
+
+
+def hash_file(path: str) -> bytes:
+  h = hashlib.new(_ALGORITHM)
+  buffer = bytearray(_BUFFER_SIZE)
+  view = memoryview(buffer)
+  with open(path, 'rb', buffering=0) as f:
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    while True:
+      n = f.readinto(buffer)
+      if not n:
+        break
+      h.update(view[:n])
+  return h.digest()
+
+
+class HashCache:
+  """Thread-safe cache of file hashes. Call commit() to persist additions."""
+
+  def __init__(self, fname: str):
+    self._db = sqlite3.connect(fname, check_same_thread=False)
+    self._db.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                     'dev INTEGER, ino INTEGER, size INTEGER, '
+                     'mtime_ns INTEGER, digest BLOB, '
+                     'PRIMARY KEY (dev, ino))')
+    # The backup path is listed often. Keeps the journal file there instead of
+    # creating and deleting it on each commit.
+    self._db.execute('PRAGMA journal_mode=TRUNCATE')
+    self._lock = threading.Lock()
+    # Statistics since the cache was opened.
+    self.hits = 0
+    self.bytes_hashed = 0
+    self.seconds_hashing = 0.0
+
+  def get(self, st: os.stat_result) -> Optional[bytes]:
+    with self._lock:
+      row = self._db.execute(
+          'SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? '
+          'AND mtime_ns=?',
+          (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+    return None if row is None else row[0]
+
+  def put(self, st: os.stat_result, digest: bytes) -> None:
+    with self._lock:
+      self._db.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                       (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                        digest))
+
+  def digest(self, path: str, st: os.stat_result) -> bytes:
+    """Hash of the file, from the cache if possible. St is its lstat."""
+    cached = self.get(st)
+    if cached is not None:
+      with self._lock:
+        self.hits += 1
+      return cached
+    start = time.monotonic()
+    digest = hash_file(path)
+    elapsed = time.monotonic() - start
+    self.put(st, digest)
+    with self._lock:
+      self.bytes_hashed += st.st_size
+      self.seconds_hashing += elapsed
+    return digest
+
+  def prune(self, live: Set[Tuple[int, int]]) -> int:
+    """Drops entries for inodes not in live, as (dev, ino) pairs.
+
+    Returns the number of entries dropped.
+    """
+    with self._lock:
+      dead = [(dev, ino)
+              for dev, ino in self._db.execute('SELECT dev, ino FROM hashes')
+              if (dev, ino) not in live]
+      self._db.executemany('DELETE FROM hashes WHERE dev=? AND ino=?', dead)
+    return len(dead)
+
+  def commit(self) -> None:
+    with self._lock:
+      self._db.commit()
+
+  def close(self) -> None:
+    self.commit()
+    self._db.close()
+
+  def __enter__(self) -> 'HashCache':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
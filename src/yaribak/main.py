@@ -17,16 +17,33 @@ Example run -
   python yaribak.py \
     --source ~ \
     --backup-path /mnt/backup_drive/backup_home
+
+Other commands are run as `yaribak <command> --help`.
 """
 
 import argparse
+import functools
 import logging
 import os
+import sys
+import time
 
 from . import backup_processor
+from . import catalog
+from . import chunks
+from . import diff
+from . import governor
 from . import human_interval
+from . import parallel_walk
+from . import reaper
+from . import restore
+from . import scheduler
+from . import tier
+from . import usage
+from . import verify
+from . import watcher
 
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 
 def _absolute_path(path: str) -> str:
@@ -35,10 +52,25 @@ def _absolute_path(path: str) -> str:
   return os.path.abspath(os.path.expanduser(os.path.expandvars(path)))
 
 
-def main():
-  logging.basicConfig(level=logging.INFO)
+def _reap_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak reap', description='Removes expired snapshots from the trash.')
+  parser.add_argument('--backup-path',
+                      type=str,
+                      required=True,
+                      help='Backup path, as used for the backups.')
+  args = parser.parse_args(argv)
+  target = _absolute_path(args.backup_path)
+  if not os.path.isdir(target):
+    parser.error(f'{target!r} is not a valid directory')
+  stats = reaper.reap(target)
+  logging.info(f'Reaper {stats}.')
+  if os.path.isdir(chunks.store_dir(target)):
+    logging.info(f'Chunk store {chunks.collect_garbage(target)}.')
 
-  parser = argparse.ArgumentParser('yaribak')
+
+def _add_backup_args(parser: argparse.ArgumentParser) -> None:
+  """Adds the flags shared by the backup and watch commands."""
   parser.add_argument('--source',
                       type=str,
                       required=True,
@@ -71,6 +103,73 @@ def main():
   parser.add_argument('--low-ram',
                       action='store_true',
                       help='Lowers memory usage a little. Can miss hard links.')
+  parser.add_argument('--ram-budget',
+                      type=str,
+                      help=('Memory rsync may use, e.g. 2G. Chooses --low-ram '
+                            'for each backup, from the number of files in the '
+                            'previous one.'))
+  parser.add_argument('--nice',
+                      type=int,
+                      help=('Run rsync, cp and other commands, and worker '
+                            'threads, with this niceness (0 to 19).'))
+  parser.add_argument('--ionice',
+                      choices=sorted(governor.IONICE_CLASSES),
+                      help='Run them with this I/O scheduling class.')
+  parser.add_argument('--bwlimit',
+                      type=str,
+                      help='Limit rsync\'s bandwidth, e.g. 20m for 20 MiB/s.')
+  parser.add_argument('--snapshot-strategy',
+                      choices=backup_processor.SNAPSHOT_STRATEGIES,
+                      default=backup_processor.SNAPSHOT_NATIVE,
+                      help=('How to create a new snapshot from the latest. '
+                            '"native" hard links with a pool of threads, '
+                            '"cp" uses cp -al, "link-dest" lets a single '
+                            'rsync pass hard link unchanged files.'))
+  parser.add_argument('--reap',
+                      choices=backup_processor.REAP_MODES,
+                      default=backup_processor.REAP_BACKGROUND,
+                      help=('Expired backups are moved to a trash directory. '
+                            'This sets when the trash is removed. '
+                            '"background" does it during the next backup, '
+                            '"inline" right away, and "manual" only with '
+                            '`yaribak reap`.'))
+  parser.add_argument('--manifest',
+                      action='store_true',
+                      help=('Write a compact listing of all files in each '
+                            'backup, to avoid walking it later.'))
+  parser.add_argument('--shards',
+                      type=int,
+                      default=1,
+                      help=('Copy top-level directories of the source with '
+                            'this many rsync processes at once. Hard links '
+                            'between different top-level directories are '
+                            'copied as separate files.'))
+  parser.add_argument('--dedup',
+                      action='store_true',
+                      help=('Hard link new files in the backup to identical '
+                            'files in the previous one, e.g. if they were '
+                            'moved or renamed.'))
+  parser.add_argument('--seed',
+                      action='store_true',
+                      help=('Copy the first backup with a pool of threads, '
+                            'before rsync checks it and completes it.'))
+  parser.add_argument('--chunk-threshold',
+                      type=str,
+                      help=('Store files of at least this size, e.g. 1G, as '
+                            'blocks shared between backups, so that only the '
+                            'changed blocks take space.'))
+  parser.add_argument('--metrics-textfile',
+                      type=str,
+                      help=('Keep progress metrics of rsync in this file, '
+                            'e.g. /var/lib/node_exporter/yaribak.prom for the '
+                            'textfile collector of node exporter.'))
+  parser.add_argument('--metrics-jsonl',
+                      type=str,
+                      help='Append progress metrics of rsync to this file.')
+  parser.add_argument('--profile',
+                      type=str,
+                      help=('Write the time, CPU and I/O taken by each phase '
+                            'of the backup to this JSON file.'))
   parser.add_argument('--verbose',
                       action='store_true',
                       help='Passes -v to rsync.')
@@ -81,36 +180,415 @@ def main():
   parser.add_argument('--exclude',
                       action='append',
                       help='Directories to exclude.')
-  args = parser.parse_args()
-  source = _absolute_path(args.source)
-  target = _absolute_path(args.backup_path)
-  only_if_changed: bool = args.only_if_changed
-  low_ram: bool = args.low_ram
-  dryrun: bool = args.dry_run
-  verbose: bool = args.verbose
+
+
+def _make_processor(args: argparse.Namespace
+                    ) -> backup_processor.BackupProcessor:
+  ram_budget: Optional[int] = None
+  if args.ram_budget:
+    ram_budget = governor.parse_size(args.ram_budget)
+  chunk_threshold: Optional[int] = None
+  if args.chunk_threshold:
+    chunk_threshold = governor.parse_size(args.chunk_threshold)
+  return backup_processor.BackupProcessor(
+      dryrun=args.dry_run,
+      verbose=args.verbose,
+      only_if_changed=args.only_if_changed,
+      low_ram=args.low_ram,
+      minimum_delay_secs=human_interval.parse_to_secs(args.minimum_wait),
+      snapshot_strategy=args.snapshot_strategy,
+      reap_mode=args.reap,
+      write_manifest=args.manifest,
+      shards=args.shards,
+      dedup_files=args.dedup,
+      seed=args.seed,
+      chunk_threshold=chunk_threshold,
+      metrics_textfile=args.metrics_textfile,
+      metrics_jsonl=args.metrics_jsonl,
+      profile_fname=args.profile,
+      resource_governor=governor.Governor(
+          ram_budget=ram_budget,
+          nice=args.nice,
+          ionice_class=args.ionice,
+          bwlimit=args.bwlimit))
+
+
+def _process_kwargs(args: argparse.Namespace) -> Dict[str, Any]:
+  """Arguments to BackupProcessor.process()."""
   min_ttl: Optional[float] = None
   if args.min_ttl:
     min_ttl = human_interval.parse_to_secs(args.min_ttl)
-  max_to_keep: int = args.max_to_keep
-  minimum_wait: float = human_interval.parse_to_secs(args.minimum_wait)
   exclude: List[str] = args.exclude or []
+  return dict(source=_absolute_path(args.source),
+              target=_absolute_path(args.backup_path),
+              max_to_keep=args.max_to_keep,
+              excludes=exclude,
+              min_ttl=min_ttl)
+
+
+def _list_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser('yaribak list',
+                                   description='Lists all snapshots.')
+  parser.add_argument('--backup-path',
+                      type=str,
+                      required=True,
+                      help='Backup path, as used for the backups.')
+  args = parser.parse_args(argv)
+  target = _absolute_path(args.backup_path)
+  if not os.path.isdir(target):
+    parser.error(f'{target!r} is not a valid directory')
+  snapshots = catalog.Catalog(target)
+  try:
+    print(catalog.format_snapshots(snapshots.snapshots()))
+  finally:
+    snapshots.close()
+
+
+def _usage_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak usage',
+      description=('Shows the bytes used by each snapshot, and how many of '
+                   'them would be freed by deleting it.'))
+  parser.add_argument('--backup-path',
+                      type=str,
+                      required=True,
+                      help='Backup path, as used for the backups.')
+  parser.add_argument('--sort',
+                      choices=['name', 'exclusive'],
+                      default='name',
+                      help='List by name, or by exclusive bytes, largest first.')
+  parser.add_argument('--refresh',
+                      action='store_true',
+                      help='Recompute even if stored usage is up to date.')
+  args = parser.parse_args(argv)
+  target = _absolute_path(args.backup_path)
+  if not os.path.isdir(target):
+    parser.error(f'{target!r} is not a valid directory')
+  snapshots = catalog.Catalog(target)
+  try:
+    listed = snapshots.snapshots()
+    names = [snapshot.name for snapshot in listed]
+    key = usage.snapshots_key(names)
+    usages: Optional[List[usage.SnapshotUsage]] = None
+    if not args.refresh:
+      usages = usage.from_metadata(
+          names, [snapshot.metadata for snapshot in listed], key)
+    if usages is None:
+      usages = usage.compute(target, names)
+      # Stored, so that the next call is quick if nothing changed.
+      for snapshot, snapshot_usage in zip(listed, usages):
+        usage.to_metadata(snapshot_usage, key, snapshot.metadata)
+        snapshot.metadata.save_to(
+            os.path.join(target, snapshot.name, 'backup_context.json'))
+        snapshots.update_metadata(snapshot.name, snapshot.metadata)
+  finally:
+    snapshots.close()
+  if args.sort == 'exclusive':
+    usages.sort(key=lambda it: it.exclusive_bytes, reverse=True)
+  print(usage.format_usages(usages))
+
+
+def _diff_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak diff',
+      description=('Lists files added, modified or deleted between two '
+                   'snapshots, without reading their contents.'))
+  parser.add_argument('--backup-path',
+                      type=str,
+                      required=True,
+                      help='Backup path, as used for the backups.')
+  parser.add_argument('--summary',
+                      action='store_true',
+                      help='Only print the totals.')
+  parser.add_argument('old',
+                      help='Snapshot by name or timestamp, or "latest".')
+  parser.add_argument('new',
+                      help='Snapshot by name or timestamp, or "latest".')
+  args = parser.parse_args(argv)
+  target = _absolute_path(args.backup_path)
+  if not os.path.isdir(target):
+    parser.error(f'{target!r} is not a valid directory')
+  snapshots = catalog.Catalog(target)
+  try:
+    listed = {snapshot.name: snapshot for snapshot in snapshots.snapshots()}
+  finally:
+    snapshots.close()
+  try:
+    old = restore.resolve_snapshot(sorted(listed), args.old)
+    new = restore.resolve_snapshot(sorted(listed), args.new)
+  except ValueError as e:
+    parser.error(str(e))
+  summary = diff.DiffSummary()
+  for difference in diff.diff(diff.records(target, listed[old]),
+                              diff.records(target, listed[new])):
+    summary.add(difference)
+    if not args.summary:
+      print(diff.format_difference(difference))
+  print(summary)
+
+
+def _restore_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak restore',
+      description=('Restores files from a snapshot. Files already identical '
+                   'at the destination are skipped.'))
+  parser.add_argument('--backup-path',
+                      type=str,
+                      required=True,
+                      help='Backup path, as used for the backups.')
+  parser.add_argument('--snapshot',
+                      type=str,
+                      default='latest',
+                      help=('Snapshot to restore from, by name or timestamp, '
+                            'e.g. 20220314_110903. Defaults to the latest.'))
+  parser.add_argument('--dest',
+                      type=str,
+                      required=True,
+                      help='Where to restore to, e.g. the original source.')
+  parser.add_argument('--workers',
+                      type=int,
+                      default=parallel_walk.DEFAULT_WORKERS,
+                      help='Number of files to copy in parallel.')
+  parser.add_argument('paths',
+                      nargs='*',
+                      help=('Globs of paths within the snapshot to restore, '
+                            'e.g. "home/*/projects". Defaults to all.'))
+  args = parser.parse_args(argv)
+  target = _absolute_path(args.backup_path)
+  if not os.path.isdir(target):
+    parser.error(f'{target!r} is not a valid directory')
+  snapshots = catalog.Catalog(target)
+  try:
+    listed = {snapshot.name: snapshot for snapshot in snapshots.snapshots()}
+  finally:
+    snapshots.close()
+  try:
+    name = restore.resolve_snapshot(sorted(listed), args.snapshot)
+  except ValueError as e:
+    parser.error(str(e))
+  logging.info(f'Restoring from {name}.')
+  stats = restore.restore(target,
+                          listed[name],
+                          _absolute_path(args.dest),
+                          args.paths,
+                          num_workers=args.workers)
+  logging.info(f'Restored {stats.files} files, '
+               f'{usage.format_bytes(stats.bytes)} in {stats.seconds:0.1f}s '
+               f'({usage.format_bytes(int(stats.bytes_per_sec))}/s); '
+               f'{stats.directories} directories, {stats.links} links, and '
+               f'skipped {stats.skipped} identical files.')
+
+
+def _tier_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak tier',
+      description=('Packs snapshots older than a threshold into compressed '
+                   'archives. The latest snapshot is never archived.'))
+  parser.add_argument('--backup-path',
+                      type=str,
+                      required=True,
+                      help='Backup path, as used for the backups.')
+  parser.add_argument('--older-than',
+                      type=str,
+                      required=True,
+                      help='Age of snapshots to archive. E.g. 30days, 1year.')
+  parser.add_argument('--dry-run',
+                      action='store_true',
+                      help='Only list the snapshots that would be archived.')
+  args = parser.parse_args(argv)
+  target = _absolute_path(args.backup_path)
+  if not os.path.isdir(target):
+    parser.error(f'{target!r} is not a valid directory')
+  older_than_secs = human_interval.parse_to_secs(args.older_than)
+  snapshots = catalog.Catalog(target)
+  try:
+    listed = snapshots.snapshots()
+    if not args.dry_run:
+      for snapshot in listed:
+        if tier.finish_interrupted(target, snapshot):
+          snapshots.update_metadata(snapshot.name, snapshot.metadata)
+    for snapshot in tier.cold_snapshots(listed, older_than_secs, time.time()):
+      if args.dry_run:
+        logging.info(f'Would archive {snapshot.name}.')
+        continue
+      logging.info(f'Archiving {snapshot.name}.')
+      archived = tier.archive_snapshot(target, snapshot)
+      snapshots.update_metadata(snapshot.name, snapshot.metadata)
+      logging.info(f'Archived {snapshot.name}: {tier.format_stats(archived)}.')
+  finally:
+    snapshots.close()
+  if not args.dry_run:
+    stats = reaper.reap(target)
+    logging.info(f'Reaper {stats}.')
+
+
+def _verify_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak verify',
+      description=('Checks that files in all snapshots are readable, and '
+                   'unchanged since last verified. Each inode is read once.'))
+  parser.add_argument('--backup-path',
+                      type=str,
+                      required=True,
+                      help='Backup path, as used for the backups.')
+  parser.add_argument('--full',
+                      action='store_true',
+                      help=('Read all files again, and compare with stored '
+                            'checksums. By default only new files are read.'))
+  parser.add_argument('--workers',
+                      type=int,
+                      default=parallel_walk.DEFAULT_WORKERS,
+                      help='Number of files to read in parallel.')
+  args = parser.parse_args(argv)
+  target = _absolute_path(args.backup_path)
+  if not os.path.isdir(target):
+    parser.error(f'{target!r} is not a valid directory')
+  snapshots = catalog.Catalog(target)
+  try:
+    names = [snapshot.name for snapshot in snapshots.snapshots()]
+  finally:
+    snapshots.close()
+  stats, problems = verify.verify(target,
+                                  names,
+                                  full=args.full,
+                                  num_workers=args.workers)
+  for problem in problems:
+    print(f'{problem.snapshot}: {problem.path}: {problem.error}')
+  logging.info(f'Verified {stats.inodes} files and {stats.blocks} blocks in '
+               f'{len(names)} snapshots; '
+               f'read {stats.hashed} ({usage.format_bytes(stats.hashed_bytes)}'
+               f') in {stats.seconds:0.1f}s '
+               f'({usage.format_bytes(int(stats.bytes_per_sec))}/s).')
+  if problems:
+    logging.error(f'Found {len(problems)} problems.')
+    sys.exit(1)
+
+
+def _backup_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser('yaribak')
+  _add_backup_args(parser)
+  args = parser.parse_args(argv)
+  processor = _make_processor(args)
+  processor.process(**_process_kwargs(args))
 
-  processor = backup_processor.BackupProcessor(dryrun=dryrun,
-                                               verbose=verbose,
-                                               only_if_changed=only_if_changed,
-                                               low_ram=low_ram,
-                                               minimum_delay_secs=minimum_wait)
-  processor.process(source=source,
-                    target=target,
-                    max_to_keep=max_to_keep,
-                    excludes=exclude,
-                    min_ttl=min_ttl)
-
-  if dryrun:
+  if args.dry_run:
     logging.info('Called with --dry-run, nothing was changed.')
   else:
     logging.info('Done')
 
 
+def _watch_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak watch',
+      description=('Keeps running, and backs up whenever the source changes. '
+                   'Only directories with changes are scanned, except for the '
+                   'first backup.'))
+  _add_backup_args(parser)
+  parser.add_argument('--debounce',
+                      type=str,
+                      default='10s',
+                      help=('Wait for the source to be quiet this long '
+                            'before a backup.'))
+  args = parser.parse_args(argv)
+  if args.snapshot_strategy == backup_processor.SNAPSHOT_LINK_DEST:
+    parser.error('watch needs a clone of the latest backup; use '
+                 '--snapshot-strategy=native or cp')
+  # The wait between backups is handled by the watcher, which holds changes
+  # until then.
+  interval_secs = human_interval.parse_to_secs(args.minimum_wait)
+  args.minimum_wait = '0s'
+  processor = _make_processor(args)
+  kwargs = _process_kwargs(args)
+
+  def backup(dirty_dirs: Optional[List[str]]) -> None:
+    processor.process(**kwargs, dirty_dirs=dirty_dirs)
+
+  watcher.watch(kwargs['source'],
+                backup,
+                interval_secs=interval_secs,
+                debounce_secs=human_interval.parse_to_secs(args.debounce))
+
+
+def _options_to_argv(options: Dict[str, Any]) -> List[str]:
+  """Converts options of a job in the config to command line flags."""
+  argv: List[str] = []
+  for key, value in options.items():
+    flag = '--' + key.replace('_', '-')
+    if isinstance(value, bool):
+      if value:
+        argv.append(flag)
+    elif isinstance(value, list):
+      for item in value:
+        argv += [flag, str(item)]
+    else:
+      argv += [flag, str(value)]
+  return argv
+
+
+def _schedule_main(argv: List[str]) -> None:
+  parser = argparse.ArgumentParser(
+      'yaribak schedule',
+      description=('Runs all backups in a config file that are due, with '
+                   'limited concurrency on each device.'))
+  parser.add_argument('--config',
+                      type=str,
+                      required=True,
+                      help='JSON file with the jobs.')
+  parser.add_argument('--max-per-device',
+                      type=int,
+                      help='Overrides max_per_device in the config.')
+  parser.add_argument('--dry-run',
+                      action='store_true',
+                      help='Do not make any change.')
+  args = parser.parse_args(argv)
+  config = scheduler.load_config(_absolute_path(args.config))
+  max_per_device: int = args.max_per_device or config.max_per_device
+
+  jobs: List[scheduler.Job] = []
+  for options in config.jobs:
+    name = str(options.pop('name'))
+    job_parser = argparse.ArgumentParser(f'yaribak schedule (job {name})')
+    _add_backup_args(job_parser)
+    job_args = job_parser.parse_args(_options_to_argv(options))
+    job_args.dry_run |= args.dry_run
+    kwargs = _process_kwargs(job_args)
+    jobs.append(
+        scheduler.make_job(
+            name=name,
+            run=functools.partial(_make_processor(job_args).process, **kwargs),
+            paths=[kwargs['source'], kwargs['target']],
+            elapsed_secs=functools.partial(
+                backup_processor.elapsed_since_backup, kwargs['target']),
+            minimum_wait_secs=human_interval.parse_to_secs(
+                job_args.minimum_wait)))
+
+  results = scheduler.run_jobs(jobs, max_per_device)
+  print(scheduler.report(results))
+  if any(result.status == scheduler.FAILED for result in results):
+    sys.exit(1)
+
+
+# Commands other than backup, which is the default.
+_COMMANDS: Dict[str, Callable[[List[str]], None]] = {
+    'diff': _diff_main,
+    'list': _list_main,
+    'reap': _reap_main,
+    'restore': _restore_main,
+    'schedule': _schedule_main,
+    'tier': _tier_main,
+    'usage': _usage_main,
+    'verify': _verify_main,
+    'watch': _watch_main,
+}
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  if len(sys.argv) > 1 and sys.argv[1] in _COMMANDS:
+    _COMMANDS[sys.argv[1]](sys.argv[2:])
+  else:
+    _backup_main(sys.argv[1:])
+
+
 if __name__ == '__main__':
   main()
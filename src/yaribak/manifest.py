@@ -0,0 +1,251 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compact binary listing of all entries in a snapshot.
+
+Layout of the file -
+  magic
+  header: device and inode of the payload directory
+  record for each entry, sorted by path
+  index of u64 offsets to each record
+  footer: magic, number of entries, offset of index
+
+Each record is a fixed header (inode, size, mtime_ns, mode, nlink, path length)
+followed by the path. Paths are relative to the payload, and are stored with
+NUL instead of "/" between components. That way plain byte comparison sorts
+them like a depth-first walk with sorted names, i.e. "a" < "a/b" < "a.txt".
+
+The payload directory identifies the snapshot the manifest belongs to. A
+manifest hard linked into another snapshot, e.g. by a clone, names a different
+payload directory, and is not used for it.
+
+The file is memory mapped when read, so opening it costs the same regardless
+of size, and finding a path is a binary search over the index.
+"""
+
+import array
+import concurrent.futures
+import mmap
+import os
+import struct
+
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+# File name of the manifest, in the snapshot directory.
+MANIFEST_FNAME = 'manifest.ymf'
+
+_MAGIC = b'YMANIF02'
+# Device and inode of the payload directory.
+_HEADER = struct.Struct('<QQ')
+# inode, size, mtime_ns, mode, nlink, path length.
+_RECORD = struct.Struct('<QQqIIH')
+# magic, number of entries, offset of index.
+_FOOTER = struct.Struct('<8sQQ')
+
+
+class Entry(NamedTuple):
+  path: str
+  inode: int
+  size: int
+  mtime_ns: int
+  mode: int
+  nlink: int
+
+
+def path_key(path: str) -> bytes:
+  """The stored form of a relative path, which also defines the sort order."""
+  return os.fsencode(path).replace(b'/', b'\0')
+
+
+def _from_key(key: bytes) -> str:
+  return os.fsdecode(key.replace(b'\0', b'/'))
+
+
+class ManifestWriter:
+  """Writes a manifest in a streaming way. Entries must be added in order."""
+
+  def __init__(self, fname: str, root: os.stat_result):
+    """Root is the stat of the payload directory that is listed."""
+    self._fname = fname
+    self._tmp_fname = fname + '.tmp'
+    self._file = open(self._tmp_fname, 'wb')
+    self._file.write(_MAGIC)
+    self._file.write(_HEADER.pack(root.st_dev, root.st_ino))
+    self._offsets = array.array('Q')
+    self._last_key: Optional[bytes] = None
+
+  def add(self, key: bytes, st: os.stat_result) -> None:
+    if self._last_key is not None and key <= self._last_key:
+      raise ValueError(f'Manifest entries out of order: {key!r}')
+    self._last_key = key
+    self._offsets.append(self._file.tell())
+    self._file.write(
+        _RECORD.pack(st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode,
+                     st.st_nlink, len(key)))
+    self._file.write(key)
+
+  def abort(self) -> None:
+    self._file.close()
+    os.remove(self._tmp_fname)
+
+  def close(self) -> int:
+    """Finalizes the manifest, and returns the number of entries."""
+    index_offset = self._file.tell()
+    self._offsets.tofile(self._file)
+    self._file.write(_FOOTER.pack(_MAGIC, len(self._offsets), index_offset))
+    self._file.close()
+    # Replacing also ensures this is not a hard link to an older manifest.
+    os.replace(self._tmp_fname, self._fname)
+    return len(self._offsets)
+
+
+def _sorted_entries(path: str) -> List[Tuple[bytes, os.DirEntry]]:
+  with os.scandir(path) as it:
+    return sorted((os.fsencode(e.name), e) for e in it)
+
+
+def walk_sorted(payload: str) -> Iterator[Tuple[bytes, os.DirEntry]]:
+  """Walks payload in the order of the keys of its entries, see path_key()."""
+  # Stack of (key prefix, remaining entries of a directory, reversed).
+  stack = [(b'', _sorted_entries(payload)[::-1])]
+  while stack:
+    prefix, remaining = stack[-1]
+    if not remaining:
+      stack.pop()
+      continue
+    name, entry = remaining.pop()
+    key = prefix + name
+    yield key, entry
+    if entry.is_dir(follow_symlinks=False):
+      stack.append((key + b'\0', _sorted_entries(entry.path)[::-1]))
+
+
+def write_tree(payload: str,
+               fname: str,
+               initializer: Optional[Callable[[], None]] = None) -> int:
+  """Walks payload and writes its manifest. Returns the number of entries.
+
+  If given, initializer() is called first in a thread started for the walk,
+  so that e.g. a priority it lowers does not stay with the calling thread.
+  """
+  if initializer is not None:
+    with concurrent.futures.ThreadPoolExecutor(1,
+                                               initializer=initializer) as ex:
+      return ex.submit(write_tree, payload, fname).result()
+  writer = ManifestWriter(fname, os.stat(payload))
+  try:
+    for key, entry in walk_sorted(payload):
+      writer.add(key, entry.stat(follow_symlinks=False))
+  except BaseException:
+    writer.abort()
+    raise
+  return writer.close()
+
+
+def usable_manifest(directory: str) -> Optional[str]:
+  """The manifest of a snapshot directory, if it lists its payload.
+
+  Everything that reads a snapshot's manifest should find it through this.
+  """
+  fname = os.path.join(directory, MANIFEST_FNAME)
+  if not os.path.exists(fname):
+    return None
+  try:
+    st = os.stat(os.path.join(directory, 'payload'))
+    with open(fname, 'rb') as f:
+      header = f.read(len(_MAGIC) + _HEADER.size)
+  except FileNotFoundError:
+    return None
+  # Possibly an older format.
+  if header[:len(_MAGIC)] != _MAGIC:
+    return None
+  if len(header) != len(_MAGIC) + _HEADER.size:
+    return None
+  # Not the case for a hard link to the manifest of another snapshot, e.g. if
+  # the snapshot was cloned from one with a manifest, but did not write its
+  # own.
+  if _HEADER.unpack_from(header, len(_MAGIC)) != (st.st_dev, st.st_ino):
+    return None
+  return fname
+
+
+class Manifest:
+  """Read-only, memory mapped view of a manifest."""
+
+  def __init__(self, fname: str):
+    with open(fname, 'rb') as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = self._mmap[:len(_MAGIC)]
+    min_size = len(_MAGIC) + _HEADER.size + _FOOTER.size
+    if len(self._mmap) < min_size or header != _MAGIC:
+      self._mmap.close()
+      raise ValueError(f'{fname} is not a manifest')
+    magic, self._count, index_offset = _FOOTER.unpack_from(
+        self._mmap,
+        len(self._mmap) - _FOOTER.size)
+    if magic != _MAGIC:
+      self._mmap.close()
+      raise ValueError(f'{fname} is truncated')
+    index_end = index_offset + 8 * self._count
+    self._index = memoryview(self._mmap)[index_offset:index_end].cast('Q')
+
+  def __len__(self) -> int:
+    return self._count
+
+  def _key(self, i: int) -> bytes:
+    offset = self._index[i]
+    key_len = _RECORD.unpack_from(self._mmap, offset)[-1]
+    start = offset + _RECORD.size
+    return self._mmap[start:start + key_len]
+
+  def __getitem__(self, i: int) -> Entry:
+    if not 0 <= i < self._count:
+      raise IndexError(i)
+    offset = self._index[i]
+    inode, size, mtime_ns, mode, nlink, key_len = _RECORD.unpack_from(
+        self._mmap, offset)
+    start = offset + _RECORD.size
+    return Entry(_from_key(self._mmap[start:start + key_len]), inode, size,
+                 mtime_ns, mode, nlink)
+
+  def __iter__(self) -> Iterator[Entry]:
+    for i in range(self._count):
+      yield self[i]
+
+  def bisect(self, path: str) -> int:
+    """Index of the first entry not sorting before path."""
+    key = path_key(path)
+    lo, hi = 0, self._count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._key(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def find(self, path: str) -> Optional[Entry]:
+    i = self.bisect(path)
+    if i < self._count and self._key(i) == path_key(path):
+      return self[i]
+    return None
+
+  def close(self) -> None:
+    self._index.release()
+    self._mmap.close()
+
+  def __enter__(self) -> 'Manifest':
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.close()
@@ -16,7 +16,7 @@ import dataclasses
 import json
 import os
 
-from typing import Optional
+from typing import Dict, Optional
 
 
 @dataclasses.dataclass
@@ -28,6 +28,14 @@ class Metadata:
   updated_epoch: Optional[int] = None
   # Duration after which this backup may be erased.
   min_ttl: Optional[float] = None
+  # Totals reported by rsync while creating the backup, see progress.py.
+  rsync_stats: Optional[Dict[str, float]] = None
+  # Bytes used, from `yaribak usage`. Valid while the backup path has the
+  # snapshots identified by usage_key.
+  usage: Optional[Dict[str, int]] = None
+  usage_key: Optional[str] = None
+  # Name of the archive holding the payload, once archived with `yaribak tier`.
+  archive: Optional[str] = None
 
   def last_updated(self) -> int:
     """Unlike updated_epoch, this is not None."""
@@ -0,0 +1,95 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs work over a directory tree with a bounded pool of threads.
+
+Most filesystem calls (scandir, link, unlink, lstat) release the GIL, so
+threads are enough to keep several requests in flight on the disk.
+"""
+
+import os
+import queue
+import threading
+
+from typing import Callable, Iterable, List, Optional, TypeVar
+
+T = TypeVar('T')
+
+# Default number of worker threads for tree operations.
+DEFAULT_WORKERS = min(16, 4 * (os.cpu_count() or 1))
+
+# Put in the queue to ask a worker to exit.
+_SENTINEL = object()
+
+
+def run(roots: Iterable[T],
+        visit: Callable[[T], Iterable[T]],
+        num_workers: int = DEFAULT_WORKERS,
+        stop: Optional[threading.Event] = None,
+        initializer: Optional[Callable[[], None]] = None) -> None:
+  """Calls visit() on every item reachable from roots.
+
+  Each visit() processes one item, typically a directory, and returns further
+  items to process, typically its subdirectories. Items are processed in
+  roughly depth-first order, which keeps the pending queue small.
+
+  If visit() raises, remaining items are skipped and the first exception is
+  re-raised. A caller may also set `stop` (e.g. from within visit()) to end
+  early without an error.
+
+  If given, initializer() is called at the start of each worker thread, as
+  with concurrent.futures.ThreadPoolExecutor.
+  """
+  if num_workers < 1:
+    raise ValueError(f'num_workers must be positive, got {num_workers}')
+  if stop is None:
+    stop = threading.Event()
+  pending: 'queue.LifoQueue[object]' = queue.LifoQueue()
+  errors: List[BaseException] = []
+
+  def worker() -> None:
+    if initializer is not None:
+      try:
+        initializer()
+      except BaseException as e:  # Re-raised in the calling thread.
+        errors.append(e)
+        stop.set()
+    while True:
+      item = pending.get()
+      try:
+        if item is _SENTINEL:
+          return
+        if stop.is_set():
+          continue
+        for child in visit(item):  # type: ignore
+          pending.put(child)
+      except BaseException as e:  # Re-raised in the calling thread.
+        errors.append(e)
+        stop.set()
+      finally:
+        pending.task_done()
+
+  for root in roots:
+    pending.put(root)
+  threads = [
+      threading.Thread(target=worker, daemon=True) for _ in range(num_workers)
+  ]
+  for thread in threads:
+    thread.start()
+  pending.join()
+  for _ in threads:
+    pending.put(_SENTINEL)
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0]
@@ -0,0 +1,106 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records the time and I/O taken by each phase of a backup.
+
+Each span records the wall time, the CPU time of this process (all threads)
+and of its child processes that exited, and the I/O counters in /proc/self/io,
+which also include exited child processes. Work by background threads, e.g.
+the reaper, is counted in whichever spans it overlaps.
+"""
+
+import contextlib
+import json
+import resource
+import time
+
+from typing import Any, Dict, Iterator, List
+
+_PROC_IO_FNAME = '/proc/self/io'
+
+
+def _read_io() -> Dict[str, int]:
+  """I/O counters of this process. Empty if not available."""
+  counters: Dict[str, int] = {}
+  try:
+    with open(_PROC_IO_FNAME) as f:
+      for line in f:
+        name, value = line.split(':')
+        counters[name] = int(value)
+  except OSError:
+    pass
+  return counters
+
+
+def _cpu_secs() -> Dict[str, float]:
+  own = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return {
+      'cpu_secs': own.ru_utime + own.ru_stime,
+      'children_cpu_secs': children.ru_utime + children.ru_stime,
+  }
+
+
+class Profiler:
+  """Collects spans. If not enabled, spans are not recorded."""
+
+  def __init__(self, enabled: bool = True):
+    self._enabled = enabled
+    self._start = time.monotonic()
+    self._start_epoch = time.time()
+    self._spans: List[Dict[str, Any]] = []
+
+  @contextlib.contextmanager
+  def span(self, name: str, detail: str = '') -> Iterator[None]:
+    if not self._enabled:
+      yield
+      return
+    start = time.monotonic()
+    cpu = _cpu_secs()
+    io = _read_io()
+    try:
+      yield
+    finally:
+      end_cpu = _cpu_secs()
+      end_io = _read_io()
+      record: Dict[str, Any] = {
+          'name': name,
+          'start_secs': round(start - self._start, 6),
+          'wall_secs': round(time.monotonic() - start, 6),
+      }
+      if detail:
+        record['detail'] = detail
+      for key in cpu:
+        record[key] = round(end_cpu[key] - cpu[key], 6)
+      record['io'] = {key: end_io[key] - io[key] for key in io if key in end_io}
+      self._spans.append(record)
+
+  def report(self) -> Dict[str, Any]:
+    """Spans in the order they started, and totals by name."""
+    spans = sorted(self._spans, key=lambda span: span['start_secs'])
+    totals: Dict[str, Dict[str, float]] = {}
+    for span in spans:
+      total = totals.setdefault(span['name'], {'count': 0, 'wall_secs': 0.0})
+      total['count'] += 1
+      total['wall_secs'] = round(total['wall_secs'] + span['wall_secs'], 6)
+    return {
+        'start_epoch': self._start_epoch,
+        'wall_secs': round(time.monotonic() - self._start, 6),
+        'spans': spans,
+        'totals': totals,
+    }
+
+  def write(self, fname: str) -> None:
+    with open(fname, 'w') as f:
+      json.dump(self.report(), f, indent=2)
+      f.write('\n')
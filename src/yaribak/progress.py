@@ -0,0 +1,208 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Parses rsync's progress and stats output, and exports them as metrics.
+
+With RSYNC_FLAGS, rsync prints an overall progress line every so often, ending
+with "\\r" instead of "\\n", and a block of totals when done. Metrics can be
+written as a node-exporter textfile, replaced atomically, and appended to a
+JSON-lines file.
+
+With several rsync processes (see --shards), the live metrics are those of
+whichever process printed last, while the totals are summed.
+"""
+
+import json
+import os
+import re
+import time
+
+from typing import Callable, Dict, Optional
+
+# Pass to rsync, to print the progress and totals.
+RSYNC_FLAGS = '--info=progress2,stats2'
+
+# E.g. "  1,234,567  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=34/567)".
+_PROGRESS_RE = re.compile(r'^\s*(?P<bytes>[\d,]+)\s+(?P<percent>\d+)%\s+'
+                          r'(?P<rate>[\d.,]+)(?P<unit>[kMGT]?B)/s\s+'
+                          r'(?P<eta>[\d?]+:[\d?]+:[\d?]+)'
+                          r'(?:\s+\(xfr#(?P<xfr>\d+), (?:ir|to)-chk='
+                          r'(?P<remaining>\d+)/(?P<total>\d+)\))?\s*$')
+_RATE_UNITS = {'B': 1, 'kB': 2**10, 'MB': 2**20, 'GB': 2**30, 'TB': 2**40}
+
+# Totals printed with stats2, by name in the metrics.
+_STATS = {
+    'Number of files': 'files',
+    'Number of regular files transferred': 'files_transferred',
+    'Total file size': 'total_size',
+    'Total transferred file size': 'transferred_size',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+# E.g. "Number of files: 1,234 (reg: 1,000, dir: 234)".
+_STATS_RE = re.compile(r'^(?P<name>[A-Z][a-z ]+): (?P<value>[\d,]+)\b')
+# Other lines printed with stats2.
+_OTHER_STATS_RE = re.compile(r'^([A-Z][a-z ]+: |sent [\d,]+ bytes|'
+                             r'total size is )')
+
+_METRIC_PREFIX = 'yaribak_rsync_'
+
+
+def _parse_number(text: str) -> float:
+  return float(text.replace(',', ''))
+
+
+def _parse_eta(text: str) -> Optional[float]:
+  if '?' in text:
+    return None
+  hours, minutes, seconds = (int(part) for part in text.split(':'))
+  return hours * 3600 + minutes * 60 + seconds
+
+
+def parse_progress(line: str) -> Optional[Dict[str, float]]:
+  """Metrics in a progress line, or None if it is not one."""
+  m = _PROGRESS_RE.match(line)
+  if not m:
+    return None
+  metrics = {
+      'bytes_transferred': _parse_number(m.group('bytes')),
+      'percent': float(m.group('percent')),
+      'bytes_per_sec':
+          _parse_number(m.group('rate')) * _RATE_UNITS[m.group('unit')],
+  }
+  eta = _parse_eta(m.group('eta'))
+  if eta is not None:
+    metrics['eta_secs'] = eta
+  if m.group('xfr') is not None:
+    total = int(m.group('total'))
+    metrics['files_transferred'] = float(m.group('xfr'))
+    metrics['files_checked'] = float(total - int(m.group('remaining')))
+    metrics['files_total'] = float(total)
+  return metrics
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+  if not labels:
+    return ''
+  escaped = (f'{key}="{json.dumps(value)[1:-1]}"'
+             for key, value in sorted(labels.items()))
+  return '{' + ','.join(escaped) + '}'
+
+
+class MetricsWriter:
+  """Writes metrics to a textfile and/or a JSON-lines file, if given."""
+
+  def __init__(self,
+               textfile: Optional[str] = None,
+               jsonl: Optional[str] = None,
+               labels: Optional[Dict[str, str]] = None,
+               interval_secs: float = 5.0):
+    self._textfile = textfile
+    self._jsonl = jsonl
+    self._labels = labels or {}
+    self._interval_secs = interval_secs
+    self._last_write: Optional[float] = None
+
+  def write(self, metrics: Dict[str, float], force: bool = False) -> None:
+    """Writes, unless the last write was less than interval_secs ago."""
+    now = time.monotonic()
+    if not force and self._last_write is not None:
+      if now - self._last_write < self._interval_secs:
+        return
+    self._last_write = now
+    metrics = dict(metrics, timestamp=time.time())
+    if self._textfile is not None:
+      self._write_textfile(metrics)
+    if self._jsonl is not None:
+      record = json.dumps(dict(self._labels, **metrics), sort_keys=True)
+      with open(self._jsonl, 'a') as f:
+        f.write(record + '\n')
+
+  def _write_textfile(self, metrics: Dict[str, float]) -> None:
+    assert self._textfile is not None
+    labels = _format_labels(self._labels)
+    lines = []
+    for name, value in sorted(metrics.items()):
+      lines.append(f'# TYPE {_METRIC_PREFIX}{name} gauge')
+      lines.append(f'{_METRIC_PREFIX}{name}{labels} {value}')
+    # The exporter ignores files without the .prom extension.
+    tmp_fname = self._textfile + '.tmp'
+    with open(tmp_fname, 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_fname, self._textfile)
+
+
+class ProgressTracker:
+  """Consumes lines of rsync output, and keeps track of progress.
+
+  Other lines are passed on to output_handler. If on_progress is given, it is
+  called with the metrics of each progress line.
+  """
+
+  def __init__(self,
+               output_handler: Optional[Callable[[str], None]] = None,
+               writer: Optional[MetricsWriter] = None,
+               on_progress: Optional[Callable[[Dict[str, float]],
+                                              None]] = None):
+    self._output_handler = output_handler
+    self._writer = writer
+    self._on_progress = on_progress
+    self._start = time.monotonic()
+    self.latest: Dict[str, float] = {}
+    self._totals: Dict[str, float] = {}
+
+  def __call__(self, line: str) -> None:
+    metrics = parse_progress(line)
+    if metrics is not None:
+      elapsed = time.monotonic() - self._start
+      metrics['elapsed_secs'] = elapsed
+      if 'files_transferred' in metrics and elapsed > 0:
+        metrics['files_per_sec'] = metrics['files_transferred'] / elapsed
+      self.latest = metrics
+      if self._writer is not None:
+        self._writer.write(dict(metrics, done=0))
+      if self._on_progress is not None:
+        self._on_progress(metrics)
+      return
+    m = _STATS_RE.match(line)
+    if m and m.group('name') in _STATS:
+      key = _STATS[m.group('name')]
+      value = _parse_number(m.group('value'))
+      self._totals[key] = self._totals.get(key, 0) + value
+      return
+    if _OTHER_STATS_RE.match(line):
+      return
+    if self._output_handler is not None:
+      self._output_handler(line)
+
+  def totals(self) -> Dict[str, float]:
+    """Totals of the run so far, with rates over the whole run."""
+    totals = dict(self._totals)
+    seconds = time.monotonic() - self._start
+    totals['seconds'] = round(seconds, 3)
+    if seconds > 0:
+      totals['bytes_per_sec'] = round(
+          totals.get('transferred_size', 0) / seconds, 3)
+      totals['files_per_sec'] = round(
+          totals.get('files_transferred', 0) / seconds, 3)
+    if totals.get('total_size'):
+      totals['transfer_ratio'] = round(
+          totals.get('transferred_size', 0) / totals['total_size'], 6)
+    return totals
+
+  def finish(self) -> Dict[str, float]:
+    """Writes the final metrics, and returns the totals."""
+    totals = self.totals()
+    if self._writer is not None:
+      self._writer.write(dict(self.latest, **totals, done=1), force=True)
+    return totals
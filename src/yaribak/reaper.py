@@ -0,0 +1,164 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Deletes expired snapshots in two steps.
+
+First, the snapshot is atomically renamed into a trash directory under the
+backup path. This is instant, and the snapshot stops being visible as a backup.
+
+Later, a reaper unlinks everything in the trash with a pool of low priority
+threads. The reaper only ever removes what it finds, so after a crash it can
+simply be run again.
+"""
+
+import dataclasses
+import logging
+import os
+import stat
+import threading
+import time
+
+from typing import List, Optional
+
+from . import parallel_walk
+from . import utils
+
+# Name of the trash directory, under the backup path.
+TRASH_DIR = '.trash'
+
+
+@dataclasses.dataclass
+class ReapStats:
+  # Directory entries removed.
+  entries: int = 0
+  # Inodes freed, i.e. entries that were the last link to their inode.
+  inodes: int = 0
+  # Disk space of the freed inodes.
+  bytes: int = 0
+  seconds: float = 0.0
+
+  def add(self, other: 'ReapStats') -> None:
+    self.entries += other.entries
+    self.inodes += other.inodes
+    self.bytes += other.bytes
+
+  def __str__(self) -> str:
+    return (f'removed {self.entries} entries, freed {self.inodes} inodes '
+            f'and {self.bytes / 2**20:0.1f} MiB in {self.seconds:0.2f}s')
+
+
+def trash_dir(target: str) -> str:
+  return os.path.join(target, TRASH_DIR)
+
+
+def move_to_trash(target: str, folder: str) -> str:
+  """Renames folder into the trash, and returns the new path."""
+  trash = trash_dir(target)
+  os.makedirs(trash, exist_ok=True)
+  name = os.path.basename(folder)
+  dest = os.path.join(trash, name)
+  suffix = 0
+  while os.path.lexists(dest):
+    suffix += 1
+    dest = os.path.join(trash, f'{name}_{suffix}')
+  os.rename(folder, dest)
+  return dest
+
+
+def _freed(st: os.stat_result) -> ReapStats:
+  """Stats for removing one entry, given its stat from just before."""
+  # An empty directory still has 2 links, "." and the parent's entry.
+  if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+    return ReapStats(entries=1)
+  return ReapStats(entries=1, inodes=1, bytes=st.st_blocks * 512)
+
+
+def reap(target: str,
+         num_workers: int = parallel_walk.DEFAULT_WORKERS) -> ReapStats:
+  """Removes everything in the trash, if any."""
+  start = time.monotonic()
+  stats = ReapStats()
+  stats_lock = threading.Lock()
+  trash = trash_dir(target)
+  if not os.path.isdir(trash):
+    return stats
+  # All directories seen, to be removed once they are empty.
+  directories: List[str] = []
+
+  def visit(path: str) -> List[str]:
+    subdirs: List[str] = []
+    dir_stats = ReapStats()
+    try:
+      with os.scandir(path) as it:
+        for entry in it:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              subdirs.append(entry.path)
+              continue
+            st = entry.stat(follow_symlinks=False)
+            os.unlink(entry.path)
+          except FileNotFoundError:
+            # Removed by a concurrent reaper.
+            continue
+          dir_stats.add(_freed(st))
+    except FileNotFoundError:
+      pass
+    with stats_lock:
+      stats.add(dir_stats)
+      directories.extend(subdirs)
+    return subdirs
+
+  parallel_walk.run([trash],
+                    visit,
+                    num_workers=num_workers,
+                    initializer=utils.lower_thread_priority)
+
+  # Deepest first, so that each directory is empty when removed.
+  directories.sort(key=lambda path: path.count(os.sep), reverse=True)
+  for path in directories:
+    try:
+      st = os.lstat(path)
+      os.rmdir(path)
+    except FileNotFoundError:
+      continue
+    stats.add(_freed(st))
+
+  stats.seconds = time.monotonic() - start
+  return stats
+
+
+class BackgroundReaper:
+  """Runs reap() in a background thread."""
+
+  def __init__(self, target: str):
+    self._target = target
+    self._stats: Optional[ReapStats] = None
+    self._error: Optional[BaseException] = None
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def _run(self) -> None:
+    try:
+      self._stats = reap(self._target)
+    except BaseException as e:  # Re-raised in join().
+      self._error = e
+
+  def start(self) -> None:
+    logging.info(f'Reaping {trash_dir(self._target)} in the background.')
+    self._thread.start()
+
+  def join(self) -> ReapStats:
+    self._thread.join()
+    if self._error is not None:
+      raise self._error
+    assert self._stats is not None
+    return self._stats
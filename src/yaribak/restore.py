@@ -0,0 +1,449 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Restores files from a snapshot, in parallel.
+
+Paths to restore are globs relative to the payload, matched one component at
+a time as in a shell. Only directories that may contain matches are walked, so
+restoring one directory does not walk the rest of the snapshot. Parents of
+restored paths are created if missing, with default permissions.
+
+Like rsync's quick check, files at the destination with the same size, mtime
+and mode are skipped, and when running as root also the same owner. Files hard
+linked to each other in the snapshot are hard linked at the destination too.
+Each file is written under a temporary name and renamed, so an interrupted
+restore leaves no partial files.
+
+Large files kept in the chunk store (see chunks.py) are restored from their
+blocks, after the rest of the snapshot.
+"""
+
+import collections
+import concurrent.futures
+import dataclasses
+import fnmatch
+import logging
+import os
+import re
+import stat
+import threading
+import time
+
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+from . import archive
+from . import catalog
+from . import chunks
+from . import copier
+from . import parallel_walk
+
+# Characters that make a path component a glob.
+_GLOB_RE = re.compile(r'[*?[]')
+
+# Files being restored from an archive per worker, at most.
+_PENDING_PER_WORKER = 4
+
+
+@dataclasses.dataclass
+class RestoreStats:
+  files: int = 0
+  directories: int = 0
+  # Symlinks, special files, and files hard linked to another restored file.
+  links: int = 0
+  # Files already identical at the destination.
+  skipped: int = 0
+  bytes: int = 0
+  seconds: float = 0.0
+
+  @property
+  def bytes_per_sec(self) -> float:
+    if self.seconds <= 0:
+      return 0.0
+    return self.bytes / self.seconds
+
+
+def resolve_snapshot(names: List[str], which: str) -> str:
+  """Snapshot name for 'latest', a full name, or the timestamp in a name."""
+  if not names:
+    raise ValueError('There are no snapshots')
+  if which == 'latest':
+    return names[-1]
+  for name in [which, catalog.SNAPSHOT_DIR_PREFIX + which]:
+    if name in names:
+      return name
+  raise ValueError(f'No snapshot named {which!r}')
+
+
+class Selector:
+  """Matches relative paths against globs, one component at a time."""
+
+  def __init__(self, patterns: List[str]):
+    self._patterns = [_split(pattern) for pattern in patterns]
+
+  def roots(self) -> List[str]:
+    """Paths to start from, i.e. the literal leading part of each glob."""
+    if not self._patterns:
+      return ['']
+    roots = set()
+    for parts in self._patterns:
+      literal = []
+      for part in parts:
+        if _GLOB_RE.search(part):
+          break
+        literal.append(part)
+      roots.add('/'.join(literal))
+    # Skip roots that are within another.
+    kept: List[str] = []
+    for root in sorted(roots):
+      if not any(_is_within(root, other) for other in kept):
+        kept.append(root)
+    return kept
+
+  def selects(self, relpath: str) -> bool:
+    """True if the path matches, or is within a path that matches."""
+    if not self._patterns:
+      return True
+    parts = _split(relpath)
+    return any(
+        len(pattern) <= len(parts) and _match(parts, pattern)
+        for pattern in self._patterns)
+
+  def may_contain(self, relpath: str) -> bool:
+    """True if paths within this directory may be selected."""
+    parts = _split(relpath)
+    return any(
+        len(pattern) > len(parts) and _match(parts, pattern)
+        for pattern in self._patterns)
+
+
+def _split(path: str) -> List[str]:
+  return [part for part in path.split('/') if part]
+
+
+def _is_within(path: str, directory: str) -> bool:
+  return not directory or path == directory or path.startswith(directory + '/')
+
+
+def _match(parts: List[str], pattern: List[str]) -> bool:
+  """True if the leading components of pattern match parts."""
+  return all(
+      fnmatch.fnmatchcase(part, glob) for part, glob in zip(parts, pattern))
+
+
+def _tmp_path(path: str) -> str:
+  """Temporary name to create path with, removing any left from before."""
+  head, tail = os.path.split(path)
+  tmp_path = os.path.join(head, f'.{tail}.yaribak_tmp')
+  if os.path.lexists(tmp_path):
+    os.remove(tmp_path)
+  return tmp_path
+
+
+def _is_identical(path: str, size: int, attrs: copier.Attrs) -> bool:
+  """Quick check of a file at the destination, as in rsync."""
+  try:
+    st = os.lstat(path)
+  except FileNotFoundError:
+    return False
+  if not stat.S_ISREG(st.st_mode):
+    return False
+  if st.st_size != size or st.st_mtime_ns != attrs.mtime_ns:
+    return False
+  if stat.S_IMODE(st.st_mode) != stat.S_IMODE(attrs.mode):
+    return False
+  # Owners can only be set as root.
+  return os.geteuid() != 0 or (st.st_uid, st.st_gid) == (attrs.uid, attrs.gid)
+
+
+class _Restorer:
+  """Creates entries at the destination. Methods may be called from threads.
+
+  Entries are created with temporary names and renamed into place. Directory
+  metadata is set at the end, since creating entries changes their mtime.
+  """
+
+  def __init__(self, dest: str):
+    self._dest = dest
+    self._lock = threading.Lock()
+    self.stats = RestoreStats()
+    # Key of a hard linked group of files, to the first one restored.
+    self._first_links: Dict[int, str] = {}
+    self._pending_links: List[Tuple[str, str]] = []
+    self._directories: List[Tuple[str, copier.Attrs]] = []
+
+  def _path(self, relpath: str) -> str:
+    return os.path.join(self._dest, relpath)
+
+  def make_parent(self, relpath: str) -> None:
+    """Creates the parent of a path, if it is not restored itself."""
+    os.makedirs(os.path.dirname(self._path(relpath)), exist_ok=True)
+
+  def directory(self, relpath: str, attrs: copier.Attrs) -> None:
+    path = self._path(relpath)
+    if os.path.lexists(path) and not os.path.isdir(path):
+      os.remove(path)
+    os.makedirs(path, exist_ok=True)
+    with self._lock:
+      self._directories.append((relpath, attrs))
+      self.stats.directories += 1
+
+  def file(self, relpath: str, attrs: copier.Attrs, size: int,
+           link_key: Optional[int], copy_fn: Callable[[str], int]) -> None:
+    """Restores a regular file, written by copy_fn(path) if not identical.
+
+    Files with the same link_key are restored as hard links to each other.
+    """
+    if link_key is not None:
+      with self._lock:
+        first = self._first_links.setdefault(link_key, relpath)
+        if first != relpath:
+          self._pending_links.append((relpath, first))
+          return
+    path = self._path(relpath)
+    if _is_identical(path, size, attrs):
+      with self._lock:
+        self.stats.skipped += 1
+      return
+    tmp_path = _tmp_path(path)
+    copied = copy_fn(tmp_path)
+    copier.set_metadata(tmp_path, attrs)
+    os.replace(tmp_path, path)
+    with self._lock:
+      self.stats.files += 1
+      self.stats.bytes += copied
+
+  def symlink(self, relpath: str, attrs: copier.Attrs, target: str) -> None:
+    tmp_path = _tmp_path(self._path(relpath))
+    os.symlink(target, tmp_path)
+    copier.set_metadata(tmp_path, attrs)
+    os.replace(tmp_path, self._path(relpath))
+    with self._lock:
+      self.stats.links += 1
+
+  def special(self, relpath: str, attrs: copier.Attrs, device: int) -> None:
+    """Recreates a device, fifo or socket, if permitted."""
+    tmp_path = _tmp_path(self._path(relpath))
+    try:
+      os.mknod(tmp_path, attrs.mode, device)
+    except PermissionError as e:
+      logging.warning(f'Skipping {relpath}: {e}')
+      return
+    copier.set_metadata(tmp_path, attrs)
+    os.replace(tmp_path, self._path(relpath))
+    with self._lock:
+      self.stats.links += 1
+
+  def finish(self) -> None:
+    """Creates hard links, and sets directory metadata."""
+    for relpath, first in self._pending_links:
+      path = self._path(relpath)
+      if os.path.lexists(path) and os.path.samefile(path, self._path(first)):
+        self.stats.skipped += 1
+        continue
+      tmp_path = _tmp_path(path)
+      os.link(self._path(first), tmp_path)
+      os.replace(tmp_path, path)
+      self.stats.links += 1
+    for relpath, attrs in self._directories:
+      copier.set_metadata(self._path(relpath), attrs)
+
+
+class _Item(NamedTuple):
+  relpath: str
+  st: os.stat_result
+
+
+def _restore_payload(payload: str, restorer: _Restorer, selector: Selector,
+                     num_workers: int) -> List[str]:
+  """Restores the selected entries. Returns the roots not in the payload."""
+
+  def restore_entry(item: _Item) -> None:
+    src = os.path.join(payload, item.relpath)
+    attrs = copier.Attrs.of(src, item.st)
+    if stat.S_ISDIR(item.st.st_mode):
+      restorer.directory(item.relpath, attrs)
+    elif stat.S_ISREG(item.st.st_mode):
+      link_key = item.st.st_ino if item.st.st_nlink > 1 else None
+      restorer.file(item.relpath, attrs, item.st.st_size, link_key,
+                    lambda dst: copier.copy_file(src, dst))
+    elif stat.S_ISLNK(item.st.st_mode):
+      restorer.symlink(item.relpath, attrs, os.readlink(src))
+    else:
+      restorer.special(item.relpath, attrs, item.st.st_rdev)
+
+  def visit(item: _Item) -> List[_Item]:
+    """Restores the item if selected, and lists what to visit next.
+
+    Files are returned as items of their own, so that the workers copy the
+    files of a large directory in parallel.
+    """
+    is_dir = stat.S_ISDIR(item.st.st_mode)
+    selected = selector.selects(item.relpath)
+    if selected or not is_dir:
+      restore_entry(item)
+    if not is_dir or not (selected or selector.may_contain(item.relpath)):
+      return []
+    children = []
+    made_dir = selected
+    with os.scandir(os.path.join(payload, item.relpath)) as it:
+      for entry in it:
+        relpath = os.path.join(item.relpath, entry.name)
+        st = entry.stat(follow_symlinks=False)
+        if stat.S_ISDIR(st.st_mode):
+          wanted = selected or selector.selects(relpath)
+          if wanted or selector.may_contain(relpath):
+            children.append(_Item(relpath, st))
+        elif selected or selector.selects(relpath):
+          if not made_dir:
+            restorer.make_parent(relpath)
+            made_dir = True
+          children.append(_Item(relpath, st))
+    return children
+
+  roots = []
+  missing = []
+  for root in selector.roots():
+    try:
+      roots.append(_Item(root, os.lstat(os.path.join(payload, root))))
+    except FileNotFoundError:
+      missing.append(root)
+      continue
+    restorer.make_parent(root)
+  parallel_walk.run(roots, visit, num_workers=num_workers)
+  return missing
+
+
+def _restore_chunked(maps: str, store: str, restorer: _Restorer,
+                     selector: Selector, num_workers: int) -> List[str]:
+  """Restores the selected files of the chunk store.
+
+  Their directories are restored with the payload. Returns the roots that
+  have no such files.
+  """
+
+  def visit(item: _Item) -> List[_Item]:
+    path = os.path.join(maps, item.relpath)
+    if not stat.S_ISDIR(item.st.st_mode):
+      restorer.make_parent(item.relpath)
+      restorer.file(item.relpath, copier.Attrs.of(path, item.st),
+                    chunks.read_size(path), None,
+                    lambda dst: chunks.restore_file(path, store, dst))
+      return []
+    children = []
+    with os.scandir(path) as it:
+      for entry in it:
+        relpath = os.path.join(item.relpath, entry.name)
+        st = entry.stat(follow_symlinks=False)
+        if stat.S_ISDIR(st.st_mode):
+          if selector.selects(relpath) or selector.may_contain(relpath):
+            children.append(_Item(relpath, st))
+        elif selector.selects(relpath):
+          children.append(_Item(relpath, st))
+    return children
+
+  roots = []
+  missing = []
+  for root in selector.roots():
+    try:
+      roots.append(_Item(root, os.lstat(os.path.join(maps, root))))
+    except FileNotFoundError:
+      missing.append(root)
+  parallel_walk.run(roots, visit, num_workers=num_workers)
+  return missing
+
+
+def _entry_attrs(entry: archive.Entry) -> copier.Attrs:
+  # Archives do not keep the access time.
+  return copier.Attrs(entry.mode, entry.uid, entry.gid, entry.mtime_ns,
+                      entry.mtime_ns, entry.xattrs)
+
+
+def _restore_archive(reader: archive.Archive, restorer: _Restorer,
+                     selector: Selector, num_workers: int) -> None:
+
+  def restore_entry(entry: archive.Entry) -> None:
+    attrs = _entry_attrs(entry)
+    if entry.kind == archive.FILE:
+
+      def write(dst: str) -> int:
+        with open(dst, 'xb') as f:
+          for chunk in reader.read(entry):
+            f.write(chunk)
+        return entry.size
+
+      restorer.file(entry.path, attrs, entry.size, None, write)
+    elif entry.kind == archive.REFERENCE:
+      ref = reader.ref_path(entry)
+      restorer.file(entry.path, attrs, entry.size, entry.data,
+                    lambda dst: copier.copy_file(ref, dst))
+    elif entry.kind == archive.SYMLINK:
+      restorer.symlink(entry.path, attrs, entry.target)
+    else:
+      restorer.special(entry.path, attrs, entry.data)
+
+  pending: Deque[concurrent.futures.Future] = collections.deque()
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    for root in selector.roots():
+      restorer.make_parent(root)
+      for entry in reader.subtree(root):
+        if not selector.selects(entry.path):
+          continue
+        if not selector.selects(os.path.dirname(entry.path)):
+          restorer.make_parent(entry.path)
+        # Entries are sorted, so directories are created before their
+        # contents.
+        if entry.kind == archive.DIRECTORY:
+          restorer.directory(entry.path, _entry_attrs(entry))
+          continue
+        pending.append(executor.submit(restore_entry, entry))
+        if len(pending) > _PENDING_PER_WORKER * num_workers:
+          pending.popleft().result()
+    while pending:
+      pending.popleft().result()
+
+
+def restore(target: str,
+            snapshot: catalog.Snapshot,
+            dest: str,
+            patterns: List[str],
+            num_workers: int = parallel_walk.DEFAULT_WORKERS) -> RestoreStats:
+  """Restores paths selected by patterns, or everything, from the snapshot.
+
+  Paths in the destination are the same as in the payload.
+  """
+  start = time.monotonic()
+  directory = os.path.join(target, snapshot.name)
+  selector = Selector(patterns)
+  os.makedirs(dest, exist_ok=True)
+  restorer = _Restorer(dest)
+  missing = set(selector.roots())
+  if snapshot.metadata.archive is None:
+    missing &= set(
+        _restore_payload(os.path.join(directory, 'payload'), restorer,
+                         selector, num_workers))
+  else:
+    fname = os.path.join(directory, snapshot.metadata.archive)
+    refs_dir = os.path.join(directory, archive.REFS_DIR)
+    with archive.Archive(fname, refs_dir) as reader:
+      _restore_archive(reader, restorer, selector, num_workers)
+    missing = set()
+  maps = os.path.join(directory, chunks.MAPS_DIR)
+  if os.path.isdir(maps):
+    missing &= set(
+        _restore_chunked(maps, chunks.store_dir(target), restorer, selector,
+                         num_workers))
+  for root in sorted(missing):
+    logging.warning(f'Not in the snapshot: {root}')
+  restorer.finish()
+  restorer.stats.seconds = time.monotonic() - start
+  return restorer.stats
@@ -0,0 +1,72 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tracks the progress of a snapshot being created, so that it can be resumed.
+
+The state is kept in the incomplete snapshot, and is updated after each phase.
+A backup that is stopped leaves it behind, and the next backup continues from
+the last phase done if it would start from the same base snapshot.
+"""
+
+import dataclasses
+import json
+import logging
+import os
+
+from typing import List, Optional
+
+STATE_FNAME = 'resume_state.json'
+
+# Phases recorded in the state.
+CLONE = 'clone'
+SEED = 'seed'
+RSYNC = 'rsync'
+
+
+@dataclasses.dataclass
+class ResumeState:
+  source: str
+  # Name of the snapshot cloned, or None for the first backup.
+  base: Optional[str]
+  snapshot_strategy: str
+  # Phases done, in order.
+  phases: List[str] = dataclasses.field(default_factory=list)
+  # Whether changes listed before a stop were lost, e.g. if it was killed. If
+  # so, the snapshot gets no changelog.
+  changelog_lost: bool = False
+
+  def same_backup(self, other: 'ResumeState') -> bool:
+    """Whether both are for the same source, base and strategy."""
+    return (self.source, self.base,
+            self.snapshot_strategy) == (other.source, other.base,
+                                        other.snapshot_strategy)
+
+  def save_to(self, fname: str) -> None:
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+      f.write(json.dumps(dataclasses.asdict(self), indent=True,
+                         sort_keys=True))
+    # Atomic, so that a stop while saving leaves the previous state.
+    os.replace(tmp_fname, fname)
+
+  @staticmethod
+  def load_from(fname: str) -> Optional['ResumeState']:
+    """Returns the state saved in fname, or None if missing or unreadable."""
+    try:
+      with open(fname) as f:
+        return ResumeState(**json.load(f))
+    except FileNotFoundError:
+      return None
+    except (ValueError, TypeError) as e:
+      logging.warning(f'Ignoring unreadable {fname}: {e}')
+      return None
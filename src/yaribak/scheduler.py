@@ -0,0 +1,207 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs many backup jobs concurrently, from a config file.
+
+The config is JSON, e.g. -
+  {
+    "max_per_device": 1,
+    "jobs": [
+      {"name": "home", "source": "/home", "backup_path": "/mnt/b/home",
+       "minimum_wait": "1day", "max_to_keep": 10, "exclude": ["*/.cache"]}
+    ]
+  }
+
+Each job takes the same options as a backup, with "_" in place of "-". At most
+max_per_device jobs run at once on any device holding a source or a backup
+path. The most overdue jobs, by time since their last backup relative to
+minimum_wait, start first. Jobs are named by "name", or else by their
+backup_path, and names must be unique.
+"""
+
+import collections
+import dataclasses
+import json
+import logging
+import math
+import os
+import threading
+import time
+import traceback
+
+from typing import Any, Callable, Dict, List, Optional, Set
+
+# Statuses of a job in the report.
+DONE = 'done'
+FAILED = 'failed'
+NOT_DUE = 'not due'
+
+
+@dataclasses.dataclass
+class Config:
+  jobs: List[Dict[str, Any]]
+  max_per_device: int = 1
+
+
+def load_config(fname: str) -> Config:
+  with open(fname) as f:
+    data = json.load(f)
+  if not isinstance(data, dict) or not isinstance(data.get('jobs'), list):
+    raise ValueError(f'{fname}: expected an object with a list of "jobs"')
+  unknown = set(data) - {'jobs', 'max_per_device'}
+  if unknown:
+    raise ValueError(f'{fname}: unknown keys {sorted(unknown)}')
+  config = Config(**data)
+  if config.max_per_device < 1:
+    raise ValueError(f'{fname}: max_per_device must be positive')
+  names: Set[str] = set()
+  for job in config.jobs:
+    if not isinstance(job, dict):
+      raise ValueError(f'{fname}: each job must be an object')
+    job.setdefault('name', job.get('backup_path'))
+    if not isinstance(job['name'], str):
+      raise ValueError(f'{fname}: each job needs a "name" or "backup_path"')
+    if job['name'] in names:
+      raise ValueError(f'{fname}: duplicate job {job["name"]!r}')
+    names.add(job['name'])
+  return config
+
+
+@dataclasses.dataclass
+class Job:
+  name: str
+  run: Callable[[], None]
+  # Devices (st_dev) used by the job.
+  devices: Set[int]
+  # Seconds since the last backup, or None if there is none.
+  elapsed_secs: Optional[float]
+  minimum_wait_secs: float
+  # Set if the job cannot run, e.g. if its source is missing. It is reported
+  # as failed.
+  error: Optional[str] = None
+
+  def overdue_ratio(self) -> float:
+    """Elapsed time relative to minimum_wait; due if at least 1."""
+    if self.elapsed_secs is None or self.minimum_wait_secs <= 0:
+      return math.inf
+    return self.elapsed_secs / self.minimum_wait_secs
+
+
+def make_job(name: str, run: Callable[[], None], paths: List[str],
+             elapsed_secs: Callable[[], Optional[float]],
+             minimum_wait_secs: float) -> Job:
+  """A job using the devices of paths, e.g. its source and backup path.
+
+  If those devices or the time since the last backup cannot be found, the job
+  is reported as failed, and other jobs still run.
+  """
+  try:
+    devices = {device_of(path) for path in paths}
+    elapsed = elapsed_secs()
+  except Exception as e:  # Reported, and other jobs continue.
+    logging.error(f'Job {name} cannot run:\n{traceback.format_exc()}')
+    return Job(name, run, set(), None, minimum_wait_secs, error=repr(e))
+  return Job(name, run, devices, elapsed, minimum_wait_secs)
+
+
+@dataclasses.dataclass
+class JobResult:
+  name: str
+  status: str
+  seconds: float = 0.0
+  error: Optional[str] = None
+
+
+def _run_one(job: Job) -> JobResult:
+  start = time.monotonic()
+  try:
+    job.run()
+  except Exception as e:  # Reported, and other jobs continue.
+    logging.error(f'Job {job.name} failed:\n{traceback.format_exc()}')
+    return JobResult(job.name, FAILED, time.monotonic() - start, repr(e))
+  return JobResult(job.name, DONE, time.monotonic() - start)
+
+
+def run_jobs(jobs: List[Job], max_per_device: int) -> List[JobResult]:
+  """Runs the jobs that are due, and returns results in priority order.
+
+  Job names must be unique.
+  """
+  if max_per_device < 1:
+    raise ValueError(f'max_per_device must be positive, got {max_per_device}')
+  counts = collections.Counter(job.name for job in jobs)
+  duplicates = sorted(name for name, count in counts.items() if count > 1)
+  if duplicates:
+    raise ValueError(f'Duplicate job names: {duplicates}')
+  jobs = sorted(jobs, key=lambda job: job.overdue_ratio(), reverse=True)
+  results: Dict[str, JobResult] = {}
+  pending: List[Job] = []
+  for job in jobs:
+    if job.error is not None:
+      results[job.name] = JobResult(job.name, FAILED, error=job.error)
+    elif job.overdue_ratio() < 1:
+      results[job.name] = JobResult(job.name, NOT_DUE)
+    else:
+      pending.append(job)
+
+  # Number of running jobs on each device.
+  busy: 'collections.Counter[int]' = collections.Counter()
+  condition = threading.Condition()
+  threads: List[threading.Thread] = []
+
+  def worker(job: Job) -> None:
+    result = _run_one(job)
+    with condition:
+      results[job.name] = result
+      busy.subtract(job.devices)
+      condition.notify_all()
+
+  with condition:
+    while pending:
+      # The first due job whose devices all have room. Less overdue jobs may
+      # start before others, if those are waiting on a different device.
+      startable = next((job for job in pending
+                        if all(busy[d] < max_per_device for d in job.devices)),
+                       None)
+      if startable is None:
+        condition.wait()
+        continue
+      pending.remove(startable)
+      busy.update(startable.devices)
+      logging.info(f'Starting job {startable.name}.')
+      thread = threading.Thread(target=worker, args=(startable,))
+      thread.start()
+      threads.append(thread)
+  for thread in threads:
+    thread.join()
+  return [results[job.name] for job in jobs]
+
+
+def device_of(path: str) -> int:
+  return os.stat(path).st_dev
+
+
+def report(results: List[JobResult]) -> str:
+  """Summary of all jobs, one per line."""
+  width = max([len(result.name) for result in results] + [3])
+  lines = [f'{"Job":<{width}}  {"Status":<8} {"Time":>9}']
+  for result in results:
+    line = (f'{result.name:<{width}}  {result.status:<8} '
+            f'{result.seconds:>8.1f}s')
+    if result.error is not None:
+      line += f'  {result.error}'
+    lines.append(line)
+  counts = collections.Counter(result.status for result in results)
+  lines.append(', '.join(f'{counts[status]} {status}'
+                         for status in (DONE, FAILED, NOT_DUE)))
+  return '\n'.join(lines)
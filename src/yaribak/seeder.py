@@ -0,0 +1,181 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Copies a whole source in-process, to seed the first backup.
+
+A single rsync copies one file at a time, through its own buffers. Here a pool
+of threads copies many files at once, with the data staying in the kernel (see
+copier.py), which is much faster on disks that serve many requests at a time.
+Owners, modes, xattrs (which hold ACLs) and times are copied, and files hard
+linked to each other in the source are hard linked in the copy.
+
+The copy is not a backup by itself. Rsync runs over it after, as usual, which
+copies anything that changed during the seed and anything the seed skipped.
+"""
+
+import dataclasses
+import logging
+import os
+import stat
+import threading
+import time
+
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from . import changelog
+from . import copier
+from . import exclusion
+from . import parallel_walk
+
+
+@dataclasses.dataclass
+class SeedStats:
+  files: int = 0
+  directories: int = 0
+  # Symlinks, special files, and files hard linked to another copied file.
+  links: int = 0
+  # Data copied, not counting holes of sparse files.
+  bytes: int = 0
+  seconds: float = 0.0
+
+  @property
+  def bytes_per_sec(self) -> float:
+    if self.seconds <= 0:
+      return 0.0
+    return self.bytes / self.seconds
+
+  def __str__(self) -> str:
+    return (f'copied {self.files} files, {self.directories} directories and '
+            f'{self.links} links, {self.bytes / 2**20:0.1f} MiB in '
+            f'{self.seconds:0.2f}s ({self.bytes_per_sec / 2**20:0.1f} MiB/s)')
+
+
+class _Item(NamedTuple):
+  relpath: str
+  st: os.stat_result
+
+
+def seed_tree(source: str,
+              dest: str,
+              excludes: List[str],
+              num_workers: int = parallel_walk.DEFAULT_WORKERS,
+              max_size: Optional[int] = None,
+              initializer: Optional[Callable[[], None]] = None,
+              on_change: Optional[Callable[[changelog.Change], None]] = None
+              ) -> SeedStats:
+  """Copies the contents of source into dest, which must not exist.
+
+  Files larger than max_size, if given, are skipped as rsync's --max-size does.
+
+  If given, initializer() is called at the start of each worker thread, and
+  on_change() with each entry copied, as an added change. Both may be called
+  from several threads at once.
+  """
+  start = time.monotonic()
+  stats = SeedStats()
+  lock = threading.Lock()
+  excluder = exclusion.Excluder(excludes)
+  # Inode of a hard linked group of files, to the first one copied.
+  first_links: Dict[Tuple[int, int], str] = {}
+  pending_links: List[Tuple[str, str]] = []
+  directories: List[Tuple[str, copier.Attrs]] = []
+
+  def added(relpath: str, st: os.stat_result) -> None:
+    if on_change is None:
+      return
+    if stat.S_ISDIR(st.st_mode):
+      on_change(changelog.Change(changelog.ADDED, relpath + '/', st.st_size))
+    else:
+      on_change(changelog.Change(changelog.ADDED, relpath, st.st_size))
+
+  def copy_entry(item: _Item) -> None:
+    """Copies anything but a directory."""
+    src = os.path.join(source, item.relpath)
+    dst = os.path.join(dest, item.relpath)
+    st = item.st
+    if stat.S_ISREG(st.st_mode):
+      if st.st_nlink > 1:
+        with lock:
+          first = first_links.setdefault((st.st_dev, st.st_ino), item.relpath)
+          if first != item.relpath:
+            pending_links.append((item.relpath, first))
+            return
+      copied = copier.copy_file(src, dst)
+      with lock:
+        stats.files += 1
+        stats.bytes += copied
+    elif stat.S_ISLNK(st.st_mode):
+      os.symlink(os.readlink(src), dst)
+      with lock:
+        stats.links += 1
+    else:
+      os.mknod(dst, st.st_mode, st.st_rdev)
+      with lock:
+        stats.links += 1
+    copier.set_metadata(dst, copier.Attrs.of(src, st))
+
+  def visit(item: _Item) -> List[_Item]:
+    """Copies the item, and lists the contents of a directory to copy next.
+
+    Files are returned as items of their own, so that the workers copy the
+    files of a large directory in parallel.
+    """
+    try:
+      if not stat.S_ISDIR(item.st.st_mode):
+        copy_entry(item)
+        added(item.relpath, item.st)
+        return []
+      path = os.path.join(source, item.relpath)
+      attrs = copier.Attrs.of(path, item.st)
+      os.mkdir(os.path.join(dest, item.relpath))
+      children = []
+      with os.scandir(path) as it:
+        for entry in it:
+          st = entry.stat(follow_symlinks=False)
+          relpath = os.path.join(item.relpath, entry.name)
+          if excluder.excludes(relpath, stat.S_ISDIR(st.st_mode)):
+            continue
+          if stat.S_ISREG(st.st_mode) and max_size is not None:
+            if st.st_size > max_size:
+              continue
+          children.append(_Item(relpath, st))
+    except (FileNotFoundError, PermissionError) as e:
+      # Removed while seeding, or unreadable. Left for rsync to handle and
+      # report, as it does for the rest of the source.
+      logging.warning(f'Not seeding {item.relpath}: {e}')
+      return []
+    with lock:
+      directories.append((item.relpath, attrs))
+      stats.directories += 1
+    if item.relpath:
+      added(item.relpath, item.st)
+    return children
+
+  parallel_walk.run([_Item('', os.lstat(source))],
+                    visit,
+                    num_workers=num_workers,
+                    initializer=initializer)
+
+  for relpath, first in pending_links:
+    try:
+      os.link(os.path.join(dest, first), os.path.join(dest, relpath))
+    except FileNotFoundError:
+      # The first of the group was not seeded.
+      continue
+    stats.links += 1
+  # Last, since creating entries changes the mtime of their directory.
+  for relpath, attrs in directories:
+    copier.set_metadata(os.path.join(dest, relpath), attrs)
+
+  stats.seconds = time.monotonic() - start
+  return stats
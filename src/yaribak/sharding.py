@@ -0,0 +1,90 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Splits a source into shards, to be copied by separate rsync processes.
+
+Shards are sets of top-level directories of the source. Each is weighed by
+its number of entries in the latest manifest, if there is one, since scanning
+dominates the time of an incremental backup.
+
+Limitations of sharding -
+- Hard links across shards are copied as separate files. Top-level files go
+  with none of the shards, so they are never hard linked to anything below.
+- Exclude patterns are matched against top-level names only with fnmatch to
+  leave out whole shards; rsync itself applies all of them within shards.
+"""
+
+import fnmatch
+import heapq
+import os
+
+from typing import Dict, List, Optional, Tuple
+
+from . import manifest
+
+
+def top_level_dirs(source: str, excludes: List[str]) -> List[str]:
+  """Names of directories directly under source, which are not excluded."""
+  patterns = [exclude.strip('/') for exclude in excludes]
+  names = []
+  with os.scandir(source) as it:
+    for entry in it:
+      if not entry.is_dir(follow_symlinks=False):
+        continue
+      if any(fnmatch.fnmatchcase(entry.name, p) for p in patterns):
+        continue
+      names.append(entry.name)
+  return sorted(names)
+
+
+def weigh(names: List[str], manifest_fname: Optional[str]) -> Dict[str, int]:
+  """Number of entries under each directory, as of the manifest.
+
+  Directories not in the manifest, e.g. new ones, weigh the same as the
+  heaviest known one. Without a manifest, all weigh the same.
+  """
+  if manifest_fname is None or not os.path.exists(manifest_fname):
+    return {name: 1 for name in names}
+  weights: Dict[str, int] = {}
+  with manifest.Manifest(manifest_fname) as listing:
+    for name in names:
+      if listing.find(name) is None:
+        continue
+      # Paths under name sort before this, as the separator is NUL.
+      end = listing.bisect(name + '\x01')
+      weights[name] = end - listing.bisect(name)
+  heaviest = max(weights.values(), default=1)
+  return {name: weights.get(name, heaviest) for name in names}
+
+
+def balance(weights: Dict[str, int], num_shards: int) -> List[List[str]]:
+  """Greedily assigns the heaviest remaining name to the lightest shard.
+
+  Returns up to num_shards non-empty shards, each sorted.
+  """
+  if num_shards < 1:
+    raise ValueError(f'num_shards must be positive, got {num_shards}')
+  # Heap of (total weight, shard index).
+  heap: List[Tuple[int, int]] = [(0, i) for i in range(num_shards)]
+  shards: List[List[str]] = [[] for _ in range(num_shards)]
+  for name in sorted(weights, key=lambda name: (-weights[name], name)):
+    total, i = heapq.heappop(heap)
+    shards[i].append(name)
+    heapq.heappush(heap, (total + weights[name], i))
+  return [sorted(shard) for shard in shards if shard]
+
+
+def plan(source: str, excludes: List[str], num_shards: int,
+         manifest_fname: Optional[str]) -> List[List[str]]:
+  names = top_level_dirs(source, excludes)
+  return balance(weigh(names, manifest_fname), num_shards)
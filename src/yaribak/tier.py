@@ -0,0 +1,111 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Converts cold snapshots into archives.
+
+A snapshot's payload is a full tree of directories and hard links. Once
+archived, the snapshot instead has a single archive file, and a flat directory
+of hard links to the files it shares with other snapshots. The payload is then
+moved to the trash, to be reaped.
+
+The archive is recorded in the snapshot's metadata, which is written only
+after the archive is complete. So after an interruption, either the payload
+is still the snapshot, or the archive is. Usage stored in the metadata is
+cleared then, so that `yaribak usage` computes it again.
+"""
+
+import logging
+import os
+
+from typing import List
+
+from . import archive
+from . import catalog
+from . import manifest
+from . import metadata
+from . import reaper
+
+
+def cold_snapshots(snapshots: List[catalog.Snapshot], older_than_secs: float,
+                   now_epoch: float) -> List[catalog.Snapshot]:
+  """Snapshots to archive. The latest is never archived, since backups need it.
+  """
+  cold = []
+  for snapshot in snapshots[:-1]:
+    if snapshot.metadata.archive is not None:
+      continue
+    if now_epoch - snapshot.metadata.last_updated() >= older_than_secs:
+      cold.append(snapshot)
+  return cold
+
+
+def _remove_leftovers(target: str, directory: str) -> None:
+  """Removes an archive from an earlier, interrupted run."""
+  fname = os.path.join(directory, archive.ARCHIVE_FNAME)
+  refs_dir = os.path.join(directory, archive.REFS_DIR)
+  for leftover in [fname, fname + '.tmp', archive.records_fname(fname)]:
+    if os.path.exists(leftover):
+      os.remove(leftover)
+  for leftover in [refs_dir, refs_dir + '.tmp']:
+    if os.path.exists(leftover):
+      reaper.move_to_trash(target, leftover)
+
+
+def archive_snapshot(target: str,
+                     snapshot: catalog.Snapshot) -> archive.ArchiveStats:
+  """Archives the snapshot, and updates its metadata.
+
+  The payload is moved to the trash, and should be reaped after.
+  """
+  directory = os.path.join(target, snapshot.name)
+  payload = os.path.join(directory, 'payload')
+  _remove_leftovers(target, directory)
+  stats = archive.write(payload, os.path.join(directory, archive.ARCHIVE_FNAME),
+                        os.path.join(directory, archive.REFS_DIR))
+  # The manifest lists inodes of the payload, which will be gone.
+  manifest_fname = os.path.join(directory, manifest.MANIFEST_FNAME)
+  if os.path.exists(manifest_fname):
+    os.remove(manifest_fname)
+  snapshot.metadata.archive = archive.ARCHIVE_FNAME
+  _clear_usage(directory, snapshot.metadata)
+  reaper.move_to_trash(target, payload)
+  return stats
+
+
+def _clear_usage(directory: str, data: metadata.Metadata) -> None:
+  """Saves the metadata, without usage, which is of the payload."""
+  data.usage = None
+  data.usage_key = None
+  data.save_to(os.path.join(directory, 'backup_context.json'))
+
+
+def finish_interrupted(target: str, snapshot: catalog.Snapshot) -> bool:
+  """Moves the payload of an archived snapshot to trash, if still there.
+
+  Returns whether it did, and so updated the metadata.
+  """
+  directory = os.path.join(target, snapshot.name)
+  payload = os.path.join(directory, 'payload')
+  if snapshot.metadata.archive is None or not os.path.isdir(payload):
+    return False
+  logging.info(f'Removing payload of archived {snapshot.name}.')
+  _clear_usage(directory, snapshot.metadata)
+  reaper.move_to_trash(target, payload)
+  return True
+
+
+def format_stats(stats: archive.ArchiveStats) -> str:
+  return (f'{stats.entries} entries; stored '
+          f'{stats.stored_bytes / 2**20:0.1f} MiB in '
+          f'{stats.archive_bytes / 2**20:0.1f} MiB, and referenced '
+          f'{stats.referenced_bytes / 2**20:0.1f} MiB')
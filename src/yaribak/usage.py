@@ -0,0 +1,195 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Space used by each snapshot, counting each inode once.
+
+A snapshot's exclusive bytes are in inodes that no other snapshot links to,
+and are freed if it is deleted. Its shared bytes are in inodes that other
+snapshots also link to. Each snapshot is listed from its manifest if it has
+one, or else walked. Inodes with a single link, and directories, are known to
+be exclusive without keeping track of them.
+
+Sizes are apparent sizes, as in `du --apparent-size`.
+"""
+
+import dataclasses
+import hashlib
+import os
+import stat
+import threading
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import manifest
+from . import metadata
+from . import parallel_walk
+
+# Marks an inode linked from more than one snapshot.
+_SHARED = -1
+
+
+@dataclasses.dataclass
+class SnapshotUsage:
+  name: str
+  total_bytes: int = 0
+  exclusive_bytes: int = 0
+  # True if listed from the manifest, instead of walking.
+  from_manifest: bool = False
+
+  @property
+  def shared_bytes(self) -> int:
+    return self.total_bytes - self.exclusive_bytes
+
+
+def snapshots_key(names: List[str]) -> str:
+  """Identifies a set of snapshots, which usage depends on."""
+  return hashlib.sha1('\n'.join(sorted(names)).encode()).hexdigest()
+
+
+class _Accumulator:
+  """Counts bytes of inodes, one snapshot at a time."""
+
+  def __init__(self, num_snapshots: int):
+    # Inode to [size, first snapshot or _SHARED, last snapshot].
+    self._inodes: Dict[int, List[int]] = {}
+    self._lock = threading.Lock()
+    self.totals = [0] * num_snapshots
+    self._exclusive = [0] * num_snapshots
+
+  def add(self, index: int, records: Iterable[Tuple[int, int, bool]]) -> None:
+    """Adds (inode, size, known to be exclusive) of entries in a snapshot."""
+    with self._lock:
+      for inode, size, exclusive in records:
+        if exclusive:
+          self.totals[index] += size
+          self._exclusive[index] += size
+          continue
+        info = self._inodes.get(inode)
+        if info is None:
+          self._inodes[inode] = [size, index, index]
+          self.totals[index] += size
+        elif info[2] != index:
+          # Not yet counted in this snapshot.
+          info[1] = _SHARED
+          info[2] = index
+          self.totals[index] += size
+
+  def exclusive(self) -> List[int]:
+    exclusive = list(self._exclusive)
+    for size, first, _ in self._inodes.values():
+      if first != _SHARED:
+        exclusive[first] += size
+    return exclusive
+
+
+def _record(st: os.stat_result) -> Tuple[int, int, bool]:
+  exclusive = stat.S_ISDIR(st.st_mode) or st.st_nlink == 1
+  return st.st_ino, st.st_size, exclusive
+
+
+def _add_from_manifest(accumulator: _Accumulator, index: int, directory: str,
+                       fname: str) -> None:
+  # Entries next to the payload, e.g. the metadata and the manifest itself,
+  # and the payload directory. Only entries within it are in the manifest.
+  with os.scandir(directory) as it:
+    accumulator.add(index,
+                    [_record(entry.stat(follow_symlinks=False)) for entry in it])
+  with manifest.Manifest(fname) as listing:
+    # Link counts in the manifest may be stale, so only directories are
+    # known to be exclusive.
+    accumulator.add(index, ((entry.inode, entry.size, stat.S_ISDIR(entry.mode))
+                            for entry in listing))
+
+
+def _add_from_walk(accumulator: _Accumulator, index: int, directory: str,
+                   num_workers: int) -> None:
+
+  def visit(path: str) -> List[str]:
+    records = []
+    subdirs = []
+    with os.scandir(path) as it:
+      for entry in it:
+        records.append(_record(entry.stat(follow_symlinks=False)))
+        if entry.is_dir(follow_symlinks=False):
+          subdirs.append(entry.path)
+    accumulator.add(index, records)
+    return subdirs
+
+  parallel_walk.run([directory], visit, num_workers=num_workers)
+
+
+def compute(target: str,
+            names: List[str],
+            num_workers: int = parallel_walk.DEFAULT_WORKERS
+            ) -> List[SnapshotUsage]:
+  """Usage of each named snapshot in the backup path, relative to the rest.
+
+  Inodes linked only from snapshots not in names count as exclusive.
+  """
+  accumulator = _Accumulator(len(names))
+  usages = []
+  for index, name in enumerate(names):
+    directory = os.path.join(target, name)
+    fname = manifest.usable_manifest(directory)
+    if fname is not None:
+      _add_from_manifest(accumulator, index, directory, fname)
+    else:
+      _add_from_walk(accumulator, index, directory, num_workers)
+    usages.append(SnapshotUsage(name, from_manifest=fname is not None))
+  for usage, total, exclusive in zip(usages, accumulator.totals,
+                                     accumulator.exclusive()):
+    usage.total_bytes = total
+    usage.exclusive_bytes = exclusive
+  return usages
+
+
+def from_metadata(names: List[str], datas: List[metadata.Metadata],
+                  key: str) -> Optional[List[SnapshotUsage]]:
+  """Usages stored in the snapshots' metadata, if all are up to date."""
+  usages = []
+  for name, data in zip(names, datas):
+    if data.usage is None or data.usage_key != key:
+      return None
+    usages.append(
+        SnapshotUsage(name,
+                      total_bytes=data.usage['total_bytes'],
+                      exclusive_bytes=data.usage['exclusive_bytes']))
+  return usages
+
+
+def to_metadata(usage: SnapshotUsage, key: str,
+                data: metadata.Metadata) -> None:
+  data.usage = {
+      'total_bytes': usage.total_bytes,
+      'exclusive_bytes': usage.exclusive_bytes,
+  }
+  data.usage_key = key
+
+
+def format_bytes(num_bytes: int) -> str:
+  size = float(num_bytes)
+  for unit in ['B', 'KiB', 'MiB', 'GiB']:
+    if size < 1024:
+      return f'{size:0.1f} {unit}'
+    size /= 1024
+  return f'{size:0.1f} TiB'
+
+
+def format_usages(usages: List[SnapshotUsage]) -> str:
+  """Table of usages, one snapshot per line."""
+  lines = [f'{"Snapshot":<22} {"Total":>12} {"Exclusive":>12} {"Shared":>12}']
+  for usage in usages:
+    lines.append(f'{usage.name:<22} {format_bytes(usage.total_bytes):>12} '
+                 f'{format_bytes(usage.exclusive_bytes):>12} '
+                 f'{format_bytes(usage.shared_bytes):>12}')
+  return '\n'.join(lines)
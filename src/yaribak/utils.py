@@ -12,28 +12,116 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import errno
+import logging
 import os
+import subprocess
+import threading
 
+from typing import Dict, List, Tuple
 
-def is_hardlinked_replica(dir1: str, dir2: str) -> bool:
-  """Returns True if directories have same hard-linked files."""
-  for walk1, walk2 in zip(os.walk(dir1), os.walk(dir2)):
-    root1, dirs1, files1 = walk1
-    root2, dirs2, files2 = walk2
-    files1.sort()
-    files2.sort()
-    if files1 != files2:
-      return False
-    # With topdown=True (default for os.walk), sorting also ensures that the
-    # traversal order is same. Otherwise it technically depends on the file
-    # system.
-    dirs1.sort()
-    dirs2.sort()
-    if dirs1 != dirs2:
-      return False
-    for file1, file2 in zip(files1, files2):
-      inode1 = os.lstat(os.path.join(root1, file1)).st_ino
-      inode2 = os.lstat(os.path.join(root2, file2)).st_ino
-      if inode1 != inode2:
-        return False
-  return True
+from . import parallel_walk
+
+# Errors from setting an xattr that are expected, e.g. when not running as root
+# or when the target filesystem does not support a namespace.
+_XATTR_SKIP_ERRNOS = {
+    errno.EPERM, errno.EACCES, errno.ENOTSUP, errno.EOPNOTSUPP
+}
+
+
+def is_hardlinked_replica(dir1: str, dir2: str,
+                          num_workers: int = parallel_walk.DEFAULT_WORKERS
+                          ) -> bool:
+  """Returns True if directories have same hard-linked files.
+
+  That is, both have the same directory structure, and each non-directory
+  entry is the same inode in both. Subtrees are compared concurrently, and all
+  workers stop at the first difference.
+  """
+  # Set at the first difference, which also stops all workers.
+  differs = threading.Event()
+
+  def visit(relpath: str) -> List[str]:
+    # Only one side of one directory is held in memory at a time.
+    entries1: Dict[str, Tuple[bool, int]] = {}
+    with os.scandir(os.path.join(dir1, relpath)) as it:
+      for entry in it:
+        entries1[entry.name] = (entry.is_dir(follow_symlinks=False),
+                                entry.inode())
+    subdirs: List[str] = []
+    with os.scandir(os.path.join(dir2, relpath)) as it:
+      for entry in it:
+        is_dir = entry.is_dir(follow_symlinks=False)
+        expected = entries1.pop(entry.name, None)
+        if expected is None or expected[0] != is_dir:
+          differs.set()
+          return []
+        if not is_dir and expected[1] != entry.inode():
+          differs.set()
+          return []
+        if is_dir:
+          subdirs.append(os.path.join(relpath, entry.name))
+    if entries1:
+      differs.set()
+      return []
+    return subdirs
+
+  parallel_walk.run([''], visit, num_workers=num_workers, stop=differs)
+  return not differs.is_set()
+
+
+def get_xattrs(src: str) -> Dict[str, bytes]:
+  """Extended attributes, including POSIX ACLs, without following links.
+
+  ACLs are stored in the `system.posix_acl_*` attributes, so they are read
+  along with the rest. Attributes that cannot be read are skipped.
+  """
+  try:
+    names = os.listxattr(src, follow_symlinks=False)
+  except OSError as e:
+    if e.errno in _XATTR_SKIP_ERRNOS:
+      return {}
+    raise
+  xattrs = {}
+  for name in names:
+    try:
+      xattrs[name] = os.getxattr(src, name, follow_symlinks=False)
+    except OSError as e:
+      if e.errno not in _XATTR_SKIP_ERRNOS:
+        raise
+      logging.debug(f'Could not read xattr {name} of {src}: {e}')
+  return xattrs
+
+
+def set_xattrs(dst: str, xattrs: Dict[str, bytes]) -> None:
+  """Sets extended attributes. Like `cp -a`, those that cannot be set are
+  skipped.
+  """
+  for name, value in xattrs.items():
+    try:
+      os.setxattr(dst, name, value, follow_symlinks=False)
+    except OSError as e:
+      if e.errno not in _XATTR_SKIP_ERRNOS:
+        raise
+      logging.debug(f'Could not set xattr {name} on {dst}: {e}')
+
+
+def lower_thread_priority() -> None:
+  """Puts the calling thread in the idle I/O class, at the lowest CPU priority.
+
+  On Linux both priorities are per thread, so other threads are not affected.
+  Failures are logged and ignored, since this is only an optimization.
+  """
+  tid = threading.get_native_id()
+  try:
+    os.setpriority(os.PRIO_PROCESS, tid, 19)
+  except OSError as e:
+    logging.debug(f'Could not lower CPU priority: {e}')
+  try:
+    subprocess.run(
+        ['ionice', '-c', '3', '-p', str(tid)],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+  except (OSError, subprocess.CalledProcessError) as e:
+    logging.debug(f'Could not lower I/O priority: {e}')
@@ -0,0 +1,273 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks that the files in all snapshots are readable and intact.
+
+A file hard linked into many snapshots is one inode, so each (dev, inode) is
+read and hashed once, however many snapshots have it. Hashes are kept in the
+hash cache of the backup path, which also serves dedup. Later runs only hash
+inodes that are not in it, unless asked for a full check, which hashes
+everything again and compares with the cached hashes.
+
+Blocks of the chunk store that the snapshots use are checked the same way,
+and also against the digest they are named by.
+"""
+
+import concurrent.futures
+import dataclasses
+import itertools
+import os
+import stat
+import threading
+import time
+
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from . import chunks
+from . import hash_cache
+from . import parallel_walk
+
+# Inodes submitted to the pool at a time.
+_BATCH_SIZE = 4096
+
+_InodeKey = Tuple[int, int]
+_T = TypeVar('_T')
+_R = TypeVar('_R')
+
+
+@dataclasses.dataclass
+class Problem:
+  snapshot: str
+  # Relative to the snapshot directory.
+  path: str
+  error: str
+
+
+@dataclasses.dataclass
+class VerifyStats:
+  # Unique inodes of regular files in all snapshots.
+  inodes: int = 0
+  # Blocks of the chunk store used by the snapshots.
+  blocks: int = 0
+  # Inodes and blocks read and hashed in this run.
+  hashed: int = 0
+  hashed_bytes: int = 0
+  # Cache entries dropped, for inodes no longer in any snapshot.
+  pruned: int = 0
+  problems: int = 0
+  seconds: float = 0.0
+
+  @property
+  def bytes_per_sec(self) -> float:
+    if self.seconds <= 0:
+      return 0.0
+    return self.hashed_bytes / self.seconds
+
+
+@dataclasses.dataclass
+class _Inode:
+  # Path in the first snapshot found to have it, and that snapshot's index.
+  path: str
+  index: int
+  st: os.stat_result
+  # Bit i is set if the i-th snapshot has this inode.
+  snapshots: int
+
+
+def _list_inodes(target: str, names: List[str], num_workers: int,
+                 problems: List[Problem]) -> Dict[_InodeKey, _Inode]:
+  inodes: Dict[_InodeKey, _Inode] = {}
+  lock = threading.Lock()
+
+  def visit(item: Tuple[int, str]) -> List[Tuple[int, str]]:
+    index, relpath = item
+    subdirs = []
+    files = []
+    try:
+      with os.scandir(os.path.join(target, names[index], relpath)) as it:
+        for entry in it:
+          child = os.path.join(relpath, entry.name)
+          st = entry.stat(follow_symlinks=False)
+          if stat.S_ISDIR(st.st_mode):
+            subdirs.append((index, child))
+          elif stat.S_ISREG(st.st_mode):
+            files.append((child, st))
+    except OSError as e:
+      with lock:
+        problems.append(Problem(names[index], relpath, f'Unreadable: {e}'))
+      return []
+    with lock:
+      for child, st in files:
+        key = (st.st_dev, st.st_ino)
+        inode = inodes.get(key)
+        if inode is None:
+          inodes[key] = _Inode(child, index, st, 1 << index)
+        else:
+          inode.snapshots |= 1 << index
+    return subdirs
+
+  parallel_walk.run([(index, '') for index in range(len(names))],
+                    visit,
+                    num_workers=num_workers)
+  return inodes
+
+
+def _hash_all(keys: List[_T], hash_fn: Callable[[_T], _R],
+              num_workers: int) -> Iterator[_R]:
+  """Calls hash_fn on each of keys in a pool, and yields the results."""
+  with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+    # In batches, since map() submits all items at once.
+    yield from itertools.chain.from_iterable(
+        executor.map(hash_fn, keys[i:i + _BATCH_SIZE])
+        for i in range(0, len(keys), _BATCH_SIZE))
+
+
+def _verify_blocks(target: str, names: List[str], inodes: Dict[_InodeKey,
+                                                               _Inode],
+                   full: bool, cache: hash_cache.HashCache,
+                   num_workers: int, stats: VerifyStats,
+                   errors: Dict[_InodeKey, str],
+                   live: Set[_InodeKey]) -> None:
+  """Checks the blocks used by maps among inodes.
+
+  Errors are recorded against the maps that use a bad block. The inodes of
+  blocks found are added to live.
+  """
+  lock = threading.Lock()
+  store = chunks.store_dir(target)
+  # Maps that use each block.
+  users: Dict[str, List[_InodeKey]] = {}
+  for key, inode in inodes.items():
+    if not inode.path.startswith(chunks.MAPS_DIR + os.sep):
+      continue
+    path = os.path.join(target, names[inode.index], inode.path)
+    try:
+      chunk_map = chunks.read_map(path)
+    except (OSError, ValueError) as e:
+      errors.setdefault(key, f'Unreadable chunk map: {e}')
+      continue
+    for digest in chunk_map.digests:
+      if digest is not None:
+        users.setdefault(digest, []).append(key)
+  stats.blocks = len(users)
+
+  def check(digest: str) -> Tuple[str, int, str]:
+    """Returns the digest, bytes hashed, and an error if any."""
+    path = chunks.chunk_path(store, digest)
+    try:
+      st = os.lstat(path)
+      with lock:
+        live.add((st.st_dev, st.st_ino))
+      cached = cache.get(st)
+      if cached is not None and not full:
+        if cached.hex() != digest:
+          return digest, 0, 'Hash differs from last verified'
+        return digest, 0, ''
+      actual = hash_cache.hash_file(path)
+    except FileNotFoundError:
+      return digest, 0, 'Missing'
+    except OSError as e:
+      return digest, 0, f'Unreadable: {e}'
+    if actual.hex() != digest:
+      return digest, st.st_size, 'Corrupt'
+    cache.put(st, actual)
+    return digest, st.st_size, ''
+
+  for digest, hashed_bytes, error in _hash_all(list(users), check,
+                                               num_workers):
+    if hashed_bytes:
+      stats.hashed += 1
+      stats.hashed_bytes += hashed_bytes
+    if error:
+      for key in users[digest]:
+        errors.setdefault(key, f'Block {digest}: {error}')
+
+
+def _snapshot_names(names: List[str], mask: int) -> Iterator[str]:
+  for index, name in enumerate(names):
+    if mask & (1 << index):
+      yield name
+
+
+def verify(target: str,
+           names: List[str],
+           full: bool = False,
+           num_workers: int = parallel_walk.DEFAULT_WORKERS
+           ) -> Tuple[VerifyStats, List[Problem]]:
+  """Verifies the named snapshots in the backup path.
+
+  Problems are sorted by snapshot and path. An inode shared by several
+  snapshots is reported in each, by the path it was first found at.
+
+  Cached hashes of inodes in none of the snapshots are dropped, so names
+  should be all snapshots in the backup path.
+  """
+  start = time.monotonic()
+  stats = VerifyStats()
+  problems: List[Problem] = []
+  inodes = _list_inodes(target, names, num_workers, problems)
+  stats.inodes = len(inodes)
+
+  # Errors found for each inode.
+  errors: Dict[_InodeKey, str] = {}
+  with hash_cache.HashCache(os.path.join(target,
+                                         hash_cache.CACHE_FNAME)) as cache:
+    # Hashes from earlier runs, for inodes to compare.
+    known: Dict[_InodeKey, bytes] = {}
+    to_hash: List[_InodeKey] = []
+    for key, inode in inodes.items():
+      digest = cache.get(inode.st)
+      if digest is None:
+        to_hash.append(key)
+      elif full:
+        known[key] = digest
+        to_hash.append(key)
+
+    def hash_inode(key: _InodeKey) -> Tuple[_InodeKey, Optional[bytes], str]:
+      inode = inodes[key]
+      path = os.path.join(target, names[inode.index], inode.path)
+      try:
+        return key, hash_cache.hash_file(path), ''
+      except OSError as e:
+        return key, None, f'Unreadable: {e}'
+
+    # Largest first, so that the pool is not left waiting on one large file.
+    to_hash.sort(key=lambda key: inodes[key].st.st_size, reverse=True)
+    for key, digest, error in _hash_all(to_hash, hash_inode, num_workers):
+      inode = inodes[key]
+      if digest is None:
+        errors[key] = error
+        continue
+      stats.hashed += 1
+      stats.hashed_bytes += inode.st.st_size
+      if key in known:
+        # The cached hash is kept, so this is reported until fixed.
+        if known[key] != digest:
+          errors[key] = 'Hash differs from last verified'
+        continue
+      cache.put(inode.st, digest)
+    live = set(inodes)
+    _verify_blocks(target, names, inodes, full, cache, num_workers, stats,
+                   errors, live)
+    # Not if a directory could not be listed, since its inodes are unknown.
+    if not problems:
+      stats.pruned = cache.prune(live)
+
+  for key, error in errors.items():
+    inode = inodes[key]
+    for name in _snapshot_names(names, inode.snapshots):
+      problems.append(Problem(name, inode.path, error))
+  problems.sort(key=lambda it: (it.snapshot, it.path))
+  stats.problems = len(problems)
+  stats.seconds = time.monotonic() - start
+  return stats, problems
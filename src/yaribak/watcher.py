@@ -0,0 +1,213 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Watches a source tree with inotify, to back up only what changed.
+
+The watcher keeps a set of dirty directories, relative to the source. Any
+event inside a directory marks it dirty; new directories are watched and
+marked dirty along with everything under them. Backing up the immediate
+contents of each dirty directory (rsync --dirs with --delete) on top of a
+clone of the latest backup gives the same result as a full rsync.
+
+When the dirty set cannot be trusted, i.e. at startup, on queue overflow, on
+directory moves, or when out of watches, the next backup is a full rescan.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from typing import Callable, Dict, List, Optional, Set
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+_CONTENT_EVENTS = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE
+_ENTRY_EVENTS = _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO
+# Events on the watched directory itself.
+_SELF_EVENTS = _IN_DELETE_SELF | _IN_MOVE_SELF
+_WATCH_FLAGS = _IN_ONLYDIR | _IN_DONT_FOLLOW
+_WATCH_MASK = _CONTENT_EVENTS | _ENTRY_EVENTS | _SELF_EVENTS | _WATCH_FLAGS
+
+# wd, mask, cookie, len; followed by len bytes of name.
+_EVENT = struct.Struct('iIII')
+
+
+def _libc() -> ctypes.CDLL:
+  return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                     use_errno=True)
+
+
+class TreeWatcher:
+  """Tracks directories with changes under a root."""
+
+  def __init__(self, root: str):
+    self._root = root
+    self._libc = _libc()
+    self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if self._fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, f'inotify_init1: {os.strerror(err)}')
+    # Watch descriptor to directory relative to root.
+    self._wd_to_dir: Dict[int, str] = {}
+    self._dirty: Set[str] = set()
+    # Everything will be scanned at first.
+    self._full_rescan = True
+    # Set when out of inotify watches, in which case every backup is full.
+    self._degraded = False
+    self.last_event_time = 0.0
+    self._watch_tree('')
+
+  def close(self) -> None:
+    os.close(self._fd)
+
+  def _add_watch(self, relpath: str) -> bool:
+    path = os.fsencode(os.path.join(self._root, relpath))
+    wd = self._libc.inotify_add_watch(self._fd, path, _WATCH_MASK)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err == errno.ENOSPC:
+        if not self._degraded:
+          logging.warning('Out of inotify watches; every backup will be full. '
+                          'Consider raising fs.inotify.max_user_watches.')
+        self._degraded = True
+      elif err not in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+        raise OSError(err, f'inotify_add_watch: {os.strerror(err)}')
+      return False
+    self._wd_to_dir[wd] = relpath
+    return True
+
+  def _watch_tree(self, relpath: str) -> None:
+    """Watches relpath and all directories under it, and marks them dirty."""
+    pending = [relpath]
+    while pending:
+      current = pending.pop()
+      if not self._add_watch(current):
+        continue
+      self._dirty.add(current)
+      try:
+        with os.scandir(os.path.join(self._root, current)) as it:
+          for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+              pending.append(os.path.join(current, entry.name))
+      except (FileNotFoundError, NotADirectoryError):
+        pass
+
+  def _rewatch(self) -> None:
+    """Starts over, e.g. if the mapping of watches to paths is stale."""
+    for wd in list(self._wd_to_dir):
+      self._libc.inotify_rm_watch(self._fd, wd)
+    self._wd_to_dir.clear()
+    self._full_rescan = True
+    self._watch_tree('')
+
+  def poll(self, timeout: float) -> None:
+    """Waits up to timeout seconds for events, and processes them."""
+    readable, _, _ = select.select([self._fd], [], [], timeout)
+    if not readable:
+      return
+    try:
+      data = os.read(self._fd, 1 << 20)
+    except BlockingIOError:
+      return
+    self.last_event_time = time.monotonic()
+    needs_rewatch = False
+    offset = 0
+    while offset < len(data):
+      wd, mask, _, name_len = _EVENT.unpack_from(data, offset)
+      offset += _EVENT.size
+      name = os.fsdecode(data[offset:offset + name_len].rstrip(b'\0'))
+      offset += name_len
+      if mask & _IN_Q_OVERFLOW:
+        logging.warning('inotify queue overflowed; will rescan everything.')
+        needs_rewatch = True
+        continue
+      directory = self._wd_to_dir.get(wd)
+      if mask & _IN_IGNORED:
+        self._wd_to_dir.pop(wd, None)
+        continue
+      if directory is None:
+        continue
+      self._dirty.add(directory)
+      if mask & _IN_ISDIR and mask & _IN_MOVED_FROM:
+        # Watches under the moved directory now have stale paths.
+        needs_rewatch = True
+      elif mask & _IN_MOVE_SELF and directory == '':
+        needs_rewatch = True
+      elif mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+        self._watch_tree(os.path.join(directory, name))
+    if needs_rewatch:
+      self._rewatch()
+
+  def take_dirty(self) -> Optional[List[str]]:
+    """Returns and resets the dirty directories; None if all must be scanned."""
+    full = self._full_rescan or self._degraded
+    dirty = sorted(self._dirty)
+    self._dirty = set()
+    self._full_rescan = False
+    return None if full else dirty
+
+
+def watch(source: str,
+          backup: Callable[[Optional[List[str]]], None],
+          interval_secs: float,
+          debounce_secs: float,
+          max_cycles: Optional[int] = None) -> None:
+  """Calls backup() with the dirty directories whenever a backup is due.
+
+  A backup is due once interval_secs have passed since the last one, there
+  were changes, and no new events arrived for debounce_secs.
+  """
+  watcher = TreeWatcher(source)
+  try:
+    last_backup = float('-inf')
+    cycles = 0
+    while max_cycles is None or cycles < max_cycles:
+      now = time.monotonic()
+      wait = max(last_backup + interval_secs - now,
+                 watcher.last_event_time + debounce_secs - now, 0.0)
+      watcher.poll(timeout=wait if wait > 0 else debounce_secs)
+      now = time.monotonic()
+      if now - last_backup < interval_secs:
+        continue
+      if now - watcher.last_event_time < debounce_secs:
+        continue
+      dirty = watcher.take_dirty()
+      if dirty == []:
+        continue
+      logging.info('Backing up everything.' if dirty is None else
+                   f'Backing up {len(dirty)} changed directories.')
+      backup(dirty)
+      last_backup = time.monotonic()
+      cycles += 1
+  finally:
+    watcher.close()
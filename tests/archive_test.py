@@ -0,0 +1,106 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.yaribak import archive
+
+
+def _write(path: str, content: bytes) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'wb') as f:
+    f.write(content)
+
+
+class TestArchive(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    self._payload = os.path.join(self._tmpdir, 'payload')
+    self._fname = os.path.join(self._tmpdir, archive.ARCHIVE_FNAME)
+    self._refs_dir = os.path.join(self._tmpdir, archive.REFS_DIR)
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def _make_payload(self) -> None:
+    _write(os.path.join(self._payload, 'a', 'small'), b'small')
+    _write(os.path.join(self._payload, 'a', 'empty'), b'')
+    _write(os.path.join(self._payload, 'large'), bytes(range(256)) * 1000)
+    _write(os.path.join(self._payload, 'linked'), b'linked')
+    os.link(os.path.join(self._payload, 'linked'),
+            os.path.join(self._tmpdir, 'elsewhere'))
+    os.symlink('a/small', os.path.join(self._payload, 'symlink'))
+
+  def _read(self, reader: archive.Archive, path: str) -> bytes:
+    entry = reader.find(path)
+    assert entry is not None
+    return b''.join(reader.read(entry))
+
+  def test_roundtrip(self):
+    self._make_payload()
+    # Small frames, so that files span several.
+    with mock.patch.object(archive, 'FRAME_SIZE', 1000):
+      stats = archive.write(self._payload, self._fname, self._refs_dir)
+    self.assertEqual(stats.entries, 6)
+    self.assertEqual(stats.stored_bytes, 5 + 256000)
+    self.assertEqual(stats.referenced_bytes, 6)
+    self.assertFalse(os.path.exists(self._fname + '.tmp'))
+    self.assertFalse(os.path.exists(archive.records_fname(self._fname)))
+
+    with archive.Archive(self._fname, self._refs_dir) as reader:
+      self.assertEqual([entry.path for entry in reader],
+                       ['a', 'a/empty', 'a/small', 'large', 'linked', 'symlink'])
+      self.assertEqual(self._read(reader, 'a/small'), b'small')
+      self.assertEqual(self._read(reader, 'a/empty'), b'')
+      self.assertEqual(self._read(reader, 'large'), bytes(range(256)) * 1000)
+      directory = reader.find('a')
+      assert directory is not None
+      self.assertEqual(directory.kind, archive.DIRECTORY)
+      symlink = reader.find('symlink')
+      assert symlink is not None
+      self.assertEqual(symlink.kind, archive.SYMLINK)
+      self.assertEqual(symlink.target, 'a/small')
+      self.assertIsNone(reader.find('missing'))
+
+      linked = reader.find('linked')
+      assert linked is not None
+      self.assertEqual(linked.kind, archive.REFERENCE)
+      ref = reader.ref_path(linked)
+      self.assertTrue(
+          os.path.samefile(ref, os.path.join(self._tmpdir, 'elsewhere')))
+      with self.assertRaises(ValueError):
+        list(reader.read(linked))
+
+  def test_zlib(self):
+    self._make_payload()
+    archive.write(self._payload,
+                  self._fname,
+                  self._refs_dir,
+                  codec=archive.CODEC_ZLIB)
+    with archive.Archive(self._fname, self._refs_dir) as reader:
+      self.assertEqual(self._read(reader, 'large'), bytes(range(256)) * 1000)
+
+  def test_not_an_archive(self):
+    _write(self._fname, b'not an archive')
+    with self.assertRaises(ValueError):
+      archive.Archive(self._fname, self._refs_dir)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,215 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from src.yaribak import async_backup
+from src.yaribak import backup_processor
+from src.yaribak import catalog
+from src.yaribak import changelog
+from src.yaribak import events
+
+from typing import AsyncGenerator, List, cast
+
+# Stands in for rsync, which prints a change, progress, and totals.
+_FAKE_RSYNC = r"""#!/bin/sh
+printf '>f+++++++++:5:file\n'
+printf '          5 100%%    1.00kB/s    0:00:00 (xfr#1, to-chk=0/2)\r'
+printf 'Number of files: 2\n'
+"""
+
+# Stands in for an rsync that runs until stopped.
+_SLOW_RSYNC = r"""#!/bin/sh
+echo $$ > "$YARIBAK_TEST_PIDFILE.tmp"
+mv "$YARIBAK_TEST_PIDFILE.tmp" "$YARIBAK_TEST_PIDFILE"
+exec sleep 60
+"""
+
+
+class TestAsyncBackup(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    self._source = os.path.join(self._tmpdir, 'source')
+    os.mkdir(self._source)
+    self._bin_dir = os.path.join(self._tmpdir, 'bin')
+    os.mkdir(self._bin_dir)
+    self._pidfile = os.path.join(self._tmpdir, 'rsync.pid')
+    self._environ = mock.patch.dict(
+        os.environ, {
+            'PATH': self._bin_dir + os.pathsep + os.environ['PATH'],
+            'YARIBAK_TEST_PIDFILE': self._pidfile,
+        })
+    self._environ.start()
+
+  def tearDown(self):
+    self._environ.stop()
+    self._tmpdir_obj.cleanup()
+
+  def _install_rsync(self, script: str) -> None:
+    fname = os.path.join(self._bin_dir, 'rsync')
+    with open(fname, 'w') as f:
+      f.write(script)
+    os.chmod(fname, 0o755)
+
+  def _make_target(self, name: str) -> str:
+    target = os.path.join(self._tmpdir, name)
+    os.mkdir(target)
+    return target
+
+  @staticmethod
+  def _processor(dryrun: bool = False) -> backup_processor.BackupProcessor:
+    return backup_processor.BackupProcessor(dryrun=dryrun,
+                                            verbose=False,
+                                            only_if_changed=False,
+                                            low_ram=True)
+
+  async def _collect(self, processor: backup_processor.BackupProcessor,
+                     target: str) -> List[events.Event]:
+    return [
+        event async for event in async_backup.backup(
+            processor, self._source, target, -1, [], None)
+    ]
+
+  def test_events(self):
+    self._install_rsync(_FAKE_RSYNC)
+    target = self._make_target('backups')
+    received = asyncio.run(self._collect(self._processor(), target))
+
+    names = catalog.snapshot_names(target)
+    self.assertEqual(len(names), 1)
+    phases = [
+        event.phase
+        for event in received
+        if isinstance(event, events.PhaseStarted)
+    ]
+    self.assertEqual(phases,
+                     ['scan', 'clone', 'metadata', 'rsync', 'metadata', 'rename'])
+    progress = [
+        event for event in received if isinstance(event, events.RsyncProgress)
+    ]
+    self.assertEqual(progress[-1].bytes_transferred, 5)
+    self.assertEqual(progress[-1].files_total, 2)
+    finished = next(
+        event for event in received if isinstance(event, events.RsyncFinished))
+    self.assertEqual(finished.status, 0)
+    self.assertEqual(finished.counts[changelog.ADDED], 1)
+    self.assertEqual(finished.stats['files'], 2)
+    self.assertEqual(received[-1], events.SnapshotCreated(names[0]))
+
+  def test_dryrun_steps_match(self):
+    target = self._make_target('backups')
+    expected = list(self._processor(dryrun=True)._process_iterator(
+        self._source, target, -1, [], None))
+    received = asyncio.run(self._collect(self._processor(dryrun=True), target))
+    steps = [
+        event.description
+        for event in received
+        if isinstance(event, events.StepDone)
+    ]
+    self.assertEqual(steps, expected)
+
+  def test_concurrent(self):
+    self._install_rsync(_FAKE_RSYNC)
+    targets = [self._make_target(f'backups{i}') for i in range(3)]
+
+    async def run_all() -> List[List[events.Event]]:
+      return await asyncio.gather(*(
+          self._collect(self._processor(), target) for target in targets))
+
+    for target, received in zip(targets, asyncio.run(run_all())):
+      names = catalog.snapshot_names(target)
+      self.assertEqual(len(names), 1)
+      self.assertEqual(received[-1], events.SnapshotCreated(names[0]))
+
+  def test_cleanup_off_loop(self):
+    loop_threads = []
+    cleanup_threads = []
+
+    def steps(*args, **kwargs):
+      try:
+        loop_threads.append(threading.get_ident())
+        yield 'Step 1'
+        yield 'Step 2'
+      finally:
+        # E.g. waiting for the background reaper.
+        cleanup_threads.append(threading.get_ident())
+
+    processor = self._processor()
+
+    async def first_event() -> events.Event:
+      # An async generator, which can be closed early.
+      received = cast(
+          AsyncGenerator[events.Event, None],
+          async_backup.backup(processor, self._source, self._tmpdir, -1, [],
+                              None))
+      event = await received.__anext__()
+      await received.aclose()
+      return event
+
+    with mock.patch.object(processor, 'steps', steps):
+      event = asyncio.run(first_event())
+    self.assertEqual(event, events.StepDone('Step 1'))
+    self.assertEqual(len(cleanup_threads), 1)
+    self.assertNotEqual(cleanup_threads, loop_threads)
+
+  def test_cancel(self):
+    self._install_rsync(_SLOW_RSYNC)
+    target = self._make_target('backups')
+    processor = self._processor()
+    received: List[events.Event] = []
+
+    async def consume() -> None:
+      async for event in async_backup.backup(processor, self._source, target,
+                                             -1, [], None):
+        received.append(event)
+
+    async def run_and_cancel() -> None:
+      task = asyncio.ensure_future(consume())
+      while not os.path.exists(self._pidfile):
+        await asyncio.sleep(0.01)
+      task.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await task
+
+    asyncio.run(run_and_cancel())
+    with open(self._pidfile) as f:
+      pid = int(f.read())
+    # Terminated, and waited for.
+    with self.assertRaises(ProcessLookupError):
+      os.kill(pid, 0)
+    # Stopped while copying.
+    self.assertEqual(received[-1], events.PhaseStarted('rsync'))
+    self.assertEqual(catalog.snapshot_names(target), [])
+    self.assertTrue(os.path.isdir(os.path.join(target, 'ysnap__incomplete')))
+    self.assertIsNone(processor._catalog)
+
+    # The next backup resumes it.
+    self._install_rsync(_FAKE_RSYNC)
+    received = asyncio.run(self._collect(processor, target))
+    incomplete = os.path.join(target, 'ysnap__incomplete')
+    self.assertIn(events.StepDone(f'[Resume {incomplete} after clone]'),
+                  received)
+    self.assertNotIn(events.PhaseStarted('clone'), received)
+    self.assertEqual(len(catalog.snapshot_names(target)), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,19 +14,27 @@
 
 import datetime
 import filecmp
+import json
 import os
 import pathlib
+import shutil
 import tempfile
 import unittest
 from unittest import mock
 
 from src.yaribak import backup_processor
+from src.yaribak import catalog
+from src.yaribak import changelog
+from src.yaribak import chunks
+from src.yaribak import governor
 from src.yaribak import metadata
+from src.yaribak import resume
 
-from typing import List
+from typing import List, Optional
 
 # Default expected rsync flags.
-_EXPECTED_RSYNC_FLAGS = '-aAXHSv --delete --delete-excluded'
+_EXPECTED_RSYNC_FLAGS = ('-aAXHSv --delete --delete-excluded --out-format=%i:%l:%n '
+                         '--info=progress2,stats2')
 
 
 def _dir_compare(dir1: str, dir2: str) -> bool:
@@ -58,6 +66,23 @@ class TestBackupProcessor(unittest.TestCase):
         f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
     ])
 
+  def test_time_of_each_backup(self):
+
+    def later() -> datetime.datetime:
+      self._fake_now += datetime.timedelta(minutes=1)
+      return self._fake_now
+
+    # Taken once when each backup starts, even as time passes.
+    with mock.patch.object(backup_processor, '_now', side_effect=later):
+      renames = [
+          self._process(self._source_dir, self._backup_dir)[-1]
+          for _ in range(2)
+      ]
+    self.assertEqual(renames, [
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235319]',
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235419]',
+    ])
+
   def test_excludes(self):
     cmds = self._process(self._source_dir,
                          self._backup_dir,
@@ -71,6 +96,472 @@ class TestBackupProcessor(unittest.TestCase):
         f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
     ])
 
+  def test_existing_backup(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    previous = f'{self._tmpdir}/backups/ysnap_20220313_000000'
+    for strategy, clone_step in [
+        ('native',
+         f'[Clone {previous} to {self._tmpdir}/backups/ysnap__incomplete]'),
+        ('cp', f'cp -al {previous} {self._tmpdir}/backups/ysnap__incomplete'),
+    ]:
+      cmds = self._process(self._source_dir,
+                           self._backup_dir,
+                           snapshot_strategy=strategy)
+      self.assertEqual(list(cmds), [
+          f'rsync {_EXPECTED_RSYNC_FLAGS} {self._tmpdir}/source/ {previous}/payload --dry-run',
+          clone_step,
+          f'[Store metadata at {self._tmpdir}/backups/ysnap__incomplete/backup_context.json]',
+          f'rsync {_EXPECTED_RSYNC_FLAGS} {self._tmpdir}/source/ {self._tmpdir}/backups/ysnap__incomplete/payload',
+          f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
+      ], strategy)
+
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         snapshot_strategy='link-dest')
+    self.assertEqual(list(cmds), [
+        f'rsync {_EXPECTED_RSYNC_FLAGS} {self._tmpdir}/source/ {previous}/payload --dry-run',
+        f'mkdir {self._tmpdir}/backups/ysnap__incomplete',
+        f'chown {self._user_and_group} {self._tmpdir}/backups/ysnap__incomplete',
+        f'[Store metadata at {self._tmpdir}/backups/ysnap__incomplete/backup_context.json]',
+        f'rsync {_EXPECTED_RSYNC_FLAGS} {self._tmpdir}/source/ {self._tmpdir}/backups/ysnap__incomplete/payload --link-dest={previous}/payload',
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
+    ])
+
+  def test_seed(self):
+    cmds = self._process(self._source_dir, self._backup_dir, seed=True)
+    payload = f'{self._tmpdir}/backups/ysnap__incomplete/payload'
+    self.assertEqual(cmds[3:5], [
+        f'[Seed {payload} from {self._tmpdir}/source]',
+        f'rsync {_EXPECTED_RSYNC_FLAGS} {self._tmpdir}/source/ {payload}',
+    ])
+    # Only the first backup is seeded.
+    self._make_snapshot('ysnap_20220313_000000')
+    cmds = self._process(self._source_dir, self._backup_dir, seed=True)
+    self.assertFalse(any(cmd.startswith('[Seed') for cmd in cmds))
+
+  def test_chunks(self):
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         chunk_threshold=1 << 20)
+    incomplete = f'{self._tmpdir}/backups/ysnap__incomplete'
+    self.assertEqual(cmds[3:5], [
+        f'rsync {_EXPECTED_RSYNC_FLAGS} --max-size=1048575 {self._tmpdir}/source/ {incomplete}/payload',
+        f'[Store large files of {self._tmpdir}/source in {self._tmpdir}/backups/.chunks]',
+    ])
+
+  def test_chunks_stored(self):
+    large = os.path.join(self._source_dir, 'large')
+    content = os.urandom(3 * chunks.CHUNK_SIZE)
+    with open(large, 'wb') as f:
+      f.write(content)
+    processor = backup_processor.BackupProcessor(dryrun=False,
+                                                 verbose=False,
+                                                 only_if_changed=True,
+                                                 low_ram=True,
+                                                 chunk_threshold=1 << 20)
+    kwargs = dict(max_to_keep=-1, excludes=[], min_ttl=None)
+    # No rsync, which would only copy the small files.
+    with mock.patch.object(backup_processor, '_run_with_output_handler'):
+      processor.process(self._source_dir, self._backup_dir, **kwargs)
+      first = os.path.join(self._backup_dir, 'ysnap_20220314_235219')
+      restored = os.path.join(self._tmpdir, 'restored')
+      chunks.restore_file(os.path.join(first, chunks.MAPS_DIR, 'large'),
+                          chunks.store_dir(self._backup_dir), restored)
+      self.assertTrue(filecmp.cmp(large, restored, shallow=False))
+
+      # The probe sees no change in the large file.
+      processor.process(self._source_dir, self._backup_dir, **kwargs)
+      self.assertEqual(catalog.snapshot_names(self._backup_dir),
+                       ['ysnap_20220314_235219'])
+
+      # A change in it makes a new backup.
+      with open(large, 'r+b') as f:
+        f.write(b'changed')
+      os.utime(large, ns=(0, 10**18))
+      self._fake_now += datetime.timedelta(days=1)
+      processor.process(self._source_dir, self._backup_dir, **kwargs)
+      self.assertEqual(len(catalog.snapshot_names(self._backup_dir)), 2)
+
+  def _stop_backup(self, base: Optional[str], phases: List[str]) -> str:
+    """Leaves an incomplete snapshot, as a backup stopped midway does."""
+    incomplete = os.path.join(self._backup_dir, 'ysnap__incomplete')
+    os.makedirs(os.path.join(incomplete, 'payload'))
+    resume.ResumeState(source=self._source_dir,
+                       base=base,
+                       snapshot_strategy='native',
+                       phases=phases).save_to(
+                           os.path.join(incomplete, resume.STATE_FNAME))
+    return incomplete
+
+  def test_resume(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    incomplete = self._stop_backup('ysnap_20220313_000000', ['clone'])
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         dirty_dirs=['a'])
+    # Neither probed nor cloned again, and everything is checked by rsync.
+    self.assertEqual(cmds, [
+        f'[Resume {incomplete} after clone]',
+        f'[Store metadata at {incomplete}/backup_context.json]',
+        f'rsync {_EXPECTED_RSYNC_FLAGS} {self._tmpdir}/source/ {incomplete}/payload',
+        f'[Rename {incomplete} to {self._tmpdir}/backups/ysnap_20220314_235219]',
+    ])
+
+  def test_resume_changelog(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    processor = backup_processor.BackupProcessor(dryrun=False,
+                                                 verbose=False,
+                                                 only_if_changed=False,
+                                                 low_ram=True)
+    new_snapshot = os.path.join(self._backup_dir, 'ysnap_20220314_235219')
+    for killed in [False, True]:
+      incomplete = self._stop_backup('ysnap_20220313_000000', ['clone'])
+      fname = os.path.join(incomplete, changelog.CHANGELOG_FNAME)
+      writer = changelog.ChangelogWriter(fname)
+      writer.add(changelog.Change(changelog.ADDED, 'copied', 5))
+      writer.suspend()
+      if killed:
+        # Nothing was written from the buffers.
+        with open(fname + '.tmp', 'wb'):
+          pass
+      with mock.patch.object(backup_processor, '_run_with_output_handler'):
+        processor.process(self._source_dir,
+                          self._backup_dir,
+                          max_to_keep=-1,
+                          excludes=[],
+                          min_ttl=None)
+      fname = os.path.join(new_snapshot, changelog.CHANGELOG_FNAME)
+      snapshots = catalog.Catalog(self._backup_dir)
+      snapshot = snapshots.get('ysnap_20220314_235219')
+      snapshots.close()
+      assert snapshot is not None
+      if killed:
+        self.assertFalse(os.path.exists(fname))
+        self.assertIsNone(snapshot.changed_bytes)
+      else:
+        # Kept from before the stop.
+        self.assertEqual(list(changelog.read(fname)),
+                         [changelog.Change(changelog.ADDED, 'copied', 5)])
+        self.assertEqual(snapshot.changed_bytes, 5)
+      # No partial changelog is left behind.
+      expected = ['backup_context.json', 'payload']
+      if not killed:
+        expected.append(changelog.CHANGELOG_FNAME)
+      self.assertEqual(sorted(os.listdir(new_snapshot)), sorted(expected))
+      shutil.rmtree(new_snapshot)
+
+  def test_resume_first_backup(self):
+    incomplete = self._stop_backup(None, ['clone'])
+    cmds = self._process(self._source_dir, self._backup_dir, seed=True)
+    self.assertEqual(cmds[0], f'[Resume {incomplete} after clone]')
+    self.assertFalse(any(cmd.startswith('[Seed') for cmd in cmds))
+
+  def test_resume_inconsistent(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    previous = os.path.join(self._backup_dir, 'ysnap_20220313_000000')
+    processor = backup_processor.BackupProcessor(dryrun=False,
+                                                 verbose=False,
+                                                 only_if_changed=False,
+                                                 low_ram=True)
+    for base, phases in [
+        # Stopped while cloning.
+        ('ysnap_20220313_000000', []),
+        # Cloned from a snapshot that is not the latest.
+        ('ysnap_20220312_000000', ['clone']),
+        # No state.
+        (None, None),
+    ]:
+      incomplete = os.path.join(self._backup_dir, 'ysnap__incomplete')
+      if phases is None:
+        os.makedirs(os.path.join(incomplete, 'payload'))
+      else:
+        self._stop_backup(base, phases)
+      stale = os.path.join(incomplete, 'payload', 'stale')
+      with open(stale, 'w') as f:
+        f.write('stale')
+      with mock.patch.object(backup_processor, '_run_with_output_handler'):
+        cmds = list(
+            processor._process_iterator(self._source_dir,
+                                        self._backup_dir,
+                                        max_to_keep=-1,
+                                        excludes=[],
+                                        min_ttl=None))
+      self.assertEqual(cmds[:2], [
+          f'[Remove lingering {incomplete}]',
+          f'[Clone {previous} to {incomplete}]',
+      ], base)
+      new_snapshot = os.path.join(self._backup_dir, 'ysnap_20220314_235219')
+      self.assertFalse(
+          os.path.exists(os.path.join(new_snapshot, 'payload', 'stale')))
+      # The state is not kept in the snapshot.
+      self.assertFalse(
+          os.path.exists(os.path.join(new_snapshot, resume.STATE_FNAME)))
+      os.rename(new_snapshot, os.path.join(self._tmpdir, 'done'))
+      shutil.rmtree(os.path.join(self._tmpdir, 'done'))
+
+  def test_resource_governor(self):
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         resource_governor=governor.Governor(
+                             nice=10, ionice_class='idle', bwlimit='1m'))
+    prefix = 'nice -n 10 ionice -c 3 '
+    self.assertEqual(list(cmds), [
+        f'{prefix}mkdir {self._tmpdir}/backups/ysnap__incomplete',
+        f'{prefix}chown {self._user_and_group} {self._tmpdir}/backups/ysnap__incomplete',
+        f'[Store metadata at {self._tmpdir}/backups/ysnap__incomplete/backup_context.json]',
+        f'{prefix}rsync {_EXPECTED_RSYNC_FLAGS} --bwlimit=1m {self._tmpdir}/source/ {self._tmpdir}/backups/ysnap__incomplete/payload',
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
+    ])
+
+  def test_ram_budget(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    previous = f'{self._tmpdir}/backups/ysnap_20220313_000000'
+    data = metadata.Metadata(source=self._source_dir,
+                             epoch=1647129600,
+                             rsync_stats={'files': 1000})
+    data.save_to(os.path.join(previous, 'backup_context.json'))
+    for budget, expected_flags in [
+        (1 << 30,
+         _EXPECTED_RSYNC_FLAGS.replace('--delete',
+                                       '--no-inc-recursive --delete-after', 1)),
+        (1000, _EXPECTED_RSYNC_FLAGS),
+    ]:
+      cmds = self._process(
+          self._source_dir,
+          self._backup_dir,
+          resource_governor=governor.Governor(ram_budget=budget))
+      self.assertIn(
+          f'rsync {expected_flags} {self._tmpdir}/source/ {self._tmpdir}/backups/ysnap__incomplete/payload',
+          cmds, budget)
+
+  def test_dirty_dirs(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    previous = f'{self._tmpdir}/backups/ysnap_20220313_000000'
+    files_from = f'{self._tmpdir}/backups/ysnap__incomplete/files_from.txt'
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         dirty_dirs=['', 'a/b'])
+    # No probe, since there are known changes.
+    self.assertEqual(cmds, [
+        f'[Clone {previous} to {self._tmpdir}/backups/ysnap__incomplete]',
+        f'[Store metadata at {self._tmpdir}/backups/ysnap__incomplete/backup_context.json]',
+        f'[List 2 directories to update at {files_from}]',
+        f'rsync {_EXPECTED_RSYNC_FLAGS} {self._tmpdir}/source/ {self._tmpdir}/backups/ysnap__incomplete/payload --files-from={files_from} --dirs',
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
+    ])
+
+    with self.assertRaises(ValueError):
+      self._process(self._source_dir,
+                    self._backup_dir,
+                    snapshot_strategy='link-dest',
+                    dirty_dirs=[''])
+
+  def test_shards(self):
+    for name in ['a', 'b', 'c']:
+      os.mkdir(os.path.join(self._source_dir, name))
+    source = f'{self._tmpdir}/source'
+    payload = f'{self._tmpdir}/backups/ysnap__incomplete/payload'
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         excludes=['c'],
+                         shards=2)
+    self.assertEqual(cmds[3:6], [
+        f'rsync {_EXPECTED_RSYNC_FLAGS} {source}/ {payload} --no-recursive --dirs --exclude=c',
+        f'rsync {_EXPECTED_RSYNC_FLAGS} -R {source}/./a {payload} --exclude=c',
+        f'rsync {_EXPECTED_RSYNC_FLAGS} -R {source}/./b {payload} --exclude=c',
+    ])
+
+  def test_shards_with_spaces(self):
+    for name in ['My Documents', 'b']:
+      os.mkdir(os.path.join(self._source_dir, name))
+    processor = backup_processor.BackupProcessor(dryrun=False,
+                                                 verbose=False,
+                                                 only_if_changed=False,
+                                                 low_ram=True,
+                                                 shards=2)
+    with mock.patch.object(backup_processor,
+                           '_run_with_output_handler') as rsync:
+      processor.process(self._source_dir,
+                        self._backup_dir,
+                        max_to_keep=-1,
+                        excludes=[],
+                        min_ttl=None)
+    # A single argument.
+    self.assertTrue(
+        any(f'{self._source_dir}/./My Documents' in call.args[0]
+            for call in rsync.call_args_list))
+
+  def test_delete_older(self):
+    self._make_snapshot('ysnap_20220312_000000')
+    self._make_snapshot('ysnap_20220313_000000')
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         max_to_keep=2,
+                         reap_mode='inline')
+    self.assertEqual(cmds[-3:], [
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
+        f'[Move {self._tmpdir}/backups/ysnap_20220312_000000 to {self._tmpdir}/backups/.trash/ysnap_20220312_000000]',
+        f'[Reap {self._tmpdir}/backups/.trash]',
+    ])
+
+  def test_manifest(self):
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         write_manifest=True)
+    self.assertEqual(cmds[-2:], [
+        f'[Write manifest at {self._tmpdir}/backups/ysnap__incomplete/manifest.ymf]',
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
+    ])
+
+  def test_dedup(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    cmds = self._process(self._source_dir,
+                         self._backup_dir,
+                         write_manifest=True,
+                         dedup_files=True)
+    self.assertEqual(cmds[-3:], [
+        f'[Dedup {self._tmpdir}/backups/ysnap__incomplete against {self._tmpdir}/backups/ysnap_20220313_000000]',
+        f'[Write manifest at {self._tmpdir}/backups/ysnap__incomplete/manifest.ymf]',
+        f'[Rename {self._tmpdir}/backups/ysnap__incomplete to {self._tmpdir}/backups/ysnap_20220314_235219]',
+    ])
+
+  def test_probe(self):
+    self._make_snapshot('ysnap_20220313_000000')
+    previous = os.path.join(self._backup_dir, 'ysnap_20220313_000000')
+    processor = backup_processor.BackupProcessor(dryrun=False,
+                                                 verbose=False,
+                                                 only_if_changed=True,
+                                                 low_ram=True)
+    rsync_output: List[str] = []
+
+    def fake_rsync(args, output_handler):
+      for line in rsync_output:
+        output_handler(line)
+
+    with mock.patch.object(backup_processor,
+                           '_run_with_output_handler',
+                           side_effect=fake_rsync) as rsync:
+      # Nothing changed, so only the probe runs.
+      cmds = list(
+          processor._process_iterator(self._source_dir,
+                                      self._backup_dir,
+                                      max_to_keep=-1,
+                                      excludes=[],
+                                      min_ttl=None))
+      self.assertEqual(rsync.call_count, 1)
+      self.assertIn('--dry-run', rsync.call_args[0][0])
+      self.assertEqual(cmds[-1],
+                       f'[Update metadata at {previous}/backup_context.json]')
+      self.assertEqual(
+          metadata.Metadata.load_from(
+              os.path.join(previous, 'backup_context.json')).updated_epoch,
+          int(self._fake_now.timestamp()))
+      self.assertEqual(catalog.snapshot_names(self._backup_dir),
+                       ['ysnap_20220313_000000'])
+
+      # A change, so a new backup is made.
+      rsync_output.append('>f+++++++++:12:new file')
+      processor.process(self._source_dir,
+                        self._backup_dir,
+                        max_to_keep=-1,
+                        excludes=[],
+                        min_ttl=None)
+      self.assertEqual(rsync.call_count, 3)
+      self.assertTrue(
+          os.path.isdir(os.path.join(self._backup_dir,
+                                     'ysnap_20220314_235219')))
+
+  def test_elapsed_since_backup(self):
+    self.assertIsNone(backup_processor.elapsed_since_backup(self._backup_dir))
+    self._make_snapshot('ysnap_20220313_000000')
+    os.mkdir(os.path.join(self._backup_dir, 'ysnap__incomplete'))
+    # Created at 2022-03-13 00:00:00; now is 2022-03-14 23:52:19.
+    elapsed = self._fake_now.timestamp() - 1647129600
+    elapsed += backup_processor._ELAPSED_TIME_BUFFER
+    self.assertEqual(backup_processor.elapsed_since_backup(self._backup_dir),
+                     elapsed)
+
+  def test_profile(self):
+    profile_fname = os.path.join(self._tmpdir, 'profile.json')
+    processor = backup_processor.BackupProcessor(dryrun=True,
+                                                 verbose=False,
+                                                 only_if_changed=False,
+                                                 low_ram=False,
+                                                 profile_fname=profile_fname)
+    processor.process(source=self._source_dir,
+                      target=self._backup_dir,
+                      max_to_keep=-1,
+                      excludes=[],
+                      min_ttl=None)
+    with open(profile_fname) as f:
+      report = json.load(f)
+    self.assertEqual([span['name'] for span in report['spans']],
+                     ['scan', 'clone', 'rsync'])
+
+  def test_execute_sh_output(self):
+    processor = backup_processor.BackupProcessor(dryrun=False,
+                                                 verbose=False,
+                                                 only_if_changed=False,
+                                                 low_ram=False)
+    lines: List[str] = []
+
+    def run(args: List[str]) -> int:
+      steps = backup_processor.run_sync(
+          processor._execute_sh(args,
+                                error_ok=True,
+                                output_handler=lines.append))
+      try:
+        while True:
+          next(steps)
+      except StopIteration as e:
+        return e.value
+
+    self.assertEqual(run(['seq', '3']), 0)
+    self.assertEqual(lines, ['1', '2', '3'])
+    self.assertEqual(run(['false']), 1)
+    lines.clear()
+    # Progress lines from rsync end with a carriage return.
+    self.assertEqual(run(['printf', 'a\\rb\\r\\nc']), 0)
+    self.assertEqual(lines, ['a', 'b', 'c'])
+    lines.clear()
+    # Arguments are passed as they are.
+    self.assertEqual(run(['echo', 'a  b']), 0)
+    self.assertEqual(lines, ['a  b'])
+
+    lines.clear()
+    steps = backup_processor.run_sync(
+        processor._execute_parallel([['seq', '2'], ['false'], ['seq', '3']],
+                                    output_handler=lines.append))
+    self.assertEqual(next(steps), 'seq 2')
+    with self.assertRaises(StopIteration) as e:
+      while True:
+        next(steps)
+    self.assertEqual(e.exception.value, 1)
+    self.assertEqual(sorted(lines), ['1', '1', '2', '2', '3'])
+
+  def test_reaper_joined_on_error(self):
+    processor = backup_processor.BackupProcessor(dryrun=False,
+                                                 verbose=False,
+                                                 only_if_changed=False,
+                                                 low_ram=False)
+    background_reaper = mock.Mock()
+
+    def fail(**kwargs):
+      raise ValueError('Failed')
+      yield
+
+    processor._start_reaper = mock.Mock(  # type: ignore
+        return_value=background_reaper)
+    processor._backup_iterator = fail  # type: ignore
+    steps = processor.steps(self._source_dir, self._backup_dir, -1, [], None)
+    # Waited for by the driver, e.g. off its event loop, before the error.
+    step = next(steps)
+    assert isinstance(step, backup_processor.CallBlocking)
+    self.assertEqual(step.fn, background_reaper.join)
+    with self.assertRaisesRegex(ValueError, 'Failed'):
+      steps.send(step.fn())
+    background_reaper.join.assert_called_once_with()
+
   # Run the functions on an actual directory structure.
   def test_functional(self):
     with open(os.path.join(self._source_dir, 'file1.txt'), 'w') as f:
@@ -154,23 +645,53 @@ class TestBackupProcessor(unittest.TestCase):
       def_kwargs.update(kwargs)
       processor.process(self._source_dir, self._backup_dir, **def_kwargs)
 
+    def num_snapshots() -> int:
+      # Expired snapshots may wait in the trash, which is not counted.
+      return len(
+          [x for x in os.listdir(self._backup_dir) if x.startswith('ysnap_')])
+
     for _ in range(3):
       change_and_backup(max_to_keep=2)
     # Even though more than 8 backups were run, number of backups is restricted to 5.
-    self.assertEqual(len(os.listdir(self._backup_dir)), 2)
+    self.assertEqual(num_snapshots(), 2)
 
     change_and_backup(max_to_keep=2, min_ttl=60 * 60 * 24 * 365)
-    self.assertEqual(len(os.listdir(self._backup_dir)), 2)
+    self.assertEqual(num_snapshots(), 2)
     change_and_backup(max_to_keep=2, min_ttl=60 * 60 * 24 * 365)
-    self.assertEqual(len(os.listdir(self._backup_dir)), 2)
+    self.assertEqual(num_snapshots(), 2)
     change_and_backup(max_to_keep=2, min_ttl=60 * 60 * 24 * 365)
-    self.assertEqual(len(os.listdir(self._backup_dir)), 3)
+    self.assertEqual(num_snapshots(), 3)
 
-  def _process(self, *args, **kwargs_in) -> List[str]:
-    processor = backup_processor.BackupProcessor(dryrun=True,
-                                                 verbose=True,
-                                                 only_if_changed=True,
-                                                 low_ram=True)
+  def _make_snapshot(self, name: str) -> None:
+    snapshot_dir = os.path.join(self._backup_dir, name)
+    os.makedirs(os.path.join(snapshot_dir, 'payload'))
+    metadata.Metadata(source=self._source_dir, epoch=1647129600).save_to(
+        os.path.join(snapshot_dir, 'backup_context.json'))
+
+  def _process(self,
+               *args,
+               snapshot_strategy: str = 'native',
+               reap_mode: str = 'background',
+               write_manifest: bool = False,
+               shards: int = 1,
+               dedup_files: bool = False,
+               seed: bool = False,
+               chunk_threshold: Optional[int] = None,
+               resource_governor: Optional[governor.Governor] = None,
+               **kwargs_in) -> List[str]:
+    processor = backup_processor.BackupProcessor(
+        dryrun=True,
+        verbose=True,
+        only_if_changed=True,
+        low_ram=True,
+        snapshot_strategy=snapshot_strategy,
+        reap_mode=reap_mode,
+        write_manifest=write_manifest,
+        shards=shards,
+        dedup_files=dedup_files,
+        seed=seed,
+        chunk_threshold=chunk_threshold,
+        resource_governor=resource_governor)
     kwargs = dict(max_to_keep=-1, excludes=[], min_ttl=None)
     kwargs.update(kwargs_in)
     result = processor._process_iterator(*args, **kwargs)
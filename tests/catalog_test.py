@@ -0,0 +1,146 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from src.yaribak import catalog
+from src.yaribak import manifest
+from src.yaribak import metadata
+
+from typing import List
+
+
+class TestCatalog(unittest.TestCase):
+
+  def _make_snapshot(self, name: str, epoch: int) -> metadata.Metadata:
+    snapshot_dir = os.path.join(self._tmpdir, name)
+    os.makedirs(os.path.join(snapshot_dir, 'payload', 'dir'))
+    data = metadata.Metadata(source='/source', epoch=epoch)
+    data.save_to(os.path.join(snapshot_dir, 'backup_context.json'))
+    return data
+
+  def _names(self, snapshots: catalog.Catalog) -> List[str]:
+    return [snapshot.name for snapshot in snapshots.snapshots()]
+
+  def test_rebuild(self):
+    self._make_snapshot('ysnap_20220313_000000', 1647129600)
+    self._make_snapshot('ysnap_20220312_000000', 1647043200)
+    manifest.write_tree(
+        os.path.join(self._tmpdir, 'ysnap_20220313_000000', 'payload'),
+        os.path.join(self._tmpdir, 'ysnap_20220313_000000',
+                     manifest.MANIFEST_FNAME))
+    os.mkdir(os.path.join(self._tmpdir, 'ysnap__incomplete'))
+    os.mkdir(os.path.join(self._tmpdir, 'other'))
+
+    snapshots = catalog.Catalog(self._tmpdir)
+    self.assertEqual(self._names(snapshots),
+                     ['ysnap_20220312_000000', 'ysnap_20220313_000000'])
+    latest = snapshots.get('ysnap_20220313_000000')
+    assert latest is not None
+    self.assertEqual(latest.metadata.epoch, 1647129600)
+    self.assertEqual(latest.entries, 1)
+    oldest = snapshots.get('ysnap_20220312_000000')
+    assert oldest is not None
+    self.assertIsNone(oldest.entries)
+    snapshots.close()
+
+  def test_changes_are_tracked(self):
+    self._make_snapshot('ysnap_20220312_000000', 1647043200)
+    catalog.Catalog(self._tmpdir).close()
+
+    with mock.patch.object(catalog.Catalog, 'rebuild') as rebuild:
+      snapshots = catalog.Catalog(self._tmpdir)
+      data = self._make_snapshot('ysnap_20220313_000000', 1647129600)
+      snapshots.add(
+          catalog.Snapshot('ysnap_20220313_000000', data, seconds=1.5))
+      data.updated_epoch = 1647130000
+      snapshots.update_metadata('ysnap_20220313_000000', data)
+      shutil.rmtree(os.path.join(self._tmpdir, 'ysnap_20220312_000000'))
+      snapshots.remove('ysnap_20220312_000000')
+      snapshots.close()
+
+      # Nothing changed since, so the catalog is used as is.
+      snapshots = catalog.Catalog(self._tmpdir)
+      rebuild.assert_not_called()
+    self.assertEqual(self._names(snapshots), ['ysnap_20220313_000000'])
+    latest = snapshots.get('ysnap_20220313_000000')
+    assert latest is not None
+    self.assertEqual(latest.metadata.updated_epoch, 1647130000)
+    self.assertEqual(latest.seconds, 1.5)
+    snapshots.close()
+
+  def test_other_files(self):
+    self._make_snapshot('ysnap_20220313_000000', 1647129600)
+    catalog.Catalog(self._tmpdir).close()
+    # E.g. the hash cache, the trash and the chunk store.
+    with open(os.path.join(self._tmpdir, '.hash_cache.sqlite3'), 'w'):
+      pass
+    os.mkdir(os.path.join(self._tmpdir, '.trash'))
+    with mock.patch.object(catalog.Catalog, 'rebuild') as rebuild:
+      catalog.Catalog(self._tmpdir).close()
+    rebuild.assert_not_called()
+
+  def test_unreadable_snapshot(self):
+    self._make_snapshot('ysnap_20220313_000000', 1647129600)
+    os.mkdir(os.path.join(self._tmpdir, 'ysnap_20220314_000000'))
+    snapshots = catalog.Catalog(self._tmpdir)
+    self.assertEqual(self._names(snapshots), ['ysnap_20220313_000000'])
+    snapshots.close()
+    # Not rebuilt again for it.
+    with mock.patch.object(catalog.Catalog, 'rebuild') as rebuild:
+      catalog.Catalog(self._tmpdir).close()
+    rebuild.assert_not_called()
+
+  def test_external_change(self):
+    catalog.Catalog(self._tmpdir).close()
+    self._make_snapshot('ysnap_20220313_000000', 1647129600)
+    snapshots = catalog.Catalog(self._tmpdir)
+    self.assertEqual(self._names(snapshots), ['ysnap_20220313_000000'])
+    snapshots.close()
+
+  def test_corrupt(self):
+    self._make_snapshot('ysnap_20220313_000000', 1647129600)
+    with open(os.path.join(self._tmpdir, catalog.CATALOG_FNAME), 'w') as f:
+      f.write('not a database')
+    snapshots = catalog.Catalog(self._tmpdir)
+    self.assertEqual(self._names(snapshots), ['ysnap_20220313_000000'])
+    snapshots.close()
+
+  def test_format_snapshots(self):
+    data = metadata.Metadata(source='/source', epoch=1647129600)
+    table = catalog.format_snapshots([
+        catalog.Snapshot('ysnap_20220313_000000',
+                         data,
+                         entries=10,
+                         changed_bytes=2**20,
+                         seconds=2.0)
+    ]).splitlines()
+    self.assertEqual(len(table), 2)
+    self.assertTrue(table[1].startswith('ysnap_20220313_000000'))
+    self.assertTrue(table[1].endswith('10      1.0 MiB      2.0s'))
+
+  def setUp(self) -> None:
+    self._tmpdir_obj = tempfile.TemporaryDirectory(prefix='yaribak_test_')
+    self._tmpdir = self._tmpdir_obj.name
+
+  def tearDown(self) -> None:
+    self._tmpdir_obj.cleanup()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,123 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from src.yaribak import changelog
+
+from typing import List
+
+
+class TestChangelog(unittest.TestCase):
+
+  def test_parse_line(self):
+    cases = [
+        ('>f+++++++++:12:new file', changelog.Change('added', 'new file', 12)),
+        ('cd+++++++++:4096:new_dir/',
+         changelog.Change('added', 'new_dir/', 4096)),
+        ('hf+++++++++:5:linked', changelog.Change('added', 'linked', 5)),
+        ('>f.st......:7:a/b:c', changelog.Change('modified', 'a/b:c', 7)),
+        ('cL.c.......:3:link', changelog.Change('modified', 'link', 3)),
+        ('*deleting  :0:old', changelog.Change('deleted', 'old', 0)),
+        ('.f...p.....:7:chmod_only',
+         changelog.Change('attributes', 'chmod_only', 7)),
+        ('.d..t......:4096:./', changelog.Change('attributes', './', 4096)),
+        ('.f         :7:unchanged', None),
+        ('sending incremental file list', None),
+        ('sent 1,234 bytes  received 56 bytes  2,580.00 bytes/sec', None),
+        ('rsync: [sender] send_files failed to open "x": Permission denied',
+         None),
+    ]
+    for line, expected in cases:
+      self.assertEqual(changelog.parse_line(line), expected, line)
+
+  def test_parser_and_file(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      fname = os.path.join(tempdir, changelog.CHANGELOG_FNAME)
+      writer = changelog.ChangelogWriter(fname)
+      parser = changelog.RsyncOutputParser(writer)
+      self.assertFalse(parser.has_changes())
+      for line in [
+          'sending incremental file list',
+          '.d..t......:4096:./',
+          '>f+++++++++:12:new file',
+          '*deleting  :0:old',
+      ]:
+        parser(line)
+      writer.close()
+
+      self.assertTrue(parser.has_changes())
+      self.assertEqual(parser.counts, {'added': 1, 'deleted': 1})
+      self.assertEqual(list(changelog.read(fname)), [
+          changelog.Change('added', 'new file', 12),
+          changelog.Change('deleted', 'old', 0),
+      ])
+
+  def test_resume_partial(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      fname = os.path.join(tempdir, changelog.CHANGELOG_FNAME)
+      self.assertIsNone(changelog.set_aside_partial(fname))
+      writer = changelog.ChangelogWriter(fname)
+      writer.add(changelog.Change('added', 'before', 3))
+      writer.suspend()
+
+      stopped = changelog.set_aside_partial(fname)
+      assert stopped is not None
+      writer = changelog.ChangelogWriter(fname)
+      parser = changelog.RsyncOutputParser(writer)
+      self.assertTrue(changelog.read_partial(stopped, parser.add))
+      # Stopped again before it was removed, so it is read again.
+      self.assertEqual(changelog.set_aside_partial(fname), stopped)
+      os.remove(stopped)
+      parser('>f+++++++++:5:after')
+      writer.close()
+      self.assertEqual(parser.bytes, {'added': 8})
+      self.assertEqual(list(changelog.read(fname)), [
+          changelog.Change('added', 'before', 3),
+          changelog.Change('added', 'after', 5),
+      ])
+
+  def test_read_partial_cut_short(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      fname = os.path.join(tempdir, 'partial')
+      writer = changelog.ChangelogWriter(fname)
+      for i in range(1000):
+        writer.add(changelog.Change('added', f'file{i}', i))
+      writer.close()
+      with open(fname, 'r+b') as f:
+        f.truncate(os.path.getsize(fname) // 2)
+      received: List[changelog.Change] = []
+      self.assertFalse(changelog.read_partial(fname, received.append))
+      self.assertLess(len(received), 1000)
+      # As if killed before anything was written.
+      with open(fname, 'wb'):
+        pass
+      self.assertFalse(changelog.read_partial(fname, received.append))
+
+  def test_ignore_new_dirs(self):
+    parser = changelog.RsyncOutputParser(ignore_new_dirs=True)
+    parser('cd+++++++++:4096:new_dir/')
+    self.assertFalse(parser.has_changes())
+    parser('>f+++++++++:12:new_dir/file')
+    self.assertTrue(parser.has_changes())
+
+  def test_count_attributes(self):
+    parser = changelog.RsyncOutputParser()
+    parser('.f...p.....:7:chmod_only')
+    self.assertFalse(parser.has_changes())
+    parser = changelog.RsyncOutputParser(count_attributes=True)
+    parser('.f...p.....:7:chmod_only')
+    self.assertTrue(parser.has_changes())
@@ -0,0 +1,248 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.yaribak import changelog
+from src.yaribak import chunks
+
+from typing import List, Optional
+
+_CHUNK_SIZE = 4096
+_THRESHOLD = 3 * _CHUNK_SIZE
+
+
+def _block(seed: int) -> bytes:
+  return bytes([seed % 251]) * _CHUNK_SIZE
+
+
+class TestChunks(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    self._source = os.path.join(self._tmpdir, 'source')
+    os.mkdir(self._source)
+    self._target = os.path.join(self._tmpdir, 'backups')
+    os.mkdir(self._target)
+    self._store = chunks.store_dir(self._target)
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def _write(self, relpath: str, content: bytes) -> str:
+    path = os.path.join(self._source, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def _snapshot(self, name: str) -> str:
+    directory = os.path.join(self._target, name)
+    os.makedirs(os.path.join(directory, 'payload'))
+    return directory
+
+  def _chunk(self,
+             directory: str,
+             base: Optional[str] = None,
+             excludes: Optional[List[str]] = None,
+             dirty_dirs: Optional[List[str]] = None,
+             changes: Optional[List[changelog.Change]] = None
+             ) -> chunks.ChunkStats:
+    base_maps = None if base is None else os.path.join(base, chunks.MAPS_DIR)
+    return chunks.chunk_tree(self._source,
+                             os.path.join(directory, 'payload'),
+                             os.path.join(directory, chunks.MAPS_DIR),
+                             base_maps,
+                             self._store,
+                             _THRESHOLD,
+                             excludes or [],
+                             dirty_dirs=dirty_dirs,
+                             num_workers=2,
+                             on_change=None if changes is None else
+                             changes.append,
+                             chunk_size=_CHUNK_SIZE)
+
+  def _restore(self, directory: str, relpath: str) -> bytes:
+    dst = os.path.join(self._tmpdir, 'restored')
+    if os.path.exists(dst):
+      os.remove(dst)
+    chunks.restore_file(os.path.join(directory, chunks.MAPS_DIR, relpath),
+                        self._store, dst)
+    with open(dst, 'rb') as f:
+      return f.read()
+
+  def test_store_and_restore(self):
+    content = _block(1) + bytes(_CHUNK_SIZE) + _block(2) + b'tail'
+    path = self._write('dir/large', content)
+    os.utime(path, ns=(1000, 2000))
+    self._write('small', b'small')
+    snapshot = self._snapshot('ysnap_1')
+    # As left by rsync, from when the file was small.
+    os.mkdir(os.path.join(snapshot, 'payload', 'dir'))
+    with open(os.path.join(snapshot, 'payload', 'dir', 'large'), 'w') as f:
+      f.write('old')
+
+    changes: List[changelog.Change] = []
+    stats = self._chunk(snapshot, changes=changes)
+    self.assertEqual(stats.files, 1)
+    # Three blocks of data, and one of zeros which is not stored.
+    self.assertEqual(stats.blocks_written, 3)
+    self.assertEqual(stats.bytes_read, len(content))
+    self.assertEqual(changes,
+                     [changelog.Change(changelog.ADDED, 'dir/large',
+                                       len(content))])
+    map_path = os.path.join(snapshot, chunks.MAPS_DIR, 'dir', 'large')
+    self.assertEqual(os.stat(map_path).st_mtime_ns, 2000)
+    chunk_map = chunks.read_map(map_path)
+    self.assertEqual(chunk_map.size, len(content))
+    self.assertIsNone(chunk_map.digests[1])
+    self.assertFalse(
+        os.path.exists(os.path.join(snapshot, 'payload', 'dir', 'large')))
+    self.assertEqual(self._restore(snapshot, 'dir/large'), content)
+    self.assertFalse(
+        os.path.exists(os.path.join(snapshot, chunks.MAPS_DIR, 'small')))
+
+  def test_only_new_blocks(self):
+    blocks = [_block(i) for i in range(1, 9)]
+    self._write('large', b''.join(blocks))
+    self._write('same', _block(20) * 4)
+    first = self._snapshot('ysnap_1')
+    self._chunk(first)
+
+    # One block changes. Nothing is cloned, as with --link-dest.
+    blocks[5] = _block(100)
+    path = self._write('large', b''.join(blocks))
+    os.utime(path, ns=(0, 10**18))
+    second = self._snapshot('ysnap_2')
+    changes: List[changelog.Change] = []
+    stats = self._chunk(second, base=first, changes=changes)
+    self.assertEqual(stats.files, 1)
+    self.assertEqual(stats.unchanged, 1)
+    self.assertEqual(stats.blocks_written, 1)
+    self.assertEqual(stats.blocks_reused, 7)
+    self.assertEqual(
+        changes,
+        [changelog.Change(changelog.MODIFIED, 'large', 8 * _CHUNK_SIZE)])
+    # The unchanged file's map is shared.
+    self.assertEqual(
+        os.stat(os.path.join(first, chunks.MAPS_DIR, 'same')).st_ino,
+        os.stat(os.path.join(second, chunks.MAPS_DIR, 'same')).st_ino)
+    self.assertEqual(self._restore(second, 'large'), b''.join(blocks))
+    self.assertNotEqual(self._restore(first, 'large'), b''.join(blocks))
+
+  def test_attributes(self):
+    path = self._write('large', _block(1) * 4)
+    first = self._snapshot('ysnap_1')
+    self._chunk(first)
+    os.chmod(path, 0o600)
+    second = self._snapshot('ysnap_2')
+    stats = self._chunk(second, base=first)
+    self.assertEqual((stats.files, stats.attributes, stats.bytes_read),
+                     (0, 1, 0))
+    self.assertTrue(stats.changed)
+    self.assertEqual(
+        os.stat(os.path.join(second, chunks.MAPS_DIR, 'large')).st_mode & 0o777,
+        0o600)
+    # A second run finds it unchanged.
+    self.assertFalse(self._chunk(second, base=first).changed)
+
+  def test_removed(self):
+    self._write('a/b/large', _block(1) * 4)
+    self._write('a/shrinks', _block(2) * 4)
+    self._write('a/excluded', _block(3) * 4)
+    snapshot = self._snapshot('ysnap_1')
+    self._chunk(snapshot)
+    maps = os.path.join(snapshot, chunks.MAPS_DIR)
+    self.assertEqual(
+        sorted(os.listdir(os.path.join(maps, 'a'))),
+        ['b', 'excluded', 'shrinks'])
+
+    shutil.rmtree(os.path.join(self._source, 'a', 'b'))
+    self._write('a/shrinks', b'small')
+    changes: List[changelog.Change] = []
+    stats = self._chunk(snapshot, excludes=['excluded'], changes=changes)
+    self.assertEqual(stats.removed, 3)
+    self.assertEqual(
+        sorted(change.path for change in changes),
+        ['a/b/large', 'a/excluded', 'a/shrinks'])
+    self.assertTrue(all(change.kind == changelog.DELETED for change in changes))
+    # Directories left empty are removed.
+    self.assertEqual(os.listdir(maps), [])
+
+  def test_dirty_dirs(self):
+    self._write('clean/large', _block(1) * 4)
+    self._write('dirty/large', _block(2) * 4)
+    self._write('dirty/sub/large', _block(3) * 4)
+    snapshot = self._snapshot('ysnap_1')
+    self._chunk(snapshot)
+
+    self._write('clean/large', _block(4) * 4)
+    self._write('dirty/large', _block(5) * 4)
+    shutil.rmtree(os.path.join(self._source, 'dirty', 'sub'))
+    stats = self._chunk(snapshot, dirty_dirs=['dirty'])
+    # Only the dirty directory is checked.
+    self.assertEqual((stats.files, stats.removed), (1, 1))
+    self.assertEqual(self._restore(snapshot, 'clean/large'), _block(1) * 4)
+    self.assertEqual(self._restore(snapshot, 'dirty/large'), _block(5) * 4)
+    self.assertFalse(
+        os.path.exists(os.path.join(snapshot, chunks.MAPS_DIR, 'dirty', 'sub')))
+
+  def test_has_changes(self):
+    path = self._write('large', _block(1) * 4)
+    snapshot = self._snapshot('ysnap_1')
+    maps = os.path.join(snapshot, chunks.MAPS_DIR)
+    self.assertTrue(
+        chunks.has_changes(self._source, maps, _THRESHOLD, [], num_workers=2))
+    self._chunk(snapshot)
+    self.assertFalse(
+        chunks.has_changes(self._source, maps, _THRESHOLD, [], num_workers=2))
+    self.assertTrue(
+        chunks.has_changes(self._source, maps, _THRESHOLD, ['large']))
+    os.utime(path, ns=(0, 10**18))
+    self.assertTrue(chunks.has_changes(self._source, maps, _THRESHOLD, []))
+
+  def test_collect_garbage(self):
+    self._write('large', _block(1) * 2 + _block(2) * 2)
+    old = self._snapshot('ysnap_1')
+    self._chunk(old)
+    self._write('large', _block(1) * 2 + _block(3) * 2)
+    new = self._snapshot('ysnap_2')
+    self._chunk(new, base=old)
+    self.assertEqual(len(os.listdir(self._store)), 3)
+
+    shutil.rmtree(old)
+    # Too recent.
+    self.assertEqual(chunks.collect_garbage(self._target).blocks, 0)
+    stats = chunks.collect_garbage(self._target, grace_secs=-60)
+    self.assertEqual(stats.blocks, 1)
+    self.assertEqual(self._restore(new, 'large'),
+                     _block(1) * 2 + _block(3) * 2)
+
+  def test_unreadable_map(self):
+    self._write('large', _block(1) * 4)
+    snapshot = self._snapshot('ysnap_1')
+    self._chunk(snapshot)
+    with open(os.path.join(snapshot, chunks.MAPS_DIR, 'large'), 'w') as f:
+      f.write('garbage')
+    with self.assertRaises(ValueError):
+      chunks.collect_garbage(self._target, grace_secs=-60)
+    self.assertEqual(len(os.listdir(self._store)), 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
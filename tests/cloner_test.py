@@ -0,0 +1,63 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import tempfile
+import unittest
+
+from src.yaribak import cloner
+
+
+class TestCloner(unittest.TestCase):
+
+  def test_clone_tree(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_cloner_test_') as tempdir:
+      source = os.path.join(tempdir, 'source')
+      dest = os.path.join(tempdir, 'dest')
+      os.makedirs(os.path.join(source, 'a', 'b'))
+      os.makedirs(os.path.join(source, 'empty'))
+      with open(os.path.join(source, 'file1'), 'w') as f:
+        f.write('hello 1')
+      with open(os.path.join(source, 'a', 'b', 'file2'), 'w') as f:
+        f.write('hello 2')
+      os.symlink('does_not_exist', os.path.join(source, 'a', 'dangling'))
+      os.mkfifo(os.path.join(source, 'a', 'fifo'))
+      os.chmod(os.path.join(source, 'a', 'b'), 0o750)
+      os.setxattr(os.path.join(source, 'a'), 'user.test', b'value')
+      os.utime(os.path.join(source, 'a'), ns=(1_000_000_000, 2_000_000_000))
+
+      stats = cloner.clone_tree(source, dest, num_workers=3)
+
+      self.assertEqual(stats.directories, 3)
+      self.assertEqual(stats.links, 4)
+      for relpath in ['file1', 'a/b/file2', 'a/dangling', 'a/fifo']:
+        self.assertEqual(
+            os.lstat(os.path.join(source, relpath)).st_ino,
+            os.lstat(os.path.join(dest, relpath)).st_ino, relpath)
+      self.assertTrue(os.path.islink(os.path.join(dest, 'a', 'dangling')))
+      self.assertTrue(
+          stat.S_ISFIFO(os.lstat(os.path.join(dest, 'a', 'fifo')).st_mode))
+      self.assertTrue(os.path.isdir(os.path.join(dest, 'empty')))
+      self.assertEqual(
+          stat.S_IMODE(os.lstat(os.path.join(dest, 'a', 'b')).st_mode), 0o750)
+      self.assertEqual(os.getxattr(os.path.join(dest, 'a'), 'user.test'),
+                       b'value')
+      self.assertEqual(
+          os.lstat(os.path.join(dest, 'a')).st_mtime_ns, 2_000_000_000)
+
+  def test_dest_exists(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_cloner_test_') as tempdir:
+      with self.assertRaises(FileExistsError):
+        cloner.clone_tree(tempdir, tempdir)
@@ -0,0 +1,98 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.yaribak import copier
+
+
+class TestCopier(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    self._src = os.path.join(self._tmpdir, 'src')
+    self._dst = os.path.join(self._tmpdir, 'dst')
+    self._content = bytes(range(256)) * 5000
+    with open(self._src, 'wb') as f:
+      f.write(self._content)
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def _copied(self) -> bytes:
+    with open(self._dst, 'rb') as f:
+      return f.read()
+
+  def test_copy_file(self):
+    self.assertEqual(copier.copy_file(self._src, self._dst),
+                     len(self._content))
+    self.assertEqual(self._copied(), self._content)
+    # The destination must not exist.
+    with self.assertRaises(FileExistsError):
+      copier.copy_file(self._src, self._dst)
+
+  def test_fallbacks(self):
+    unsupported = OSError(errno.EXDEV, 'Cross-device link')
+    with mock.patch.object(os, 'copy_file_range', side_effect=unsupported):
+      copier.copy_file(self._src, self._dst)
+    self.assertEqual(self._copied(), self._content)
+
+    os.remove(self._dst)
+    with mock.patch.object(os, 'copy_file_range', side_effect=unsupported):
+      with mock.patch.object(os, 'sendfile', side_effect=unsupported):
+        copier.copy_file(self._src, self._dst)
+    self.assertEqual(self._copied(), self._content)
+
+  def test_sparse(self):
+    sparse = os.path.join(self._tmpdir, 'sparse')
+    with open(sparse, 'wb') as f:
+      f.write(b'start')
+      f.seek(8 << 20)
+      f.write(b'middle')
+      # Ends with a hole.
+      f.truncate(16 << 20)
+    copied = copier.copy_file(sparse, self._dst)
+    with open(sparse, 'rb') as f:
+      self.assertEqual(self._copied(), f.read())
+    st = os.stat(sparse)
+    if st.st_blocks * 512 < st.st_size:
+      # The filesystem keeps holes, so only the data is copied.
+      self.assertLess(copied, st.st_size)
+      self.assertLessEqual(os.stat(self._dst).st_blocks, st.st_blocks)
+
+  def test_copy_contents_count(self):
+    with open(self._src, 'rb') as fsrc, open(self._dst, 'xb') as fdst:
+      os.lseek(fsrc.fileno(), 10, os.SEEK_SET)
+      self.assertEqual(copier.copy_contents(fsrc.fileno(), fdst.fileno(), 100),
+                       100)
+    self.assertEqual(self._copied(), self._content[10:110])
+
+  def test_copy_metadata(self):
+    os.chmod(self._src, 0o640)
+    os.utime(self._src, ns=(1000, 2000))
+    with open(self._dst, 'w'):
+      pass
+    copier.copy_metadata(self._src, self._dst)
+    st = os.stat(self._dst)
+    self.assertEqual(st.st_mode & 0o777, 0o640)
+    self.assertEqual(st.st_mtime_ns, 2000)
+
+
+if __name__ == '__main__':
+  unittest.main()
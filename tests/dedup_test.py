@@ -0,0 +1,122 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from src.yaribak import changelog
+from src.yaribak import dedup
+from src.yaribak import hash_cache
+from src.yaribak import manifest
+
+from typing import Optional
+
+
+class TestDedup(unittest.TestCase):
+
+  def _write(self, relpath: str, content: bytes, mode: int = 0o644) -> str:
+    path = os.path.join(self._tmpdir, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(content)
+    os.chmod(path, mode)
+    os.utime(path, ns=(0, 1647129600 * 10**9))
+    return path
+
+  def _dedup(self,
+             changelog_fname: Optional[str] = None,
+             manifest_fname: Optional[str] = None) -> dedup.DedupStats:
+    with hash_cache.HashCache(os.path.join(self._tmpdir,
+                                           hash_cache.CACHE_FNAME)) as cache:
+      return dedup.dedup(self._new,
+                         self._old,
+                         cache,
+                         changelog_fname=changelog_fname,
+                         manifest_fname=manifest_fname,
+                         min_size=4)
+
+  def _same_inode(self, relpath1: str, relpath2: str) -> bool:
+    return (os.lstat(os.path.join(self._tmpdir, relpath1)).st_ino == os.lstat(
+        os.path.join(self._tmpdir, relpath2)).st_ino)
+
+  def test_dedup(self):
+    stats = self._dedup()
+    self.assertEqual(stats.candidates, 5)
+    self.assertEqual(stats.linked, 2)
+    self.assertEqual(stats.bytes_reclaimed, 16)
+    # Moved, and copied within the new snapshot.
+    self.assertTrue(self._same_inode('new/moved/media', 'old/media'))
+    self.assertTrue(self._same_inode('new/copy2', 'new/copy1'))
+    # Different content, attributes, and a file that was not moved.
+    self.assertFalse(self._same_inode('new/other', 'old/other'))
+    self.assertFalse(self._same_inode('new/executable', 'old/media'))
+    self.assertFalse(self._same_inode('new/tiny', 'old/tiny'))
+    with open(os.path.join(self._new, 'moved', 'media'), 'rb') as f:
+      self.assertEqual(f.read(), b'media file')
+    self.assertEqual(
+        sorted(os.listdir(self._new)),
+        ['copy1', 'copy2', 'executable', 'moved', 'other', 'tiny', 'unchanged'])
+
+    # Already linked files are not considered again.
+    self.assertEqual(self._dedup().candidates, 2)
+
+  def test_long_names_and_leftovers(self):
+    long_name = 'm' * 255
+    self._write(f'new/{long_name}', b'media file')
+    leftover = os.path.join(self._tmpdir, 'dedup_tmp', '0')
+    self._write('dedup_tmp/0', b'left by a stopped dedup')
+    stats = self._dedup()
+    self.assertEqual(stats.linked, 3)
+    self.assertTrue(self._same_inode(f'new/{long_name}', 'old/media'))
+    self.assertFalse(os.path.exists(os.path.dirname(leftover)))
+
+  def test_with_changelog_and_manifest(self):
+    changelog_fname = os.path.join(self._tmpdir, changelog.CHANGELOG_FNAME)
+    writer = changelog.ChangelogWriter(changelog_fname)
+    writer.add(changelog.Change(changelog.ADDED, 'moved/', 0))
+    writer.add(changelog.Change(changelog.ADDED, 'moved/media', 10))
+    writer.add(changelog.Change(changelog.DELETED, 'media', 10))
+    writer.close()
+    manifest_fname = os.path.join(self._tmpdir, manifest.MANIFEST_FNAME)
+    manifest.write_tree(self._old, manifest_fname)
+
+    stats = self._dedup(changelog_fname, manifest_fname)
+    self.assertEqual(stats.candidates, 1)
+    self.assertEqual(stats.linked, 1)
+    self.assertTrue(self._same_inode('new/moved/media', 'old/media'))
+
+  def setUp(self) -> None:
+    self._tmpdir_obj = tempfile.TemporaryDirectory(prefix='yaribak_test_')
+    self._tmpdir = self._tmpdir_obj.name
+    self._old = os.path.join(self._tmpdir, 'old')
+    self._new = os.path.join(self._tmpdir, 'new')
+    self._write('old/media', b'media file')
+    self._write('old/other', b'other file')
+    self._write('old/tiny', b'x')
+    self._write('new/moved/media', b'media file')
+    self._write('new/other', b'OTHER FILE')
+    self._write('new/executable', b'media file', mode=0o755)
+    self._write('new/tiny', b'x')
+    self._write('new/copy1', b'copied')
+    self._write('new/copy2', b'copied')
+    os.link(self._write('old/unchanged', b'unchanged'),
+            os.path.join(self._new, 'unchanged'))
+
+  def tearDown(self) -> None:
+    self._tmpdir_obj.cleanup()
+
+
+if __name__ == '__main__':
+  unittest.main()
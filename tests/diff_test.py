@@ -0,0 +1,109 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import builtins
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.yaribak import archive
+from src.yaribak import catalog
+from src.yaribak import cloner
+from src.yaribak import diff
+from src.yaribak import manifest
+from src.yaribak import metadata
+
+from typing import List, Tuple
+
+
+def _write(path: str, content: str) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    f.write(content)
+
+
+class TestDiff(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    self._old = catalog.Snapshot('ysnap_1', metadata.Metadata('/source', 1))
+    self._new = catalog.Snapshot('ysnap_2', metadata.Metadata('/source', 2))
+    old_payload = os.path.join(self._tmpdir, 'ysnap_1', 'payload')
+    _write(os.path.join(old_payload, 'same'), 'same')
+    _write(os.path.join(old_payload, 'modified'), 'old')
+    _write(os.path.join(old_payload, 'gone', 'file'), 'gone')
+    os.mkdir(os.path.join(self._tmpdir, 'ysnap_2'))
+    new_payload = os.path.join(self._tmpdir, 'ysnap_2', 'payload')
+    cloner.clone_tree(old_payload, new_payload)
+    os.remove(os.path.join(new_payload, 'modified'))
+    _write(os.path.join(new_payload, 'modified'), 'newer')
+    os.remove(os.path.join(new_payload, 'gone', 'file'))
+    os.rmdir(os.path.join(new_payload, 'gone'))
+    _write(os.path.join(new_payload, 'a', 'added'), 'added')
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def _diff(self) -> List[Tuple[str, str, int]]:
+    differences = diff.diff(diff.records(self._tmpdir, self._old),
+                            diff.records(self._tmpdir, self._new))
+    return [(it.kind, it.path, it.delta)
+            for it in differences
+            if not it.path.endswith('/')]
+
+  def _expected(self) -> List[Tuple[str, str, int]]:
+    return [
+        ('added', 'a/added', 5),
+        ('deleted', 'gone/file', -4),
+        ('modified', 'modified', 2),
+    ]
+
+  def test_walk(self):
+    # No file is opened, i.e. contents are never read.
+    with mock.patch.object(builtins, 'open') as mock_open:
+      self.assertEqual(self._diff(), self._expected())
+    mock_open.assert_not_called()
+
+  def test_directories(self):
+    differences = diff.diff(diff.records(self._tmpdir, self._old),
+                            diff.records(self._tmpdir, self._new))
+    self.assertEqual([(it.kind, it.path)
+                      for it in differences
+                      if it.path.endswith('/')], [('added', 'a/'),
+                                                  ('deleted', 'gone/')])
+
+  def test_manifest_and_archive(self):
+    directory = os.path.join(self._tmpdir, 'ysnap_1')
+    archive.write(os.path.join(directory, 'payload'),
+                  os.path.join(directory, archive.ARCHIVE_FNAME),
+                  os.path.join(directory, archive.REFS_DIR))
+    self._old.metadata.archive = archive.ARCHIVE_FNAME
+    directory = os.path.join(self._tmpdir, 'ysnap_2')
+    manifest.write_tree(os.path.join(directory, 'payload'),
+                        os.path.join(directory, manifest.MANIFEST_FNAME))
+    self.assertEqual(self._diff(), self._expected())
+
+  def test_summary(self):
+    summary = diff.DiffSummary()
+    for difference in diff.diff(diff.records(self._tmpdir, self._old),
+                                diff.records(self._tmpdir, self._new)):
+      summary.add(difference)
+    self.assertEqual(summary.counts['modified'], 1)
+    self.assertEqual(summary.deltas['modified'], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,58 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from src.yaribak import exclusion
+
+
+class TestExclusion(unittest.TestCase):
+
+  def _check(self, pattern: str, excluded, kept, is_dir: bool = False):
+    excluder = exclusion.Excluder([pattern])
+    for relpath in excluded:
+      self.assertTrue(excluder.excludes(relpath, is_dir), (pattern, relpath))
+    for relpath in kept:
+      self.assertFalse(excluder.excludes(relpath, is_dir), (pattern, relpath))
+
+  def test_name(self):
+    self._check('*.tmp', ['a.tmp', 'dir/b.tmp'], ['a.tmp.gz', 'a.tmp/b'])
+    self._check('cache', ['cache', 'a/cache'], ['cached', 'a/cache/b'])
+    self._check('file?', ['file1', 'a/file2'], ['file', 'file12'])
+    self._check('[ab].txt', ['a.txt', 'x/b.txt'], ['c.txt'])
+    self._check('[!ab].txt', ['c.txt'], ['a.txt'])
+
+  def test_anchored(self):
+    self._check('/cache', ['cache'], ['a/cache'])
+    self._check('/a/*/c', ['a/b/c'], ['a/b/b/c', 'x/a/b/c'])
+
+  def test_path(self):
+    self._check('deep/path', ['deep/path', 'x/deep/path'],
+                ['deep/path/file', 'xdeep/path', 'deep/pathx'])
+    self._check('cache/*.tmp', ['cache/a.tmp', 'x/cache/a.tmp'],
+                ['cache/x/a.tmp'])
+    self._check('a/**/z', ['a/b/z', 'a/b/c/z', 'x/a/b/z'], ['a/z/b'])
+
+  def test_dir_only(self):
+    excluder = exclusion.Excluder(['cache/'])
+    self.assertTrue(excluder.excludes('a/cache', True))
+    self.assertFalse(excluder.excludes('a/cache', False))
+
+  def test_ignores_empty(self):
+    excluder = exclusion.Excluder(['', '/', '//'])
+    self.assertFalse(excluder.excludes('a', True))
+
+
+if __name__ == '__main__':
+  unittest.main()
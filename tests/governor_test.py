@@ -0,0 +1,88 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from unittest import mock
+
+from src.yaribak import governor
+from src.yaribak import metadata
+
+
+class TestGovernor(unittest.TestCase):
+
+  def test_parse_size(self):
+    self.assertEqual(governor.parse_size('100'), 100)
+    self.assertEqual(governor.parse_size('2k'), 2048)
+    self.assertEqual(governor.parse_size('512M'), 512 << 20)
+    self.assertEqual(governor.parse_size('1.5GiB'), 3 << 29)
+    self.assertEqual(governor.parse_size(' 1 TB '), 1 << 40)
+    for size in ['', 'M', '1X', '-1M', '1MM']:
+      with self.assertRaises(ValueError, msg=size):
+        governor.parse_size(size)
+
+  def test_validation(self):
+    governor.Governor(nice=0, ionice_class='best-effort')
+    with self.assertRaises(ValueError):
+      governor.Governor(nice=20)
+    with self.assertRaises(ValueError):
+      governor.Governor(nice=-1)
+    with self.assertRaises(ValueError):
+      governor.Governor(ionice_class='realtime')
+
+  @mock.patch('os.getpriority', return_value=0)
+  def test_command_prefix(self, _):
+    self.assertEqual(governor.Governor().command_prefix(), [])
+    self.assertEqual(governor.Governor(nice=5).command_prefix(),
+                     ['nice', '-n', '5'])
+    self.assertEqual(
+        governor.Governor(nice=19, ionice_class='idle').command_prefix(),
+        ['nice', '-n', '19', 'ionice', '-c', '3'])
+
+  @mock.patch('os.getpriority', return_value=3)
+  def test_command_prefix_absolute_nice(self, _):
+    # Children get the same niceness as worker threads, not 3 more.
+    self.assertEqual(governor.Governor(nice=5).command_prefix(),
+                     ['nice', '-n', '2'])
+
+  def test_rsync_flags(self):
+    self.assertEqual(governor.Governor().rsync_flags(), [])
+    self.assertEqual(
+        governor.Governor(bwlimit='20m').rsync_flags(), ['--bwlimit=20m'])
+
+  def test_low_ram(self):
+    # Without a budget or a prediction, the default is kept.
+    self.assertTrue(governor.Governor().low_ram(10**9, default=True))
+    budgeted = governor.Governor(ram_budget=1 << 20)
+    self.assertFalse(budgeted.low_ram(None, default=False))
+    self.assertTrue(budgeted.low_ram(None, default=True))
+
+    fits = (1 << 20) // governor.BYTES_PER_FILE
+    self.assertFalse(budgeted.low_ram(fits, default=True))
+    self.assertTrue(budgeted.low_ram(fits + 1, default=False))
+
+  def test_predicted_files(self):
+    data = metadata.Metadata(source='/src', epoch=0)
+    self.assertIsNone(governor.predicted_files(data, None))
+    self.assertEqual(governor.predicted_files(data, 7), 7)
+    data.rsync_stats = {'files': 12.0}
+    self.assertEqual(governor.predicted_files(data, 7), 12)
+
+  def test_apply_to_thread(self):
+    # Should not raise, even where priorities cannot be changed.
+    governor.Governor().apply_to_thread()
+
+
+if __name__ == '__main__':
+  unittest.main()
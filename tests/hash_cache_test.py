@@ -0,0 +1,67 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import tempfile
+import unittest
+
+from src.yaribak import hash_cache
+
+
+class TestHashCache(unittest.TestCase):
+
+  def test_cache(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tmpdir:
+      fname = os.path.join(tmpdir, 'file')
+      with open(fname, 'wb') as f:
+        f.write(b'hello')
+      cache_fname = os.path.join(tmpdir, hash_cache.CACHE_FNAME)
+      expected = hashlib.sha256(b'hello').digest()
+
+      with hash_cache.HashCache(cache_fname) as cache:
+        self.assertEqual(cache.digest(fname, os.lstat(fname)), expected)
+        self.assertEqual(cache.bytes_hashed, 5)
+        self.assertEqual(cache.hits, 0)
+
+      # Persisted, and the file is not read again.
+      with hash_cache.HashCache(cache_fname) as cache:
+        self.assertEqual(cache.digest(fname, os.lstat(fname)), expected)
+        self.assertEqual(cache.bytes_hashed, 0)
+        self.assertEqual(cache.hits, 1)
+
+        # A different mtime invalidates the entry.
+        os.utime(fname, ns=(0, 12345))
+        self.assertIsNone(cache.get(os.lstat(fname)))
+        self.assertEqual(cache.digest(fname, os.lstat(fname)), expected)
+        self.assertEqual(cache.bytes_hashed, 5)
+
+  def test_prune(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tmpdir:
+      fnames = [os.path.join(tmpdir, name) for name in ['a', 'b']]
+      for fname in fnames:
+        with open(fname, 'wb') as f:
+          f.write(b'hello')
+      with hash_cache.HashCache(os.path.join(tmpdir,
+                                             hash_cache.CACHE_FNAME)) as cache:
+        for fname in fnames:
+          cache.digest(fname, os.lstat(fname))
+        st = os.lstat(fnames[0])
+        self.assertEqual(cache.prune({(st.st_dev, st.st_ino)}), 1)
+        self.assertIsNotNone(cache.get(st))
+        self.assertIsNone(cache.get(os.lstat(fnames[1])))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import threading
+import unittest
+
+from src.yaribak import manifest
+
+
+class TestManifest(unittest.TestCase):
+
+  def test_write_and_read(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      payload = os.path.join(tempdir, 'payload')
+      os.makedirs(os.path.join(payload, 'a', 'b'))
+      for relpath in ['a.txt', 'a/b/file1', 'a/file2', 'z']:
+        with open(os.path.join(payload, relpath), 'w') as f:
+          f.write(relpath)
+      os.link(os.path.join(payload, 'z'), os.path.join(payload, 'a', 'z2'))
+      os.symlink('a.txt', os.path.join(payload, 'link'))
+      fname = os.path.join(tempdir, manifest.MANIFEST_FNAME)
+
+      self.assertEqual(manifest.write_tree(payload, fname), 8)
+
+      with manifest.Manifest(fname) as data:
+        self.assertEqual(len(data), 8)
+        # Sorted like a depth-first walk.
+        self.assertEqual([e.path for e in data], [
+            'a', 'a/b', 'a/b/file1', 'a/file2', 'a/z2', 'a.txt', 'link', 'z'
+        ])
+        for entry in data:
+          st = os.lstat(os.path.join(payload, entry.path))
+          self.assertEqual(
+              entry,
+              manifest.Entry(entry.path, st.st_ino, st.st_size,
+                             st.st_mtime_ns, st.st_mode, st.st_nlink))
+        found = data.find('a/z2')
+        assert found is not None
+        self.assertEqual(found.nlink, 2)
+        self.assertIsNone(data.find('a/b/missing'))
+        self.assertEqual(data.bisect('a/b'), 1)
+        self.assertEqual(data.bisect('b'), 6)
+
+  def test_write_with_initializer(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      payload = os.path.join(tempdir, 'payload')
+      os.makedirs(os.path.join(payload, 'a'))
+      threads = []
+
+      def initializer():
+        threads.append(threading.get_ident())
+
+      fname = os.path.join(tempdir, manifest.MANIFEST_FNAME)
+      self.assertEqual(manifest.write_tree(payload, fname, initializer), 1)
+      # Called in a thread of its own.
+      self.assertEqual(len(threads), 1)
+      self.assertNotEqual(threads[0], threading.get_ident())
+
+  def test_out_of_order(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      st = os.lstat(tempdir)
+      writer = manifest.ManifestWriter(os.path.join(tempdir, 'm'), st)
+      writer.add(manifest.path_key('b'), st)
+      with self.assertRaises(ValueError):
+        writer.add(manifest.path_key('a'), st)
+      writer.abort()
+
+  def test_not_a_manifest(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      fname = os.path.join(tempdir, 'm')
+      with open(fname, 'w') as f:
+        f.write('not a manifest, but long enough to have a footer')
+      with self.assertRaises(ValueError):
+        manifest.Manifest(fname)
@@ -29,8 +29,26 @@ class TestMetadata(unittest.TestCase):
         'source': '/path/to/source',
         'epoch': 1234,
         'updated_epoch': None,
-        'min_ttl': None
+        'min_ttl': None,
+        'rsync_stats': None,
+        'usage': None,
+        'usage_key': None,
+        'archive': None
     })
 
     data2 = metadata.Metadata.fromjson(json_str)
     self.assertEqual(data, data2)
+
+  def test_rsync_stats(self):
+    data = metadata.Metadata(source='/path/to/source',
+                             epoch=1234,
+                             rsync_stats={
+                                 'files': 10,
+                                 'seconds': 1.5
+                             })
+    self.assertEqual(metadata.Metadata.fromjson(data.asjson()), data)
+
+  def test_old_json(self):
+    data = metadata.Metadata.fromjson(
+        '{"source": "/path/to/source", "epoch": 1234}')
+    self.assertIsNone(data.rsync_stats)
@@ -0,0 +1,58 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from src.yaribak import parallel_walk
+
+from typing import List
+
+
+class TestParallelWalk(unittest.TestCase):
+
+  def test_visits_all(self):
+    visited: List[int] = []
+    lock = threading.Lock()
+
+    # Visits a binary tree of 127 nodes.
+    def visit(node: int) -> List[int]:
+      with lock:
+        visited.append(node)
+      return [2 * node, 2 * node + 1] if node < 64 else []
+
+    parallel_walk.run([1], visit, num_workers=4)
+    self.assertEqual(sorted(visited), list(range(1, 128)))
+
+  def test_raises(self):
+
+    def visit(node: int) -> List[int]:
+      if node == 5:
+        raise ValueError('bad node')
+      return [node + 1]
+
+    with self.assertRaisesRegex(ValueError, 'bad node'):
+      parallel_walk.run([0], visit, num_workers=2)
+
+  def test_stop(self):
+    stop = threading.Event()
+
+    def visit(node: int) -> List[int]:
+      if node == 10:
+        stop.set()
+      # Would never end without the stop.
+      return [node + 1]
+
+    parallel_walk.run([0], visit, num_workers=2, stop=stop)
+    self.assertTrue(stop.is_set())
@@ -0,0 +1,84 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+
+from src.yaribak import profiler
+
+
+class TestProfiler(unittest.TestCase):
+
+  def test_spans(self):
+    profile = profiler.Profiler()
+    with profile.span('sleep'):
+      time.sleep(0.01)
+    with profile.span('child', 'true'):
+      subprocess.run(['true'], check=True)
+    with self.assertRaises(ValueError):
+      with profile.span('sleep'):
+        raise ValueError()
+
+    report = profile.report()
+    self.assertEqual([span['name'] for span in report['spans']],
+                     ['sleep', 'child', 'sleep'])
+    first, child, _ = report['spans']
+    self.assertGreaterEqual(first['wall_secs'], 0.01)
+    self.assertEqual(child['detail'], 'true')
+    for key in ['start_secs', 'wall_secs', 'cpu_secs', 'children_cpu_secs']:
+      self.assertGreaterEqual(first[key], 0)
+    if os.path.exists('/proc/self/io'):
+      self.assertIn('rchar', first['io'])
+    self.assertEqual(report['totals']['sleep']['count'], 2)
+    self.assertEqual(report['totals']['child']['count'], 1)
+
+  def test_io(self):
+    if not os.path.exists('/proc/self/io'):
+      self.skipTest('No /proc/self/io')
+    profile = profiler.Profiler()
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      fname = os.path.join(tempdir, 'file')
+      with profile.span('write'):
+        with open(fname, 'wb') as f:
+          f.write(b'x' * 100000)
+      with profile.span('child_write'):
+        subprocess.run(['cp', fname, fname + '_copy'], check=True)
+    own, child = profile.report()['spans']
+    self.assertGreaterEqual(own['io']['wchar'], 100000)
+    # Exited child processes are counted too.
+    self.assertGreaterEqual(child['io']['wchar'], 100000)
+
+  def test_disabled(self):
+    profile = profiler.Profiler(enabled=False)
+    with profile.span('nothing'):
+      pass
+    self.assertEqual(profile.report()['spans'], [])
+
+  def test_write(self):
+    profile = profiler.Profiler()
+    with profile.span('nothing'):
+      pass
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      fname = os.path.join(tempdir, 'profile.json')
+      profile.write(fname)
+      with open(fname) as f:
+        self.assertEqual(json.load(f)['spans'][0]['name'], 'nothing')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,127 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import unittest
+
+from src.yaribak import progress
+
+from typing import List
+
+# Output of `rsync --info=progress2,stats2 --out-format=...`, split into lines.
+_RSYNC_OUTPUT = [
+    '>f+++++++++:1048576:a',
+    '      1,048,576  50%    1.00MB/s    0:00:01 (xfr#1, to-chk=1/3)',
+    '>f+++++++++:1048576:b',
+    '      2,097,152 100%  512.00kB/s    0:00:04 (xfr#2, to-chk=0/3)',
+    '',
+    'Number of files: 3 (reg: 2, dir: 1)',
+    'Number of created files: 2 (reg: 2)',
+    'Number of regular files transferred: 2',
+    'Total file size: 4,194,304 bytes',
+    'Total transferred file size: 2,097,152 bytes',
+    'Literal data: 2,097,152 bytes',
+    'File list generation time: 0.001 seconds',
+    'Total bytes sent: 2,098,000',
+    'Total bytes received: 57',
+    '',
+    'sent 2,098,000 bytes  received 57 bytes  4,196,114.00 bytes/sec',
+    'total size is 4,194,304  speedup is 2.00',
+]
+
+
+class TestProgress(unittest.TestCase):
+
+  def test_parse_progress(self):
+    self.assertEqual(
+        progress.parse_progress(
+            '  1,234,567  45%   12.50MB/s    0:01:23 (xfr#12, ir-chk=34/567)'),
+        {
+            'bytes_transferred': 1234567,
+            'percent': 45,
+            'bytes_per_sec': 12.5 * 2**20,
+            'eta_secs': 83,
+            'files_transferred': 12,
+            'files_checked': 533,
+            'files_total': 567,
+        })
+    self.assertEqual(
+        progress.parse_progress('          0   0%    0.00kB/s    0:00:00'), {
+            'bytes_transferred': 0,
+            'percent': 0,
+            'bytes_per_sec': 0,
+            'eta_secs': 0,
+        })
+    self.assertIsNone(progress.parse_progress('>f+++++++++:12:new file'))
+    self.assertIsNone(progress.parse_progress('sending incremental file list'))
+
+  def test_tracker(self):
+    passed: List[str] = []
+    tracker = progress.ProgressTracker(passed.append)
+    for line in _RSYNC_OUTPUT:
+      tracker(line)
+    self.assertEqual(passed,
+                     ['>f+++++++++:1048576:a', '>f+++++++++:1048576:b', '', ''])
+    self.assertEqual(tracker.latest['files_transferred'], 2)
+    totals = tracker.totals()
+    self.assertEqual(totals['files'], 3)
+    self.assertEqual(totals['files_transferred'], 2)
+    self.assertEqual(totals['total_size'], 4194304)
+    self.assertEqual(totals['transferred_size'], 2097152)
+    self.assertEqual(totals['bytes_sent'], 2098000)
+    self.assertEqual(totals['bytes_received'], 57)
+    self.assertEqual(totals['transfer_ratio'], 0.5)
+    self.assertIn('seconds', totals)
+
+  def test_totals_of_many_processes(self):
+    tracker = progress.ProgressTracker()
+    for line in _RSYNC_OUTPUT + _RSYNC_OUTPUT:
+      tracker(line)
+    self.assertEqual(tracker.totals()['files'], 6)
+
+  def test_writer(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tempdir:
+      textfile = os.path.join(tempdir, 'yaribak.prom')
+      jsonl = os.path.join(tempdir, 'metrics.jsonl')
+      writer = progress.MetricsWriter(textfile,
+                                      jsonl,
+                                      labels={'backup_path': '/b"x'},
+                                      interval_secs=3600)
+      tracker = progress.ProgressTracker(writer=writer)
+      for line in _RSYNC_OUTPUT:
+        tracker(line)
+      # The second progress line is within the interval.
+      with open(textfile) as f:
+        self.assertIn('yaribak_rsync_files_transferred{backup_path="/b\\"x"} '
+                      '1.0\n', f.read())
+      tracker.finish()
+
+      with open(textfile) as f:
+        text = f.read()
+      self.assertIn('# TYPE yaribak_rsync_done gauge\n', text)
+      self.assertIn('yaribak_rsync_done{backup_path="/b\\"x"} 1\n', text)
+      self.assertIn('yaribak_rsync_files_transferred{backup_path="/b\\"x"} '
+                    '2.0\n', text)
+      self.assertFalse(os.path.exists(textfile + '.tmp'))
+      with open(jsonl) as f:
+        records = [json.loads(line) for line in f]
+      self.assertEqual([record['done'] for record in records], [0, 1])
+      self.assertEqual(records[1]['backup_path'], '/b"x')
+      self.assertEqual(records[1]['transfer_ratio'], 0.5)
+
+
+if __name__ == '__main__':
+  unittest.main()
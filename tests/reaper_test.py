@@ -0,0 +1,85 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from src.yaribak import reaper
+
+
+class TestReaper(unittest.TestCase):
+
+  def _make_snapshot(self, name: str) -> str:
+    snapshot = os.path.join(self._tmpdir, name)
+    os.makedirs(os.path.join(snapshot, 'payload', 'a', 'b'))
+    with open(os.path.join(snapshot, 'payload', 'a', 'b', 'file1'), 'w') as f:
+      f.write('hello 1')
+    with open(os.path.join(snapshot, 'payload', 'file2'), 'w') as f:
+      f.write('hello 2')
+    return snapshot
+
+  def test_trash_and_reap(self):
+    snapshot = self._make_snapshot('ysnap_1')
+    # A link from a retained snapshot. Reaping must not count it as freed.
+    os.link(os.path.join(snapshot, 'payload', 'file2'),
+            os.path.join(self._tmpdir, 'retained'))
+
+    trashed = reaper.move_to_trash(self._tmpdir, snapshot)
+    self.assertEqual(trashed, os.path.join(self._tmpdir, '.trash', 'ysnap_1'))
+    self.assertFalse(os.path.exists(snapshot))
+
+    stats = reaper.reap(self._tmpdir)
+    self.assertEqual(os.listdir(os.path.join(self._tmpdir, '.trash')), [])
+    # 2 files, and 4 directories: ysnap_1, payload, a, b.
+    self.assertEqual(stats.entries, 6)
+    self.assertEqual(stats.inodes, 5)
+    self.assertTrue(os.path.exists(os.path.join(self._tmpdir, 'retained')))
+
+  def test_name_collision(self):
+    first = reaper.move_to_trash(self._tmpdir, self._make_snapshot('ysnap_1'))
+    second = reaper.move_to_trash(self._tmpdir, self._make_snapshot('ysnap_1'))
+    self.assertNotEqual(first, second)
+    self.assertTrue(os.path.isdir(first))
+    self.assertTrue(os.path.isdir(second))
+
+  def test_resume(self):
+    snapshot = reaper.move_to_trash(self._tmpdir,
+                                    self._make_snapshot('ysnap_1'))
+    # Simulate a reaper that crashed after removing some files.
+    os.remove(os.path.join(snapshot, 'payload', 'a', 'b', 'file1'))
+    os.rmdir(os.path.join(snapshot, 'payload', 'a', 'b'))
+
+    stats = reaper.reap(self._tmpdir)
+    self.assertEqual(os.listdir(os.path.join(self._tmpdir, '.trash')), [])
+    self.assertEqual(stats.entries, 4)
+
+  def test_background(self):
+    reaper.move_to_trash(self._tmpdir, self._make_snapshot('ysnap_1'))
+    background_reaper = reaper.BackgroundReaper(self._tmpdir)
+    background_reaper.start()
+    stats = background_reaper.join()
+    self.assertEqual(stats.entries, 6)
+
+  def test_no_trash(self):
+    self.assertEqual(reaper.reap(self._tmpdir).entries, 0)
+
+  def setUp(self) -> None:
+    self._tmpdir_obj = tempfile.TemporaryDirectory(prefix='yaribak_test_')
+    self._tmpdir = self._tmpdir_obj.name
+    return super().setUp()
+
+  def tearDown(self) -> None:
+    self._tmpdir_obj.cleanup()
+    return super().tearDown()
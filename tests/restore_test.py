@@ -0,0 +1,194 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.yaribak import archive
+from src.yaribak import catalog
+from src.yaribak import chunks
+from src.yaribak import metadata
+from src.yaribak import restore
+
+from typing import List
+
+
+def _write(path: str, content: str) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    f.write(content)
+
+
+def _listing(root: str) -> List[str]:
+  paths = []
+  for dirpath, dirnames, filenames in os.walk(root):
+    for name in dirnames + filenames:
+      paths.append(os.path.relpath(os.path.join(dirpath, name), root))
+  return sorted(paths)
+
+
+class TestSelector(unittest.TestCase):
+
+  def test_all(self):
+    selector = restore.Selector([])
+    self.assertEqual(selector.roots(), [''])
+    self.assertTrue(selector.selects('any/path'))
+
+  def test_globs(self):
+    selector = restore.Selector(['home/*/projects', 'home/a/x', 'etc/*.conf'])
+    self.assertEqual(selector.roots(), ['etc', 'home'])
+    self.assertTrue(selector.selects('home/a/projects'))
+    self.assertTrue(selector.selects('home/a/projects/deep/file'))
+    self.assertFalse(selector.selects('home/a'))
+    self.assertFalse(selector.selects('home/a/other'))
+    self.assertTrue(selector.selects('etc/a.conf'))
+    # Globs do not match across directories.
+    self.assertFalse(selector.selects('etc/sub/a.conf'))
+    self.assertTrue(selector.may_contain('home/a'))
+    self.assertFalse(selector.may_contain('var'))
+    self.assertFalse(selector.may_contain('etc/sub'))
+
+
+class TestRestore(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    self._target = os.path.join(self._tmpdir, 'backups')
+    self._dest = os.path.join(self._tmpdir, 'dest')
+    self._snapshot = catalog.Snapshot(
+        'ysnap_20220314_110903',
+        metadata.Metadata(source='/source', epoch=1234))
+    self._directory = os.path.join(self._target, self._snapshot.name)
+    payload = os.path.join(self._directory, 'payload')
+    _write(os.path.join(payload, 'home', 'a', 'projects', 'p1'), 'p1')
+    _write(os.path.join(payload, 'home', 'b', 'projects', 'p2'), 'p2')
+    _write(os.path.join(payload, 'home', 'b', 'other'), 'other')
+    _write(os.path.join(payload, 'var', 'log'), 'log')
+    os.link(os.path.join(payload, 'home', 'a', 'projects', 'p1'),
+            os.path.join(payload, 'home', 'a', 'projects', 'p1_link'))
+    os.symlink('p1', os.path.join(payload, 'home', 'a', 'projects', 'sym'))
+    os.utime(os.path.join(payload, 'home', 'a'), ns=(1000, 2000))
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def test_resolve_snapshot(self):
+    names = ['ysnap_20220314_110903', 'ysnap_20220315_110903']
+    self.assertEqual(restore.resolve_snapshot(names, 'latest'), names[-1])
+    self.assertEqual(restore.resolve_snapshot(names, names[0]), names[0])
+    self.assertEqual(restore.resolve_snapshot(names, '20220314_110903'),
+                     names[0])
+    with self.assertRaises(ValueError):
+      restore.resolve_snapshot(names, '20220316_110903')
+    with self.assertRaises(ValueError):
+      restore.resolve_snapshot([], 'latest')
+
+  def _restore(self, patterns: List[str]) -> restore.RestoreStats:
+    return restore.restore(self._target,
+                           self._snapshot,
+                           self._dest,
+                           patterns,
+                           num_workers=2)
+
+  def _check_selected(self) -> None:
+    self.assertEqual(_listing(self._dest), [
+        'home', 'home/a', 'home/a/projects', 'home/a/projects/p1',
+        'home/a/projects/p1_link', 'home/a/projects/sym', 'home/b',
+        'home/b/projects', 'home/b/projects/p2'
+    ])
+    projects = os.path.join(self._dest, 'home', 'a', 'projects')
+    self.assertTrue(
+        os.path.samefile(os.path.join(projects, 'p1'),
+                         os.path.join(projects, 'p1_link')))
+    self.assertEqual(os.readlink(os.path.join(projects, 'sym')), 'p1')
+
+  def test_selected(self):
+    with mock.patch.object(os, 'scandir', wraps=os.scandir) as scandir:
+      stats = self._restore(['home/*/projects'])
+    self.assertEqual([stats.files, stats.links, stats.skipped], [2, 2, 0])
+    self._check_selected()
+    # Directories outside the globs are not walked.
+    walked = [os.path.relpath(call.args[0], self._directory)
+              for call in scandir.call_args_list]
+    self.assertNotIn('payload/var', walked)
+
+    # Everything is identical the second time.
+    stats = self._restore(['home/*/projects'])
+    self.assertEqual([stats.files, stats.skipped], [0, 3])
+
+    # Except a file with another mode.
+    p2 = os.path.join(self._dest, 'home', 'b', 'projects', 'p2')
+    mode = os.stat(p2).st_mode
+    os.chmod(p2, 0o600)
+    stats = self._restore(['home/*/projects'])
+    self.assertEqual([stats.files, stats.skipped], [1, 2])
+    self.assertEqual(os.stat(p2).st_mode, mode)
+
+  def test_all(self):
+    stats = self._restore([])
+    self.assertEqual(stats.files, 4)
+    with open(os.path.join(self._dest, 'var', 'log')) as f:
+      self.assertEqual(f.read(), 'log')
+    self.assertEqual(
+        os.stat(os.path.join(self._dest, 'home', 'a')).st_mtime_ns, 2000)
+
+  def test_archive(self):
+    archive.write(os.path.join(self._directory, 'payload'),
+                  os.path.join(self._directory, archive.ARCHIVE_FNAME),
+                  os.path.join(self._directory, archive.REFS_DIR))
+    self._snapshot.metadata.archive = archive.ARCHIVE_FNAME
+    stats = self._restore(['home/*/projects'])
+    self.assertEqual([stats.files, stats.links], [2, 2])
+    self._check_selected()
+    with open(os.path.join(self._dest, 'home', 'b', 'projects', 'p2')) as f:
+      self.assertEqual(f.read(), 'p2')
+
+  def test_chunked(self):
+    source = os.path.join(self._tmpdir, 'source')
+    large = b'large' * 4096
+    for relpath in ['home/a/projects/large', 'var/large', 'opt/large']:
+      path = os.path.join(source, relpath)
+      os.makedirs(os.path.dirname(path))
+      with open(path, 'wb') as f:
+        f.write(large)
+    chunks.chunk_tree(source,
+                      os.path.join(self._directory, 'payload'),
+                      os.path.join(self._directory, chunks.MAPS_DIR),
+                      None,
+                      chunks.store_dir(self._target),
+                      4096, [],
+                      num_workers=2,
+                      chunk_size=4096)
+    # Only in the chunk maps, so not missing.
+    with mock.patch.object(logging, 'warning') as warning:
+      stats = self._restore(['home/*/projects', 'opt'])
+    warning.assert_not_called()
+    self.assertEqual(stats.files, 4)
+    self.assertEqual(_listing(os.path.join(self._dest, 'home', 'a')),
+                     ['projects', 'projects/large', 'projects/p1',
+                      'projects/p1_link', 'projects/sym'])
+    self.assertFalse(os.path.exists(os.path.join(self._dest, 'var')))
+    for relpath in ['home/a/projects/large', 'opt/large']:
+      with open(os.path.join(self._dest, relpath), 'rb') as f:
+        self.assertEqual(f.read(), large)
+    with self.assertLogs(level='WARNING'):
+      self._restore(['missing'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from src.yaribak import resume
+
+
+class TestResume(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._fname = os.path.join(self._tmpdir_obj.name, resume.STATE_FNAME)
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def test_save_load(self):
+    state = resume.ResumeState(source='/source',
+                               base='ysnap_20220313_000000',
+                               snapshot_strategy='native')
+    state.phases.append(resume.CLONE)
+    state.save_to(self._fname)
+    self.assertEqual(resume.ResumeState.load_from(self._fname), state)
+    self.assertEqual(os.listdir(self._tmpdir_obj.name), [resume.STATE_FNAME])
+
+  def test_same_backup(self):
+    state = resume.ResumeState('/source', None, 'native', [resume.CLONE])
+    self.assertTrue(
+        state.same_backup(resume.ResumeState('/source', None, 'native')))
+    self.assertFalse(
+        state.same_backup(resume.ResumeState('/other', None, 'native')))
+    self.assertFalse(
+        state.same_backup(resume.ResumeState('/source', 'ysnap_1', 'native')))
+    self.assertFalse(
+        state.same_backup(resume.ResumeState('/source', None, 'cp')))
+
+  def test_missing_or_unreadable(self):
+    self.assertIsNone(resume.ResumeState.load_from(self._fname))
+    for content in ['{"source": "/so', '[]', '{"unknown": 1}']:
+      with open(self._fname, 'w') as f:
+        f.write(content)
+      with self.assertLogs(level='WARNING'):
+        self.assertIsNone(resume.ResumeState.load_from(self._fname))
+
+
+if __name__ == '__main__':
+  unittest.main()
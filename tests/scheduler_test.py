@@ -0,0 +1,144 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from src.yaribak import scheduler
+
+from typing import Any, List, Optional, Set
+
+
+class TestScheduler(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self._lock = threading.Lock()
+    self._running: 'collections.Counter[int]' = collections.Counter()
+    self._max_running: 'collections.Counter[int]' = collections.Counter()
+    self._started: List[str] = []
+
+  def _job(self,
+           name: str,
+           devices: Set[int],
+           elapsed_secs: Optional[float] = None,
+           minimum_wait_secs: float = 0,
+           fail: bool = False) -> scheduler.Job:
+
+    def run() -> None:
+      with self._lock:
+        self._started.append(name)
+        self._running.update(devices)
+        for device in devices:
+          self._max_running[device] = max(self._max_running[device],
+                                          self._running[device])
+      time.sleep(0.05)
+      with self._lock:
+        self._running.subtract(devices)
+      if fail:
+        raise RuntimeError('failed')
+
+    return scheduler.Job(name, run, devices, elapsed_secs, minimum_wait_secs)
+
+  def test_per_device_limit(self):
+    jobs = [self._job(f'a{i}', {1}) for i in range(3)]
+    jobs += [self._job(f'b{i}', {2, 3}) for i in range(3)]
+    results = scheduler.run_jobs(jobs, max_per_device=2)
+    self.assertEqual([r.status for r in results], [scheduler.DONE] * 6)
+    self.assertEqual(self._max_running, {1: 2, 2: 2, 3: 2})
+
+  def test_priority(self):
+    jobs = [
+        self._job('due', {1}, elapsed_secs=100, minimum_wait_secs=100),
+        self._job('overdue', {1}, elapsed_secs=300, minimum_wait_secs=100),
+        self._job('not_due', {1}, elapsed_secs=10, minimum_wait_secs=100),
+        self._job('first_backup', {1}, minimum_wait_secs=100),
+    ]
+    results = scheduler.run_jobs(jobs, max_per_device=1)
+    self.assertEqual(self._started, ['first_backup', 'overdue', 'due'])
+    self.assertEqual([(r.name, r.status) for r in results],
+                     [('first_backup', scheduler.DONE),
+                      ('overdue', scheduler.DONE), ('due', scheduler.DONE),
+                      ('not_due', scheduler.NOT_DUE)])
+
+  def test_failure(self):
+    results = scheduler.run_jobs(
+        [self._job('bad', {1}, fail=True),
+         self._job('good', {1})],
+        max_per_device=1)
+    self.assertEqual([r.status for r in results],
+                     [scheduler.FAILED, scheduler.DONE])
+    self.assertEqual(results[0].error, "RuntimeError('failed')")
+    report = scheduler.report(results)
+    self.assertIn("RuntimeError('failed')", report)
+    self.assertTrue(report.endswith('1 done, 1 failed, 0 not due'))
+
+  def test_missing_source(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tmpdir:
+      good = self._job('good', {1})
+      jobs = [
+          scheduler.make_job('missing', good.run,
+                             [os.path.join(tmpdir, 'missing'), tmpdir],
+                             lambda: None, 0),
+          scheduler.make_job('good', good.run, [tmpdir, tmpdir],
+                             lambda: 100.0, 10),
+      ]
+      self.assertEqual(jobs[1].devices, {os.stat(tmpdir).st_dev})
+    results = scheduler.run_jobs(jobs, max_per_device=1)
+    self.assertEqual(self._started, ['good'])
+    self.assertEqual([(r.name, r.status) for r in results],
+                     [('missing', scheduler.FAILED),
+                      ('good', scheduler.DONE)])
+    self.assertIn('FileNotFoundError', results[0].error or '')
+    self.assertTrue(
+        scheduler.report(results).endswith('1 done, 1 failed, 0 not due'))
+
+  def test_duplicate_names(self):
+    with self.assertRaisesRegex(ValueError, 'Duplicate'):
+      scheduler.run_jobs([self._job('a', {1}), self._job('a', {2})],
+                         max_per_device=1)
+    self.assertEqual(self._started, [])
+
+  def test_load_config(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tmpdir:
+      fname = os.path.join(tmpdir, 'config.json')
+
+      def load(data: Any) -> scheduler.Config:
+        with open(fname, 'w') as f:
+          json.dump(data, f)
+        return scheduler.load_config(fname)
+
+      config = load({'jobs': [{'source': 's', 'backup_path': 'b'}]})
+      self.assertEqual(config.max_per_device, 1)
+      self.assertEqual(config.jobs, [{
+          'name': 'b',
+          'source': 's',
+          'backup_path': 'b'
+      }])
+      with self.assertRaisesRegex(ValueError, 'unknown keys'):
+        load({'jobs': [], 'max_per_disk': 1})
+      with self.assertRaisesRegex(ValueError, 'duplicate'):
+        load({'jobs': [{'backup_path': 'b'}, {'backup_path': 'b'}]})
+      with self.assertRaisesRegex(ValueError, 'needs a'):
+        load({'jobs': [{'source': 's'}]})
+      with self.assertRaisesRegex(ValueError, 'must be positive'):
+        load({'jobs': [], 'max_per_device': 0})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,174 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from src.yaribak import changelog
+from src.yaribak import copier
+from src.yaribak import seeder
+
+from typing import List
+
+
+def _listing(root: str) -> List[str]:
+  """Relative paths of everything under root, with their type and attributes."""
+  result = []
+  for dirpath, dirnames, filenames in os.walk(root):
+    for name in dirnames + filenames:
+      path = os.path.join(dirpath, name)
+      st = os.lstat(path)
+      line = (f'{os.path.relpath(path, root)} {stat.filemode(st.st_mode)} '
+              f'{st.st_uid}:{st.st_gid} {st.st_mtime_ns}')
+      if stat.S_ISREG(st.st_mode):
+        with open(path, 'rb') as f:
+          line += f' {f.read()!r} nlink={st.st_nlink}'
+      elif stat.S_ISLNK(st.st_mode):
+        line += f' -> {os.readlink(path)}'
+      result.append(line)
+  return sorted(result)
+
+
+class TestSeeder(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    self._source = os.path.join(self._tmpdir, 'source')
+    self._dest = os.path.join(self._tmpdir, 'dest')
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def _write(self, relpath: str, content: bytes) -> str:
+    path = os.path.join(self._source, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+      f.write(content)
+    return path
+
+  def test_seed(self):
+    self._write('a/b/file', b'hello')
+    self._write('a/other', b'world')
+    os.link(os.path.join(self._source, 'a/other'),
+            os.path.join(self._source, 'a/b/link'))
+    os.symlink('../other', os.path.join(self._source, 'a/b/symlink'))
+    os.mkfifo(os.path.join(self._source, 'fifo'))
+    private = self._write('private', b'secret')
+    os.chmod(private, 0o600)
+    # Read-only directories are filled before their mode is set.
+    os.chmod(os.path.join(self._source, 'a/b'), 0o555)
+    for dirpath, _, _ in os.walk(self._source):
+      os.utime(dirpath, ns=(1000, 2000))
+
+    changes: List[changelog.Change] = []
+    stats = seeder.seed_tree(self._source,
+                             self._dest, [],
+                             num_workers=4,
+                             on_change=changes.append)
+    self.assertEqual(_listing(self._dest), _listing(self._source))
+    self.assertEqual(stats.files, 3)
+    self.assertEqual(stats.directories, 3)
+    self.assertEqual(stats.links, 3)
+    self.assertEqual(stats.bytes, len(b'helloworldsecret'))
+    self.assertEqual(
+        os.stat(os.path.join(self._dest, 'a/other')).st_ino,
+        os.stat(os.path.join(self._dest, 'a/b/link')).st_ino)
+    self.assertEqual(
+        sorted(change.path for change in changes),
+        ['a/', 'a/b/', 'a/b/file', 'a/b/link', 'a/b/symlink', 'a/other', 'fifo',
+         'private'])
+    self.assertTrue(all(change.kind == changelog.ADDED for change in changes))
+    # So that the temporary directory can be removed.
+    os.chmod(os.path.join(self._dest, 'a/b'), 0o755)
+    os.chmod(os.path.join(self._source, 'a/b'), 0o755)
+
+  def test_xattrs(self):
+    path = self._write('file', b'x')
+    try:
+      os.setxattr(path, 'user.yaribak_test', b'value')
+    except OSError as e:
+      if e.errno in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM):
+        self.skipTest(f'No user xattrs: {e}')
+      raise
+    seeder.seed_tree(self._source, self._dest, [])
+    self.assertEqual(
+        os.getxattr(os.path.join(self._dest, 'file'), 'user.yaribak_test'),
+        b'value')
+
+  def test_sparse(self):
+    path = self._write('sparse', b'data')
+    with open(path, 'r+b') as f:
+      f.truncate(64 << 20)
+    stats = seeder.seed_tree(self._source, self._dest, [])
+    st = os.stat(os.path.join(self._dest, 'sparse'))
+    self.assertEqual(st.st_size, 64 << 20)
+    if os.stat(path).st_blocks * 512 < (64 << 20):
+      self.assertLess(stats.bytes, 1 << 20)
+      self.assertLess(st.st_blocks * 512, 1 << 20)
+
+  def test_excludes(self):
+    self._write('keep/file', b'')
+    self._write('keep/file.tmp', b'')
+    self._write('cache/file', b'')
+    self._write('sub/cache', b'')
+    self._write('deep/path/file', b'')
+    self._write('deep/other/file', b'')
+    seeder.seed_tree(self._source, self._dest,
+                     ['*.tmp', '/cache/', 'deep/path'])
+    found = sorted(
+        os.path.relpath(os.path.join(dirpath, name), self._dest)
+        for dirpath, _, files in os.walk(self._dest)
+        for name in files)
+    self.assertEqual(found, ['deep/other/file', 'keep/file', 'sub/cache'])
+
+  def test_max_size(self):
+    self._write('small', b'x' * 10)
+    self._write('large', b'x' * 11)
+    stats = seeder.seed_tree(self._source, self._dest, [], max_size=10)
+    self.assertEqual(stats.files, 1)
+    self.assertEqual(os.listdir(self._dest), ['small'])
+
+  def test_dangling_symlink(self):
+    os.makedirs(self._source)
+    os.symlink('missing', os.path.join(self._source, 'dangling'))
+    seeder.seed_tree(self._source, self._dest, [])
+    self.assertEqual(os.readlink(os.path.join(self._dest, 'dangling')),
+                     'missing')
+
+  def test_vanished(self):
+    self._write('file', b'x')
+    self._write('gone', b'y')
+    os.link(os.path.join(self._source, 'gone'),
+            os.path.join(self._source, 'gone_link'))
+    copy_file = copier.copy_file
+
+    def fake_copy(src: str, dst: str) -> int:
+      if os.path.basename(src).startswith('gone'):
+        raise FileNotFoundError(errno.ENOENT, 'Removed', src)
+      return copy_file(src, dst)
+
+    # Skipped, for rsync to handle.
+    with mock.patch.object(copier, 'copy_file', side_effect=fake_copy):
+      stats = seeder.seed_tree(self._source, self._dest, [])
+    self.assertEqual(stats.files, 1)
+    self.assertEqual(os.listdir(self._dest), ['file'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,66 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from src.yaribak import manifest
+from src.yaribak import sharding
+
+
+class TestSharding(unittest.TestCase):
+
+  def test_top_level_dirs(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tmpdir:
+      for name in ['b', 'a', 'cache', 'a.d']:
+        os.mkdir(os.path.join(tmpdir, name))
+      with open(os.path.join(tmpdir, 'file'), 'w') as f:
+        f.write('top-level files are not sharded')
+      os.symlink('a', os.path.join(tmpdir, 'link'))
+      self.assertEqual(sharding.top_level_dirs(tmpdir, ['/cache', '*.d']),
+                       ['a', 'b'])
+
+  def test_weigh(self):
+    self.assertEqual(sharding.weigh(['a', 'b'], None), {'a': 1, 'b': 1})
+    with tempfile.TemporaryDirectory(prefix='yaribak_test_') as tmpdir:
+      payload = os.path.join(tmpdir, 'payload')
+      os.makedirs(os.path.join(payload, 'a', 'x'))
+      os.makedirs(os.path.join(payload, 'b'))
+      os.mkdir(os.path.join(payload, 'a.txt'))
+      for i in range(3):
+        with open(os.path.join(payload, 'a', 'x', str(i)), 'w') as f:
+          f.write('')
+      fname = os.path.join(tmpdir, manifest.MANIFEST_FNAME)
+      manifest.write_tree(payload, fname)
+      # "a" has itself, "x", and 3 files. New directories weigh the most.
+      self.assertEqual(sharding.weigh(['a', 'a.txt', 'b', 'new'], fname), {
+          'a': 5,
+          'a.txt': 1,
+          'b': 1,
+          'new': 5
+      })
+
+  def test_balance(self):
+    weights = {'a': 10, 'b': 6, 'c': 5, 'd': 1}
+    self.assertEqual(sharding.balance(weights, 2), [['a', 'd'], ['b', 'c']])
+    self.assertEqual(sharding.balance(weights, 1), [['a', 'b', 'c', 'd']])
+    # No empty shards.
+    self.assertEqual(sharding.balance({'a': 1}, 3), [['a']])
+    with self.assertRaises(ValueError):
+      sharding.balance(weights, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,141 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from src.yaribak import archive
+from src.yaribak import catalog
+from src.yaribak import cloner
+from src.yaribak import main
+from src.yaribak import manifest
+from src.yaribak import metadata
+from src.yaribak import reaper
+from src.yaribak import tier
+
+from typing import List
+
+
+class TestTier(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def _make_snapshot(self, name: str, epoch: int) -> catalog.Snapshot:
+    directory = os.path.join(self._tmpdir, name)
+    payload = os.path.join(directory, 'payload')
+    os.makedirs(payload)
+    data = metadata.Metadata(source='/source', epoch=epoch)
+    data.save_to(os.path.join(directory, 'backup_context.json'))
+    return catalog.Snapshot(name, data)
+
+  def test_cold_snapshots(self):
+    snapshots = [
+        self._make_snapshot('ysnap_1', 100),
+        self._make_snapshot('ysnap_2', 200),
+        self._make_snapshot('ysnap_3', 300),
+    ]
+    self.assertEqual(
+        [it.name for it in tier.cold_snapshots(snapshots, 150, 400)],
+        ['ysnap_1', 'ysnap_2'])
+    # The latest is kept, however old.
+    self.assertEqual(
+        [it.name for it in tier.cold_snapshots(snapshots, 0, 1000)],
+        ['ysnap_1', 'ysnap_2'])
+    snapshots[0].metadata.archive = archive.ARCHIVE_FNAME
+    self.assertEqual(
+        [it.name for it in tier.cold_snapshots(snapshots, 150, 400)],
+        ['ysnap_2'])
+
+  def test_archive_snapshot(self):
+    old = self._make_snapshot('ysnap_1', 100)
+    payload = os.path.join(self._tmpdir, 'ysnap_1', 'payload')
+    with open(os.path.join(payload, 'unchanged'), 'w') as f:
+      f.write('unchanged')
+    with open(os.path.join(payload, 'deleted'), 'w') as f:
+      f.write('deleted')
+    manifest.write_tree(
+        payload,
+        os.path.join(self._tmpdir, 'ysnap_1', manifest.MANIFEST_FNAME))
+    os.mkdir(os.path.join(self._tmpdir, 'ysnap_2'))
+    cloner.clone_tree(payload, os.path.join(self._tmpdir, 'ysnap_2',
+                                            'payload'))
+    os.remove(os.path.join(self._tmpdir, 'ysnap_2', 'payload', 'deleted'))
+
+    stats = tier.archive_snapshot(self._tmpdir, old)
+    self.assertEqual(stats.entries, 2)
+    self.assertEqual(stats.stored_bytes, len('deleted'))
+    self.assertEqual(stats.referenced_bytes, len('unchanged'))
+
+    directory = os.path.join(self._tmpdir, 'ysnap_1')
+    self.assertEqual(sorted(os.listdir(directory)),
+                     [archive.ARCHIVE_FNAME, 'backup_context.json', 'refs'])
+    data = metadata.Metadata.load_from(
+        os.path.join(directory, 'backup_context.json'))
+    self.assertEqual(data.archive, archive.ARCHIVE_FNAME)
+    reaper.reap(self._tmpdir)
+    with archive.Archive(os.path.join(directory, archive.ARCHIVE_FNAME),
+                         os.path.join(directory, archive.REFS_DIR)) as reader:
+      entry = reader.find('unchanged')
+      assert entry is not None
+      with open(reader.ref_path(entry)) as f:
+        self.assertEqual(f.read(), 'unchanged')
+
+  def test_usage_after_archive(self):
+    self._make_snapshot('ysnap_1', 100)
+    with open(os.path.join(self._tmpdir, 'ysnap_1', 'payload', 'file'),
+              'wb') as f:
+      f.write(b'x' * 10000)
+    self._make_snapshot('ysnap_2', 200)
+
+    def stored_usage() -> List[int]:
+      with contextlib.redirect_stdout(io.StringIO()):
+        main._usage_main(['--backup-path', self._tmpdir])
+      data = metadata.Metadata.load_from(
+          os.path.join(self._tmpdir, 'ysnap_1', 'backup_context.json'))
+      assert data.usage is not None
+      return [data.usage['total_bytes'], data.usage['exclusive_bytes']]
+
+    before = stored_usage()
+    self.assertGreater(before[1], 10000)
+    main._tier_main(['--backup-path', self._tmpdir, '--older-than', '1s'])
+    # Recomputed without --refresh, since the payload is gone.
+    after = stored_usage()
+    self.assertLess(after[1], 10000)
+    self.assertEqual(after[0], after[1])
+
+  def test_finish_interrupted(self):
+    snapshot = self._make_snapshot('ysnap_1', 100)
+    payload = os.path.join(self._tmpdir, 'ysnap_1', 'payload')
+    self.assertFalse(tier.finish_interrupted(self._tmpdir, snapshot))
+    self.assertTrue(os.path.isdir(payload))
+    snapshot.metadata.archive = archive.ARCHIVE_FNAME
+    snapshot.metadata.usage = {'total_bytes': 1, 'exclusive_bytes': 1}
+    self.assertTrue(tier.finish_interrupted(self._tmpdir, snapshot))
+    self.assertFalse(os.path.exists(payload))
+    # Usage of the payload is dropped.
+    data = metadata.Metadata.load_from(
+        os.path.join(self._tmpdir, 'ysnap_1', 'backup_context.json'))
+    self.assertIsNone(data.usage)
+
+
+if __name__ == '__main__':
+  unittest.main()
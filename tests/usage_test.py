@@ -0,0 +1,138 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from src.yaribak import cloner
+from src.yaribak import manifest
+from src.yaribak import metadata
+from src.yaribak import usage
+
+from typing import Dict, List
+
+
+def _write(path: str, size: int) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'wb') as f:
+    f.write(b'x' * size)
+
+
+class TestUsage(unittest.TestCase):
+
+  def _directory_bytes(self) -> int:
+    """Bytes of directories in a snapshot, including payload."""
+    total = 0
+    snapshot = os.path.join(self._tmpdir, 'ysnap_1')
+    for dirpath, dirnames, _ in os.walk(snapshot):
+      for name in dirnames:
+        total += os.lstat(os.path.join(dirpath, name)).st_size
+    return total
+
+  def _make_snapshots(self) -> None:
+    # Snapshot 2 is a clone of 1 with one file replaced, and one hard linked
+    # twice in the same snapshot.
+    first = os.path.join(self._tmpdir, 'ysnap_1', 'payload')
+    _write(os.path.join(first, 'shared'), 1000)
+    _write(os.path.join(first, 'old', 'replaced'), 100)
+    cloner.clone_tree(os.path.dirname(first),
+                      os.path.join(self._tmpdir, 'ysnap_2'))
+    second = os.path.join(self._tmpdir, 'ysnap_2', 'payload')
+    os.remove(os.path.join(second, 'old', 'replaced'))
+    _write(os.path.join(second, 'old', 'replaced'), 10)
+    os.link(os.path.join(second, 'old', 'replaced'),
+            os.path.join(second, 'also_replaced'))
+
+  def _bytes(self, usages: List[usage.SnapshotUsage]) -> Dict[str, List[int]]:
+    # Directories are exclusive, and the same in both snapshots.
+    dirs = self._directory_bytes()
+    return {
+        it.name: [it.exclusive_bytes - dirs, it.shared_bytes] for it in usages
+    }
+
+  def test_walk(self):
+    self._make_snapshots()
+    usages = usage.compute(self._tmpdir, ['ysnap_1', 'ysnap_2'], num_workers=2)
+    self.assertEqual(self._bytes(usages), {
+        'ysnap_1': [100, 1000],
+        'ysnap_2': [10, 1000],
+    })
+    self.assertFalse(usages[0].from_manifest)
+
+    # Without the second, everything in the first is exclusive.
+    usages = usage.compute(self._tmpdir, ['ysnap_1'])
+    self.assertEqual(self._bytes(usages), {'ysnap_1': [1100, 0]})
+
+  def test_manifest(self):
+    self._make_snapshots()
+    for name in ['ysnap_1', 'ysnap_2']:
+      directory = os.path.join(self._tmpdir, name)
+      manifest.write_tree(os.path.join(directory, 'payload'),
+                          os.path.join(directory, manifest.MANIFEST_FNAME))
+    usages = usage.compute(self._tmpdir, ['ysnap_1', 'ysnap_2'])
+    self.assertTrue(usages[0].from_manifest)
+    # The manifests themselves are exclusive too.
+    manifest_size = os.path.getsize(
+        os.path.join(self._tmpdir, 'ysnap_1', manifest.MANIFEST_FNAME))
+    self.assertEqual(self._bytes(usages)['ysnap_1'],
+                     [100 + manifest_size, 1000])
+
+  def test_shared_manifest_is_not_used(self):
+    self._make_snapshots()
+    directory = os.path.join(self._tmpdir, 'ysnap_1')
+    manifest.write_tree(os.path.join(directory, 'payload'),
+                        os.path.join(directory, manifest.MANIFEST_FNAME))
+    os.link(os.path.join(directory, manifest.MANIFEST_FNAME),
+            os.path.join(self._tmpdir, 'ysnap_2', manifest.MANIFEST_FNAME))
+    usages = usage.compute(self._tmpdir, ['ysnap_1', 'ysnap_2'])
+    self.assertTrue(usages[0].from_manifest)
+    self.assertFalse(usages[1].from_manifest)
+    # Nor once it is the last link, e.g. after ysnap_1 is reaped.
+    os.remove(os.path.join(directory, manifest.MANIFEST_FNAME))
+    self.assertIsNone(
+        manifest.usable_manifest(os.path.join(self._tmpdir, 'ysnap_2')))
+
+  def test_metadata(self):
+    names = ['ysnap_1', 'ysnap_2']
+    key = usage.snapshots_key(names)
+    datas = [metadata.Metadata(source='/source', epoch=1) for _ in names]
+    self.assertIsNone(usage.from_metadata(names, datas, key))
+    usages = [
+        usage.SnapshotUsage('ysnap_1', 10, 5),
+        usage.SnapshotUsage('ysnap_2', 20, 15),
+    ]
+    for it, data in zip(usages, datas):
+      usage.to_metadata(it, key, data)
+    self.assertEqual(usage.from_metadata(names, datas, key), usages)
+    # Stale once the set of snapshots changes.
+    self.assertIsNone(
+        usage.from_metadata(names, datas, usage.snapshots_key(['ysnap_1'])))
+
+  def test_format_bytes(self):
+    self.assertEqual(usage.format_bytes(100), '100.0 B')
+    self.assertEqual(usage.format_bytes(1536), '1.5 KiB')
+    self.assertEqual(usage.format_bytes(500 * 2**30), '500.0 GiB')
+    self.assertEqual(usage.format_bytes(3 * 2**40), '3.0 TiB')
+
+  def setUp(self) -> None:
+    self._tmpdir_obj = tempfile.TemporaryDirectory(prefix='yaribak_test_')
+    self._tmpdir = self._tmpdir_obj.name
+
+  def tearDown(self) -> None:
+    self._tmpdir_obj.cleanup()
+
+
+if __name__ == '__main__':
+  unittest.main()
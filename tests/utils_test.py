@@ -18,6 +18,7 @@ import os
 import shutil
 import tempfile
 
+from src.yaribak import cloner
 from src.yaribak import utils
 
 
@@ -43,3 +44,43 @@ class TestUtils(unittest.TestCase):
       # Copying, but not hard linking.
       shutil.copytree(dir1, dir2)
       self.assertFalse(utils.is_hardlinked_replica(dir1, dir2))
+
+  def test_hardlink_differences(self):
+    with tempfile.TemporaryDirectory(prefix='yaribak_utils_test_') as tempdir:
+      dir1 = os.path.join(tempdir, 'dir1')
+      os.makedirs(os.path.join(dir1, 'a', 'b', 'c'))
+      for relpath in ['file1', 'a/file2', 'a/b/c/file3']:
+        with open(os.path.join(dir1, relpath), 'w') as f:
+          f.write(relpath)
+      os.symlink('file1', os.path.join(dir1, 'link'))
+
+      def replica(name: str) -> str:
+        path = os.path.join(tempdir, name)
+        # Unlike shutil.copytree(), this also hard links the symlink.
+        cloner.clone_tree(dir1, path)
+        return path
+
+      self.assertTrue(utils.is_hardlinked_replica(dir1, replica('same')))
+
+      extra = replica('extra')
+      os.mkdir(os.path.join(extra, 'a', 'b', 'c', 'new_dir'))
+      self.assertFalse(utils.is_hardlinked_replica(dir1, extra))
+      self.assertFalse(utils.is_hardlinked_replica(extra, dir1))
+
+      missing = replica('missing')
+      os.remove(os.path.join(missing, 'a', 'b', 'c', 'file3'))
+      self.assertFalse(utils.is_hardlinked_replica(dir1, missing))
+      self.assertFalse(utils.is_hardlinked_replica(missing, dir1))
+
+      # Same name, but a file instead of a directory.
+      file_for_dir = replica('file_for_dir')
+      shutil.rmtree(os.path.join(file_for_dir, 'a', 'b', 'c'))
+      with open(os.path.join(file_for_dir, 'a', 'b', 'c'), 'w') as f:
+        f.write('c')
+      self.assertFalse(utils.is_hardlinked_replica(dir1, file_for_dir))
+
+      relinked = replica('relinked')
+      os.remove(os.path.join(relinked, 'link'))
+      os.symlink('file1', os.path.join(relinked, 'link'))
+      self.assertFalse(
+          utils.is_hardlinked_replica(dir1, relinked, num_workers=1))
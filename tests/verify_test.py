@@ -0,0 +1,131 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from src.yaribak import chunks
+from src.yaribak import cloner
+from src.yaribak import verify
+
+
+def _write(path: str, content: str) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, 'w') as f:
+    f.write(content)
+
+
+class TestVerify(unittest.TestCase):
+
+  def setUp(self):
+    self._tmpdir_obj = tempfile.TemporaryDirectory()
+    self._tmpdir = self._tmpdir_obj.name
+    first = os.path.join(self._tmpdir, 'ysnap_1')
+    _write(os.path.join(first, 'payload', 'shared'), 'shared')
+    _write(os.path.join(first, 'payload', 'dir', 'old'), 'old')
+    cloner.clone_tree(first, os.path.join(self._tmpdir, 'ysnap_2'))
+    _write(os.path.join(self._tmpdir, 'ysnap_2', 'payload', 'new'), 'new')
+    self._names = ['ysnap_1', 'ysnap_2']
+
+  def tearDown(self):
+    self._tmpdir_obj.cleanup()
+
+  def test_hashes_each_inode_once(self):
+    stats, problems = verify.verify(self._tmpdir, self._names, num_workers=2)
+    self.assertEqual(problems, [])
+    self.assertEqual([stats.inodes, stats.hashed], [3, 3])
+    self.assertEqual(stats.hashed_bytes, len('shared') + len('old') + 3)
+
+    # Only new inodes are read the next time.
+    _write(os.path.join(self._tmpdir, 'ysnap_2', 'payload', 'newer'), 'newer')
+    stats, problems = verify.verify(self._tmpdir, self._names)
+    self.assertEqual([stats.inodes, stats.hashed], [4, 1])
+    self.assertEqual(problems, [])
+
+  def test_prunes_cache(self):
+    verify.verify(self._tmpdir, self._names)
+    os.remove(os.path.join(self._tmpdir, 'ysnap_2', 'payload', 'new'))
+    stats, problems = verify.verify(self._tmpdir, self._names)
+    self.assertEqual(problems, [])
+    self.assertEqual([stats.inodes, stats.hashed, stats.pruned], [2, 0, 1])
+
+  def test_corruption(self):
+    verify.verify(self._tmpdir, self._names)
+    # Change the contents, keeping size and mtime.
+    path = os.path.join(self._tmpdir, 'ysnap_1', 'payload', 'shared')
+    st = os.stat(path)
+    with open(path, 'r+') as f:
+      f.write('SHARED')
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    # Not seen without reading the file.
+    _, problems = verify.verify(self._tmpdir, self._names)
+    self.assertEqual(problems, [])
+    stats, problems = verify.verify(self._tmpdir, self._names, full=True)
+    self.assertEqual(stats.hashed, 3)
+    self.assertEqual(
+        [(it.snapshot, it.path) for it in problems],
+        [('ysnap_1', 'payload/shared'), ('ysnap_2', 'payload/shared')])
+    # Still reported next time.
+    _, problems = verify.verify(self._tmpdir, self._names, full=True)
+    self.assertEqual(len(problems), 2)
+
+  def test_chunks(self):
+    source = os.path.join(self._tmpdir, 'source')
+    _write(os.path.join(source, 'large'), 'a' * 4096 + 'b' * 4096)
+    snapshot = os.path.join(self._tmpdir, 'ysnap_2')
+    chunks.chunk_tree(source,
+                      os.path.join(snapshot, 'payload'),
+                      os.path.join(snapshot, chunks.MAPS_DIR),
+                      None,
+                      chunks.store_dir(self._tmpdir),
+                      4096, [],
+                      num_workers=2,
+                      chunk_size=4096)
+    stats, problems = verify.verify(self._tmpdir, self._names)
+    self.assertEqual(problems, [])
+    self.assertEqual([stats.blocks, stats.hashed], [2, 6])
+
+    digest = chunks.read_map(os.path.join(snapshot, chunks.MAPS_DIR,
+                                          'large')).digests[0]
+    assert digest is not None
+    block = chunks.chunk_path(chunks.store_dir(self._tmpdir), digest)
+    st = os.stat(block)
+    with open(block, 'r+') as f:
+      f.write('x')
+    os.utime(block, ns=(st.st_atime_ns, st.st_mtime_ns))
+    _, problems = verify.verify(self._tmpdir, self._names, full=True)
+    self.assertEqual([(it.snapshot, it.path, it.error) for it in problems],
+                     [('ysnap_2', 'chunkmaps/large',
+                       f'Block {digest}: Corrupt')])
+
+    os.remove(block)
+    _, problems = verify.verify(self._tmpdir, self._names)
+    self.assertEqual([it.error for it in problems],
+                     [f'Block {digest}: Missing'])
+
+  def test_unreadable(self):
+    path = os.path.join(self._tmpdir, 'ysnap_2', 'payload', 'new')
+    os.chmod(path, 0)
+    if os.access(path, os.R_OK):
+      self.skipTest('Running as root, permissions are not enforced.')
+    _, problems = verify.verify(self._tmpdir, self._names)
+    self.assertEqual([(it.snapshot, it.path) for it in problems],
+                     [('ysnap_2', 'payload/new')])
+    self.assertIn('Unreadable', problems[0].error)
+
+
+if __name__ == '__main__':
+  unittest.main()
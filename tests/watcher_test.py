@@ -0,0 +1,109 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.yaribak import watcher
+
+from typing import List, Optional
+
+
+class TestWatcher(unittest.TestCase):
+
+  def _path(self, *parts: str) -> str:
+    return os.path.join(self._tmpdir, *parts)
+
+  def _poll(self) -> None:
+    # Events are queued by the time the change returns, so this is instant.
+    self._watcher.poll(timeout=0.5)
+
+  def test_first_is_full(self):
+    self.assertIsNone(self._watcher.take_dirty())
+    self.assertEqual(self._watcher.take_dirty(), [])
+
+  def test_dirty_dirs(self):
+    self._watcher.take_dirty()
+    with open(self._path('a', 'b', 'file1'), 'w') as f:
+      f.write('changed')
+    os.remove(self._path('file2'))
+    self._poll()
+    self.assertEqual(self._watcher.take_dirty(), ['', 'a/b'])
+    self.assertEqual(self._watcher.take_dirty(), [])
+
+  def test_new_directory(self):
+    self._watcher.take_dirty()
+    os.makedirs(self._path('a', 'new', 'deep'))
+    self._poll()
+    # Changes in the new directories are picked up too.
+    with open(self._path('a', 'new', 'deep', 'file3'), 'w') as f:
+      f.write('hello 3')
+    self._poll()
+    self.assertEqual(self._watcher.take_dirty(), ['a', 'a/new', 'a/new/deep'])
+
+  def test_directory_move_rescans(self):
+    self._watcher.take_dirty()
+    os.rename(self._path('a'), self._path('c'))
+    self._poll()
+    self.assertIsNone(self._watcher.take_dirty())
+    # Watches follow the new paths.
+    with open(self._path('c', 'b', 'file1'), 'w') as f:
+      f.write('changed')
+    self._poll()
+    self.assertEqual(self._watcher.take_dirty(), ['c/b'])
+
+  def test_deleted_directory(self):
+    self._watcher.take_dirty()
+    shutil.rmtree(self._path('a'))
+    self._poll()
+    self.assertEqual(self._watcher.take_dirty(), ['', 'a', 'a/b'])
+
+  def test_watch(self):
+    self._watcher.close()
+    calls: List[Optional[List[str]]] = []
+
+    def backup(dirty_dirs: Optional[List[str]]) -> None:
+      calls.append(dirty_dirs)
+      if len(calls) == 1:
+        os.remove(self._path('file2'))
+
+    watcher.watch(self._tmpdir,
+                  backup,
+                  interval_secs=0,
+                  debounce_secs=0.1,
+                  max_cycles=2)
+    self.assertEqual(calls, [None, ['']])
+
+  def setUp(self) -> None:
+    self._tmpdir_obj = tempfile.TemporaryDirectory(prefix='yaribak_test_')
+    self._tmpdir = self._tmpdir_obj.name
+    os.makedirs(self._path('a', 'b'))
+    with open(self._path('a', 'b', 'file1'), 'w') as f:
+      f.write('hello 1')
+    with open(self._path('file2'), 'w') as f:
+      f.write('hello 2')
+    self._watcher = watcher.TreeWatcher(self._tmpdir)
+
+  def tearDown(self) -> None:
+    try:
+      self._watcher.close()
+    except OSError:
+      pass
+    self._tmpdir_obj.cleanup()
+
+
+if __name__ == '__main__':
+  unittest.main()